@@ -1,14 +1,18 @@
 import fundus_prep as prep
 import os
 import sys
+import cv2
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from PIL import ImageFile
 import shutil
 from argparse import ArgumentParser
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
+from automorph_metadata import resolution_information
 from automorph_paths import prepare_automorph_data
+from automorph_timing import span
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -17,41 +21,101 @@ DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
 AUTOMORPH_DATA = DEFAULT_AUTOMORPH_DATA
 
-def process(image_list, save_path):
+def _init_worker():
+    # the images are already spread over the processes, one OpenCV thread each avoids oversubscription
+    cv2.setNumThreads(1)
+
+
+def crop_image(image_path, source_path, save_path, resolution, keep_image=False, export=True, mask_max_size=None):
+    """
+    Crops a single fundus image.
+
+    :param image_path: the image file name
+    :param source_path: the path of the image to read
+    :param save_path: the folder where the cropped PNG is written
+    :param resolution: the resolution of the image from resolution_information.csv
+    :param keep_image: whether the cropped image is returned
+    :param export: whether the cropped PNG is written
+    :param mask_max_size: optional largest side the rim of the field of view is located at, see fundus_prep.get_mask
+    :return: the crop_info.csv row of the image and the cropped image (None unless keep_image),
+             or None when the image could not be processed
+    """
+    try:
+        with span('M0.decode', images=1, image=image_path):
+            img = prep.imread(source_path)
+        with span('M0.mask', images=1, image=image_path):
+            r_img, borders, mask, r_img, radius_list, centre_list_w, centre_list_h = prep.process_without_gb(img, img, [], [], [], mask_max_size=mask_max_size)
+        if export:
+            with span('M0.write', images=1, image=image_path):
+                prep.imwrite(save_path + image_path.split('.')[0] + '.png', r_img)
+    except Exception:
+        return None
+    row = (image_path.split('.')[0] + '.png', centre_list_w[0], centre_list_h[0], radius_list[0], resolution)
+    return row, (r_img if keep_image else None)
+
+
+def _crop_images(tasks, num_workers):
+    # the results in task order as they come, the cropped images go to the store one by one
+    if num_workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield crop_image(*task)
+        return
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks)), initializer=_init_worker) as executor:
+        yield from executor.map(crop_image, *zip(*tasks), chunksize=max(1, len(tasks) // (4 * num_workers)))
+
+
+def process(image_list, save_path, images=None, export=True, num_workers=None, mask_max_size=None):
+    """
+    Crops the fundus images and writes their crop information to M0/crop_info.csv.
+
+    The images are spread over a pool of processes, the rows of crop_info.csv keep the order of
+    image_list whatever order the images finish in, and an image that fails is left out without
+    shifting the rows of the others.
+
+    :param image_list: the image file names
+    :param save_path: the folder where the cropped PNGs are written
+    :param images: optional ImageStore that receives the cropped images for the next stages
+    :param export: whether the cropped PNGs are written, they always are when images is None
+    :param num_workers: the number of processes, all the cores by default, 1 runs in this process
+    :param mask_max_size: optional largest side the rim of the field of view is located at, see fundus_prep.get_mask
+    """
     
-    radius_list = []
-    centre_list_w = []
-    centre_list_h = []
-    name_list = []
-    list_resolution = []
-    scale_resolution = []
-    
-    resolution_list = pd.read_csv(f'{AUTOMORPH_DATA}/resolution_information.csv')
+    resolutions = resolution_information(f'{AUTOMORPH_DATA}/resolution_information.csv').mapping('res')
     
+    tasks = []
     for image_path in image_list:
         
         dst_image = f'{AUTOMORPH_DATA}/images/' + image_path
         if os.path.exists(f'{AUTOMORPH_DATA}/Results/M0/images/' + image_path):
             print('continue...')
             continue
-        try:
-            resolution_ = resolution_list['res'][resolution_list['fundus']==image_path].values[0]
-            list_resolution.append(resolution_)
-            img = prep.imread(dst_image)
-            r_img, borders, mask, r_img, radius_list,centre_list_w, centre_list_h = prep.process_without_gb(img,img,radius_list,centre_list_w, centre_list_h)
-            prep.imwrite(save_path + image_path.split('.')[0] + '.png', r_img)
-            name_list.append(image_path.split('.')[0] + '.png')
-        
-        except:
-            pass
+        if image_path not in resolutions:
+            continue
+        tasks.append((image_path, dst_image, save_path, resolutions[image_path], images is not None, export or images is None, mask_max_size))
 
+    rows = []
+    for task, result in zip(tasks, _crop_images(tasks, num_workers or os.cpu_count() or 1)):
+        if result is None:
+            continue
+        row, r_img = result
+        rows.append(row)
+        if images is not None:
+            images.add(task[0].split('.')[0], r_img)
+
+    name_list = [row[0] for row in rows]
+    centre_list_w = [row[1] for row in rows]
+    centre_list_h = [row[2] for row in rows]
+    radius_list = [row[3] for row in rows]
+    list_resolution = [row[4] for row in rows]
     scale_list = [a*2/912 for a in radius_list]
     scale_resolution = [a*b*1000 for a,b in zip(list_resolution,scale_list)]
     Data4stage2 = pd.DataFrame({'Name':name_list, 'centre_w':centre_list_w, 'centre_h':centre_list_h, 'radius':radius_list, 'Scale':scale_list, 'Scale_resolution':scale_resolution})
     Data4stage2.to_csv(f'{AUTOMORPH_DATA}/Results/M0/crop_info.csv', index = None, encoding='utf8')
 
 
-if __name__ == "__main__":
+def main(argv=None, images=None, export=True):
+    global AUTOMORPH_DATA
+
     parser = ArgumentParser(description="Preprocess fundus images for AutoMorph")
     parser.add_argument(
         "--image_folder",
@@ -63,7 +127,19 @@ if __name__ == "__main__":
         default=str(Path(DEFAULT_AUTOMORPH_DATA) / "Results"),
         help="Path to the AutoMorph results folder",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="Number of processes used to crop the images, all the cores by default",
+    )
+    parser.add_argument(
+        "--mask_max_size",
+        type=int,
+        default=None,
+        help="Locate the rim of the field of view on the mask subsampled to this size, then measure it at full resolution",
+    )
+    args = parser.parse_args(argv)
 
     AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
 
@@ -74,10 +150,8 @@ if __name__ == "__main__":
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    process(image_list, save_path)
-
-        
-
-
+    process(image_list, save_path, images=images, export=export, num_workers=args.num_workers, mask_max_size=args.mask_max_size)
 
 
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,7 @@ def fold_dir(folder):
     return folder
 
 
-def get_mask_BZ(img):
+def get_mask_BZ(img, kernel_size=20):
     if img.ndim==3:
         gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     else:
@@ -49,7 +49,7 @@ def get_mask_BZ(img):
     _,new_mask,_,_ = cv2.floodFill(new_mask, nn_mask, (0,0), (0), cv2.FLOODFILL_MASK_ONLY)
     _,new_mask,_,_ = cv2.floodFill(new_mask, nn_mask, (new_mask.shape[1]-1,new_mask.shape[0]-1), (0), cv2.FLOODFILL_MASK_ONLY)
     mask = mask + new_mask
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (20,  20))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size,  kernel_size))
     mask = cv2.erode(mask, kernel)
     mask = cv2.dilate(mask, kernel)
     return mask
@@ -71,12 +71,52 @@ def _get_radius_by_mask_center(mask,center):
     mask=cv2.morphologyEx(mask, cv2.MORPH_GRADIENT, kernel)
     # radius=
     index=np.where(mask>0)
-    d_int=np.sqrt((index[0]-center[0])**2+(index[1]-center[1])**2)
+    return _radius_of_edge(index[0],index[1],center)
+
+
+def _radius_of_edge(rows,cols,center):
+    # the largest distance to the centre with nearly as many edge pixels as the most frequent one
+    d_int=np.sqrt((rows-center[0])**2+(cols-center[1])**2)
     b_count=np.bincount(np.ceil(d_int).astype(int))
     radius=np.where(b_count>b_count.max()*0.995)[0].max()
     return radius
 
 
+def _get_radius_in_annulus(mask, center, inner, outer, strip=64):
+    # _get_radius_by_mask_center with the morphological gradient only computed on the strips of rows
+    # that cross the annulus between inner and outer, the edges of the mask outside of it are left out
+    mask=mask.astype(np.uint8)
+    h, w = mask.shape
+    ksize=max(w//400*2+1,3)
+    kernel=cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(ksize,ksize))
+    pad = ksize//2
+    rows, cols = [], []
+    for top in range(max(0, int(center[0] - outer)), min(h, int(np.ceil(center[0] + outer)) + 1), strip):
+        bottom = min(h, top + strip, int(np.ceil(center[0] + outer)) + 1)
+        near = max(0.0, top - center[0], center[0] - (bottom - 1))
+        far = max(abs(top - center[0]), abs(bottom - 1 - center[0]))
+        reach = np.sqrt(max(outer**2 - near**2, 0.0))
+        hole = np.sqrt(inner**2 - far**2) if inner > far else 0.0
+        intervals = [(int(center[1] - reach) - 1, int(np.ceil(center[1] - hole)) + 1),
+                     (int(center[1] + hole) - 1, int(np.ceil(center[1] + reach)) + 1)]
+        if intervals[0][1] >= intervals[1][0]:
+            intervals = [(intervals[0][0], intervals[1][1])]
+        for left, right in intervals:
+            left, right = max(0, left), min(w, right)
+            if left >= right:
+                continue
+            # the padding holds the neighbours of the strip, the image border is kept as is
+            t0, l0 = max(0, top - pad), max(0, left - pad)
+            gradient = cv2.morphologyEx(mask[t0:min(h, bottom + pad), l0:min(w, right + pad)], cv2.MORPH_GRADIENT, kernel)
+            index = np.nonzero(gradient[top - t0:bottom - t0, left - l0:right - l0])
+            rows.append(index[0] + top)
+            cols.append(index[1] + left)
+    if sum(len(index) for index in rows) == 0:
+        # no rim in the annulus, the whole mask is measured
+        return _get_radius_by_mask_center(mask, center)
+    return _radius_of_edge(np.concatenate(rows), np.concatenate(cols), center)
+
+
 def _get_circle_by_center_bbox(shape,center,bbox,radius):
     center_mask=np.zeros(shape=shape).astype('uint8')
     tmp_mask=np.zeros(shape=bbox[2:4])
@@ -87,7 +127,18 @@ def _get_circle_by_center_bbox(shape,center,bbox,radius):
     return center_mask
 
 
-def get_mask(img):
+def get_mask(img, max_size=None):
+    """
+    Estimates the circular field of view of a fundus image.
+
+    :param img: the RGB or gray image
+    :param max_size: optional largest side the rim is located at. Larger images have a coarse radius
+                     measured on a copy of their mask subsampled to this size, the gradient of the
+                     full resolution mask is then only computed on an annulus around it. The centre
+                     and the radius are the same as without max_size, unless the mask has other
+                     edges with nearly as many pixels at one distance from the centre as its rim
+    :return: the mask, the bounding box, the centre and the radius of the field of view
+    """
     if img.ndim ==3:
         #raise 'image dim is not 3'
         g_img=cv2.cvtColor(img,cv2.COLOR_RGB2GRAY)
@@ -99,18 +150,24 @@ def get_mask(img):
         raise 'image dim is not 1 or 3'
     h,w = g_img.shape
     shape=g_img.shape[0:2]
-    #g_img = cv2.resize(g_img,(0,0),fx = 0.5,fy = 0.5)
     tg_img=cv2.normalize(g_img, None, 0, 255, cv2.NORM_MINMAX)
-    tmp_mask=get_mask_BZ(tg_img)
-    center=_get_center_by_edge(tmp_mask)
-    #bbox=_get_bbox_by_mask(tmp_mask)
-    #print(center)
-    #cv2.imshow('ImageWindow', tmp_mask*255)
-    #cv2.waitKey()
-    radius=_get_radius_by_mask_center(tmp_mask,center)
-    #resize back
-    #center = [center[0]*2,center[1]*2]
-    #radius = int(radius*2)
+    if max_size is not None and max(h, w) > max_size:
+        tmp_mask=get_mask_BZ(tg_img)
+        center=_get_center_by_edge(tmp_mask)
+        # a coarse radius on every step-th pixel of the mask, the rim of the full resolution gradient
+        # lies within a few steps and the width of the gradient around it
+        step = int(np.ceil(max(h, w) / max_size))
+        coarse_radius = step * _get_radius_by_mask_center(tmp_mask[::step, ::step], [center[0] / step, center[1] / step])
+        margin = 0.02 * coarse_radius + 4 * step + w//400 + 2
+        radius=_get_radius_in_annulus(tmp_mask, center, coarse_radius - margin, coarse_radius + margin)
+    else:
+        tmp_mask=get_mask_BZ(tg_img)
+        center=_get_center_by_edge(tmp_mask)
+        #bbox=_get_bbox_by_mask(tmp_mask)
+        #print(center)
+        #cv2.imshow('ImageWindow', tmp_mask*255)
+        #cv2.waitKey()
+        radius=_get_radius_by_mask_center(tmp_mask,center)
     
     center = [center[0], center[1]]
     radius = int(radius)
@@ -154,16 +211,17 @@ def supplemental_black_area(img,border=None):
     return image,border
 
 
-def process_without_gb(img, label,radius_list,centre_list_w, centre_list_h):
+def process_without_gb(img, label,radius_list,centre_list_w, centre_list_h, mask_max_size=None):
     # preprocess images
     #   img : origin image
     #   tar_height: height of tar image
+    #   mask_max_size: largest side the field of view is estimated at, see get_mask
     # return:
     #   result_img: preprocessed image
     #   borders: remove border, supplement mask
     #   mask: mask for preprocessed image
     borders = []
-    mask, bbox, center, radius = get_mask(img)
+    mask, bbox, center, radius = get_mask(img, max_size=mask_max_size)
     #print('center is: ',center)
     #print('radius is: ',radius)
     r_img = mask_image(img, mask)
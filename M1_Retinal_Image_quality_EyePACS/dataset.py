@@ -1,3 +1,4 @@
+import sys
 import numpy as np
 import torch
 from glob import glob
@@ -10,6 +11,10 @@ from PIL import Image, ImageEnhance
 import pandas as pd
 from os.path import splitext
 from os import listdir
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from automorph_timing import span
 
 
 class BasicDataset(Dataset):
@@ -89,15 +94,20 @@ class BasicDataset(Dataset):
 
 class BasicDataset_OUT(Dataset):
     'Characterizes a dataset for PyTorch'
-    def __init__(self, image_dir, image_size, n_classes, train_or):
+    def __init__(self, image_dir, image_size, n_classes, train_or, images=None):
         'Initialization'
         self.image_size = image_size
         self.image_dir = image_dir
         self.n_classes = n_classes
         self.train_or = train_or
-        
-        self.ids = [splitext(file)[0] for file in sorted(listdir(image_dir))
-                    if not file.startswith('.')]
+        # optional ImageStore holding the M0 images, used instead of the PNGs in image_dir
+        self.images = images
+        
+        if images is not None:
+            self.ids = images.names()
+        else:
+            self.ids = [splitext(file)[0] for file in sorted(listdir(image_dir))
+                        if not file.startswith('.')]
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
         
@@ -128,9 +138,15 @@ class BasicDataset_OUT(Dataset):
     def __getitem__(self, index):
         
         idx = self.ids[index]
-        img_file = glob(self.image_dir + idx + '.*')
-        image = Image.open(img_file[0])
-        image_processed = self.preprocess(image, self.image_size, self.train_or, index)
+        with span('M1.decode', images=1, image=idx):
+            if self.images is not None:
+                # already at the network size, so the resize in preprocess is a plain copy
+                img_file = [self.image_dir + idx + '.png']
+                image = self.images.resized(idx, self.image_size)
+            else:
+                img_file = glob(self.image_dir + idx + '.*')
+                image = Image.open(img_file[0])
+            image_processed = self.preprocess(image, self.image_size, self.train_or, index)
  
         return {
             'img_file': img_file,
@@ -12,7 +12,13 @@ from automorph_paths import prepare_automorph_data
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
 
-def main():
+def main(argv=None, images=None, export=True):
+    """
+    Splits the M0 images into Good_quality and Bad_quality after the M1 ensemble.
+
+    :param images: optional ImageStore with the M0 images, the gradable ones are returned in a new store
+    :param export: whether the images are copied to the quality folders, they always are when images is None
+    """
     parser = ArgumentParser(description='Merge AutoMorph quality assessment results')
     parser.add_argument(
         '--image_folder',
@@ -24,7 +30,7 @@ def main():
         default=str(Path(DEFAULT_AUTOMORPH_DATA) / 'Results'),
         help='Path to the AutoMorph results folder'
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     automorph_base, _ = prepare_automorph_data(args.image_folder, args.result_folder)
 
@@ -44,25 +50,35 @@ def main():
 
     Eye_good = 0
     Eye_bad = 0
+    good_names = []
+    copy_images = images is None or export
 
     for i in range(len(name_list)):
 
         if Eyepacs_pre[i]==0:
             Eye_good+=1
-            shutil.copy(name_list[i], good_quality_dir)
+            good_names.append(os.path.splitext(os.path.basename(name_list[i]))[0])
+            if copy_images:
+                shutil.copy(name_list[i], good_quality_dir)
         elif (Eyepacs_pre[i]==1) and (Eyepacs_bad_mean[i]<0.25):
         #elif (Eyepacs_pre[i]==1) and (Eyepacs_bad_mean[i]<0.25) and (Eyepacs_usable_sd[i]<0.1):
             Eye_good+=1
-            shutil.copy(name_list[i], good_quality_dir)
+            good_names.append(os.path.splitext(os.path.basename(name_list[i]))[0])
+            if copy_images:
+                shutil.copy(name_list[i], good_quality_dir)
         else:
             Eye_bad+=1
-            shutil.copy(name_list[i], bad_quality_dir)
+            if copy_images:
+                shutil.copy(name_list[i], bad_quality_dir)
             #shutil.copy(name_list[i], '../Results/M1/Good_quality/')
 
 
     print('Gradable cases by EyePACS_QA is {} '.format(Eye_good))
     print('Ungradable cases by EyePACS_QA is {} '.format(Eye_bad))
 
+    if images is not None:
+        return images.subset(good_names)
+
 
 if __name__ == '__main__':
     main()
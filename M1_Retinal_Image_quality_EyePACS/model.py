@@ -19,7 +19,8 @@ import torch
 ##########################  Unet ######################################3
 
 def InceptionV3_fl(pretrained):
-    inception_v3 = models.inception_v3(pretrained = True)
+    # the ImageNet weights come with transform_input, the architecture is the same without them
+    inception_v3 = models.inception_v3(pretrained = pretrained, transform_input = True)
     inception_v3.fc = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(2048, 256),
@@ -37,7 +38,11 @@ def InceptionV3_fl(pretrained):
 
 
 def Efficientnet_fl(pretrained):
-    model = EfficientNet.from_pretrained('efficientnet-b4')
+    # without the ImageNet weights, the architecture is built from its config alone, nothing is downloaded
+    if pretrained:
+        model = EfficientNet.from_pretrained('efficientnet-b4')
+    else:
+        model = EfficientNet.from_name('efficientnet-b4')
     model._fc = nn.Identity()
     net_fl = nn.Sequential(
             nn.Linear(1792, 256),
@@ -55,7 +60,7 @@ def Efficientnet_fl(pretrained):
 
 
 def Densenet161_fl(pretrained):
-    densenet161 = models.densenet161(pretrained = True)
+    densenet161 = models.densenet161(pretrained = pretrained)
     densenet161.classifier = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(2208, 256),
@@ -72,7 +77,7 @@ def Densenet161_fl(pretrained):
 
 
 def Resnet101_fl(pretrained):
-    resnet101 = models.resnet101(pretrained = True)
+    resnet101 = models.resnet101(pretrained = pretrained)
     resnet101.fc = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(2048, 256),
@@ -89,7 +94,7 @@ def Resnet101_fl(pretrained):
 
 
 def Resnext101_32x8d_fl(pretrained):
-    resnext101_32x8d = models.resnext101_32x8d(pretrained = True)
+    resnext101_32x8d = models.resnext101_32x8d(pretrained = pretrained)
     resnext101_32x8d.fc = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(2048, 256),
@@ -106,7 +111,7 @@ def Resnext101_32x8d_fl(pretrained):
 
 
 def MobilenetV2_fl(pretrained):
-    mobilenet_v2 = models.mobilenet_v2(pretrained = True)
+    mobilenet_v2 = models.mobilenet_v2(pretrained = pretrained)
     mobilenet_v2.classifier = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(1280, 256),
@@ -124,7 +129,7 @@ def MobilenetV2_fl(pretrained):
 
 
 def Vgg16_bn_fl(pretrained):
-    vgg16_bn = models.vgg16_bn(pretrained = True)
+    vgg16_bn = models.vgg16_bn(pretrained = pretrained)
     vgg16_bn.classifier = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(25088, 256),
@@ -16,6 +16,10 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from automorph_paths import prepare_automorph_data
+from automorph_ensemble import RunningMoments
+from automorph_onnx import BACKENDS, ONNX_FOLDER, load_ensemble
+from automorph_optimize import input_memory_format, optimize_ensemble
+from automorph_timing import Stopwatch
 
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
@@ -36,6 +40,7 @@ def test_net(model_fl_1,
               batch_size=20,
               num_workers=8,
               image_size=(512,512),
+              images=None,
               ):
 
     storage_path ="Ensemble_exp_{}/{}/train_on_{}/test_on_{}/".format(args.task, args.load, args.model, args.dataset)
@@ -45,7 +50,7 @@ def test_net(model_fl_1,
     if not os.path.isdir(storage_path):
         os.makedirs(storage_path)
     
-    dataset = BasicDataset_OUT(test_dir, image_size, n_classes, train_or=False)
+    dataset = BasicDataset_OUT(test_dir, image_size, n_classes, train_or=False, images=images)
         
     n_test = len(dataset)
     val_loader = DataLoader(
@@ -61,7 +66,6 @@ def test_net(model_fl_1,
     filename_list = []
     prediction_list_mean = []
     prediction_list_std = []
-    mask_pred_tensor_small_all = 0
     for epoch in range(epochs):
 
         model_fl_1.eval()
@@ -72,74 +76,31 @@ def test_net(model_fl_1,
         model_fl_6.eval()
         model_fl_7.eval()
         model_fl_8.eval()
-
+        memory_format = input_memory_format([model_fl_1])
 
         with tqdm(total=n_test, desc=f'Epoch {epoch + 1}/{epochs}', unit='img') as pbar:
             for batch in val_loader:
                 imgs = batch['image']
                 filename = batch['img_file'][0]
-                mask_pred_tensor_small_all = 0
-                imgs = imgs.to(device=device, dtype=torch.float32)
+                imgs = imgs.to(device=device, dtype=torch.float32, memory_format=memory_format)
                 ##################sigmoid or softmax
 
-                prediction_list = []
-                with torch.no_grad():
-                    #print(real_patch.size())
-                    prediction = model_fl_1(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_2(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_3(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_4(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_5(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_6(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_7(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    prediction = model_fl_8(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all+=mask_pred_tensor_small.type(torch.FloatTensor)
-                    prediction_list.append(mask_pred_tensor_small.type(torch.FloatTensor).cpu().detach().numpy())
-
-                    mask_pred_tensor_small_all = mask_pred_tensor_small_all/8
-
-                    _,prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
+                with torch.inference_mode():
+                    # running mean and spread of the eight softmax outputs, kept on the device
+                    moments = RunningMoments()
+                    forward, reduce = Stopwatch(device), Stopwatch(device)
+                    for model in (model_fl_1, model_fl_2, model_fl_3, model_fl_4, model_fl_5, model_fl_6, model_fl_7, model_fl_8):
+                        with forward:
+                            prediction = model(imgs)
+                        with reduce:
+                            moments.update(nn.Softmax(dim=1)(prediction))
+                    forward.record('M1.forward', images=imgs.shape[0])
+                    reduce.record('M1.ensemble_reduce', images=imgs.shape[0])
+
+                    _,prediction_decode = torch.max(moments.mean, 1)
                     
-                    prediction_list = np.array(prediction_list)
-                    prediction_list_mean.extend(np.mean(prediction_list, axis=0))
-                    prediction_list_std.extend(np.std(prediction_list, axis=0))
+                    prediction_list_mean.extend(moments.mean.cpu().numpy())
+                    prediction_list_std.extend(moments.std().cpu().numpy())
 
                     prediction_decode_list.extend(prediction_decode.cpu().detach().numpy())
                     filename_list.extend(filename)
@@ -154,7 +115,7 @@ def test_net(model_fl_1,
 
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description='Train the UNet on images and target masks',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-e', '--epochs', metavar='E', type=int, default=240,
@@ -185,6 +146,33 @@ def get_args():
         help='Number of worker processes for the DataLoader',
         dest='num_workers'
     )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        default='torch',
+        choices=BACKENDS,
+        help='Run the models with PyTorch, or with ONNX Runtime on the graphs exported by automorph_onnx.py',
+        dest='backend'
+    )
+    parser.add_argument(
+        '--onnx_folder',
+        type=str,
+        default=None,
+        help='Folder of the exported graphs, for the onnx backend, by default the onnx folder of the stage',
+        dest='onnx_folder'
+    )
+    parser.add_argument(
+        '--optimize',
+        action='store_true',
+        help='Fold the BatchNorm layers of the models and convert them to channels-last, see automorph_optimize.py',
+        dest='optimize'
+    )
+    parser.add_argument(
+        '--torchscript',
+        action='store_true',
+        help='Freeze the models with TorchScript, the frozen models are cached, see automorph_optimize.py',
+        dest='torchscript'
+    )
     parser.add_argument(
         '--image_folder',
         type=str,
@@ -200,22 +188,14 @@ def get_args():
         dest='result_folder'
     )
 
-    return parser.parse_args()
-
-
-if __name__ == '__main__':
-
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    args = get_args()
-
-    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
-    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+    return parser.parse_args(argv)
 
 
+def select_device(local_rank=0):
     # Check if CUDA is available
     if torch.cuda.is_available():
         logging.info("CUDA is available. Using CUDA...")
-        device = torch.device("cuda",args.local_rank)
+        device = torch.device("cuda",local_rank)
     elif torch.backends.mps.is_available():  # Check if MPS is available (for macOS)
         logging.info("MPS is available. Using MPS...")
         device = torch.device("mps")
@@ -225,38 +205,46 @@ if __name__ == '__main__':
 
     logging.info(f'Using device {device}')
 
-    test_dir = args.test_dir
-    dataset=args.dataset
-    img_size= (512,512)
+    return device
 
+
+def load_models(args, device, torchscript=False, optimize=False):
+    """
+    Builds the eight quality models of args.model on the device and loads their checkpoints,
+    so they can be reused over several calls of main. They are optimised for inference with optimize,
+    and frozen with torchscript, see automorph_optimize.
+    """
+    # the checkpoints replace every weight, so the architectures are built from their config alone,
+    # without downloading or loading the ImageNet weights
+    pretrained = not args.load
     if args.model=='inceptionv3':
-        model_fl = InceptionV3_fl(pretrained=True)
+        model_fl = InceptionV3_fl(pretrained=pretrained)
     if args.model=='densenet161':
-        model_fl = Densenet161_fl(pretrained=True)
+        model_fl = Densenet161_fl(pretrained=pretrained)
     if args.model == 'resnet101':   
-        model_fl = Resnet101_fl(pretrained=True)
+        model_fl = Resnet101_fl(pretrained=pretrained)
     if args.model == 'resnext101':   
-        model_fl_1 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_2 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_3 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_4 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_5 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_6 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_7 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_8 = Resnext101_32x8d_fl(pretrained=True)
+        model_fl_1 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_2 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_3 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_4 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_5 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_6 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_7 = Resnext101_32x8d_fl(pretrained=pretrained)
+        model_fl_8 = Resnext101_32x8d_fl(pretrained=pretrained)
     if args.model == 'efficientnet':   
-        model_fl_1 = Efficientnet_fl(pretrained=True)
-        model_fl_2 = Efficientnet_fl(pretrained=True)
-        model_fl_3 = Efficientnet_fl(pretrained=True)
-        model_fl_4 = Efficientnet_fl(pretrained=True)
-        model_fl_5 = Efficientnet_fl(pretrained=True)
-        model_fl_6 = Efficientnet_fl(pretrained=True)
-        model_fl_7 = Efficientnet_fl(pretrained=True)
-        model_fl_8 = Efficientnet_fl(pretrained=True)
+        model_fl_1 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_2 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_3 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_4 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_5 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_6 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_7 = Efficientnet_fl(pretrained=pretrained)
+        model_fl_8 = Efficientnet_fl(pretrained=pretrained)
     if args.model == 'mobilenetv2':   
-        model_fl = MobilenetV2_fl(pretrained=True)
+        model_fl = MobilenetV2_fl(pretrained=pretrained)
     if args.model == 'vgg16bn':   
-        model_fl = Vgg16_bn_fl(pretrained=True)
+        model_fl = Vgg16_bn_fl(pretrained=pretrained)
 
     checkpoint_path_1 = './{}/{}/{}/7_seed_28/best_loss_checkpoint.pth'.format(args.task, args.load, args.model )
     checkpoint_path_2 = './{}/{}/{}/6_seed_30/best_loss_checkpoint.pth'.format(args.task, args.load, args.model  )
@@ -303,6 +291,33 @@ if __name__ == '__main__':
             torch.load(checkpoint_path_8, map_location=device)
         )
 
+    checkpoints = [checkpoint_path_1, checkpoint_path_2, checkpoint_path_3, checkpoint_path_4,
+                   checkpoint_path_5, checkpoint_path_6, checkpoint_path_7, checkpoint_path_8] if args.load else None
+    return optimize_ensemble('quality', [model_fl_1, model_fl_2, model_fl_3, model_fl_4, model_fl_5, model_fl_6, model_fl_7, model_fl_8],
+                             checkpoints, torchscript, optimize)
+
+
+def main(argv=None, models=None, images=None):
+    global AUTOMORPH_DATA, args
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    args = get_args(argv)
+
+    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
+    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+
+    device = select_device(args.local_rank)
+
+    test_dir = args.test_dir
+    dataset=args.dataset
+    img_size= (512,512)
+
+    if models is None and args.backend != 'torch':
+        models = load_ensemble(args.onnx_folder or ONNX_FOLDER, 'quality')
+    elif models is None:
+        models = load_models(args, device, args.torchscript, args.optimize)
+    model_fl_1, model_fl_2, model_fl_3, model_fl_4, model_fl_5, model_fl_6, model_fl_7, model_fl_8 = models
+
     try:
         test_net(model_fl_1,
                  model_fl_2,
@@ -317,7 +332,8 @@ if __name__ == '__main__':
                   epochs=args.epochs,
                   batch_size=args.batchsize,
                   num_workers=args.num_workers,
-                  image_size=img_size)
+                  image_size=img_size,
+                  images=images)
     except KeyboardInterrupt:
         torch.save(model_fl.state_dict(), 'INTERRUPTED.pth')
         logging.info('Saved interrupt')
@@ -327,8 +343,5 @@ if __name__ == '__main__':
             os._exit(0)
 
 
-
-
-
-
-
+if __name__ == '__main__':
+    main()
@@ -155,7 +155,7 @@ class LearningAVSegData(Dataset):
     
     
 class LearningAVSegData_OOD(Dataset):
-    def __init__(self, imgs_dir, label_dir,  mask_dir, img_size, dataset_name, train_or=True, mask_suffix=''):
+    def __init__(self, imgs_dir, label_dir,  mask_dir, img_size, dataset_name, train_or=True, mask_suffix='', images=None):
         self.imgs_dir = imgs_dir
         self.label_dir = label_dir
         self.mask_dir = mask_dir
@@ -163,10 +163,15 @@ class LearningAVSegData_OOD(Dataset):
         self.img_size = img_size
         self.dataset_name = dataset_name
         self.train_or = train_or
+        # optional ImageStore holding the gradable images, used instead of the PNGs in imgs_dir
+        self.images = images
         
         i = 0
-        self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
-                    if not file.startswith('.')]
+        if images is not None:
+            self.ids = images.names()
+        else:
+            self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
+                        if not file.startswith('.')]
         #logging.info(f'Creating dataset with {(self.ids)} ')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
@@ -220,17 +225,21 @@ class LearningAVSegData_OOD(Dataset):
 
         idx = self.ids[i]
         
-        if self.dataset_name=='HRF-AV':
-            img_file = glob(self.imgs_dir + idx + '.*')
-            
+        if self.images is not None:
+            ori_width, ori_height = self.images.open(idx).size
+            img = self.images.resized(idx, self.img_size)
         else:
-            img_file = glob(self.imgs_dir + idx + '.*')
-        
+            if self.dataset_name=='HRF-AV':
+                img_file = glob(self.imgs_dir + idx + '.*')
+                
+            else:
+                img_file = glob(self.imgs_dir + idx + '.*')
+            
 
 
-        img = Image.open(img_file[0])
-        ori_width, ori_height = img.size
-        img = img.resize(self.img_size)
+            img = Image.open(img_file[0])
+            ori_width, ori_height = img.size
+            img = img.resize(self.img_size)
 
         img= self.preprocess(img, self.dataset_name, self.img_size, self.train_or)
         i += 1
@@ -18,83 +18,121 @@ from PIL import Image
 import pandas as pd
 from skimage import io
 from scripts.utils import Define_image_size
-from FD_cal import fractal_dimension,vessel_density
+from FD_cal import fractal_dimensions,vessel_density
 from skimage.morphology import skeletonize,remove_small_objects
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from automorph_paths import prepare_automorph_data
+from automorph_ensemble import RunningMoments
+from automorph_onnx import BACKENDS, ONNX_FOLDER, load_ensemble
+from automorph_optimize import input_memory_format, optimize_ensemble
+from automorph_timing import Stopwatch, span
+from automorph_workers import TaskPool
 
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
 
 AUTOMORPH_DATA = DEFAULT_AUTOMORPH_DATA
 
-def filter_frag(data_path):
+def _init_worker():
+    # the images are already spread over the processes, one OpenCV thread each avoids oversubscription
+    cv2.setNumThreads(1)
+
+
+def postprocess(data_path, name, img):
+    """
+    Splits an artery/vein map into its artery and vein maps, removes their small fragments, writes
+    them and their skeletons, and measures them.
+
+    :param data_path: the M2/artery_vein folder
+    :param name: the PNG file name of the image
+    :param img: the RGB map as written in resized, red for the arteries, blue for the veins and
+                green for the crossings
+    :return: the fractal dimension, the vessel density and the width of the arteries, then of the veins
+    """
+    img = cv2.resize(img,(912,912),interpolation = cv2.INTER_NEAREST)
+    img2=img>0
+    img_r = img2[...,0] + img2[...,1]
+    img_b = img2[...,2] + img2[...,1]
+    img_r = remove_small_objects(img_r, 30, connectivity=5)
+    img_b = remove_small_objects(img_b, 30, connectivity=5)
+    
+    if not os.path.isdir(data_path + 'artery_binary_process/'):
+        os.makedirs(data_path + 'artery_binary_process/', exist_ok=True)
+    io.imsave(data_path + 'artery_binary_process/' + name , 255*(img_r.astype('uint8')),check_contrast=False)
+    if not os.path.isdir(data_path + 'vein_binary_process/'):
+        os.makedirs(data_path + 'vein_binary_process/', exist_ok=True)
+    io.imsave(data_path + 'vein_binary_process/' + name , 255*(img_b.astype('uint8')),check_contrast=False)
+    
+    with span('M2.artery_vein.skeletonize', images=1, image=name):
+        skeleton_r = skeletonize(img_r)
+        skeleton_b = skeletonize(img_b)
+    
+    if not os.path.isdir(data_path + 'artery_binary_skeleton/'):
+        os.makedirs(data_path + 'artery_binary_skeleton/', exist_ok=True)
+    io.imsave(data_path + 'artery_binary_skeleton/' + name, 255*(skeleton_r.astype('uint8')),check_contrast=False)
+    if not os.path.isdir(data_path + 'vein_binary_skeleton/'):
+        os.makedirs(data_path + 'vein_binary_skeleton/', exist_ok=True)
+    io.imsave(data_path + 'vein_binary_skeleton/' + name, 255*(skeleton_b.astype('uint8')),check_contrast=False)
+    
+    
+    # both maps counted in one pass
+    FD_boxcounting_r, FD_boxcounting_b = fractal_dimensions([img_r, img_b])
+    VD_r = vessel_density(img_r)
+    VD_b = vessel_density(img_b)
+    width_r = np.sum(img_r)/np.sum(skeleton_r)
+    width_b = np.sum(img_b)/np.sum(skeleton_b)
+    return FD_boxcounting_r, VD_r, width_r, FD_boxcounting_b, VD_b, width_b
+
+
+def filter_frag(data_path, pool=None):
+    """
+    Post-processes the maps written in resized, see postprocess.
+
+    :param pool: optional TaskPool the images are spread over
+    """
     if os.path.isdir(data_path + 'raw/.ipynb_checkpoints'):
         shutil.rmtree(data_path + 'raw/.ipynb_checkpoints')
 
     image_list=os.listdir(data_path + 'raw')
-    FD_cal_r=[]
-    name_list=[]
-    VD_cal_r=[]
-    FD_cal_b=[]
-    VD_cal_b=[]
-    width_cal_r=[]
-    width_cal_b=[]
+    pool = pool or TaskPool(1)
+    name_list=sorted(image_list)
     
-    for i in sorted(image_list):
-        img=io.imread(data_path + 'resized/' + i).astype(np.int64)
-        img = cv2.resize(img,(912,912),interpolation = cv2.INTER_NEAREST)
-        img2=img>0
-        img_r = img2[...,0] + img2[...,1]
-        img_b = img2[...,2] + img2[...,1]
-        img_r = remove_small_objects(img_r, 30, connectivity=5)
-        img_b = remove_small_objects(img_b, 30, connectivity=5)
-        
-        if not os.path.isdir(data_path + 'artery_binary_process/'):
-            os.makedirs(data_path + 'artery_binary_process/') 
-        io.imsave(data_path + 'artery_binary_process/' + i , 255*(img_r.astype('uint8')),check_contrast=False)
-        if not os.path.isdir(data_path + 'vein_binary_process/'):
-            os.makedirs(data_path + 'vein_binary_process/') 
-        io.imsave(data_path + 'vein_binary_process/' + i , 255*(img_b.astype('uint8')),check_contrast=False)
-        
-        skeleton_r = skeletonize(img_r)
-        skeleton_b = skeletonize(img_b)
-        
-        if not os.path.isdir(data_path + 'artery_binary_skeleton/'):
-            os.makedirs(data_path + 'artery_binary_skeleton/') 
-        io.imsave(data_path + 'artery_binary_skeleton/' + i, 255*(skeleton_r.astype('uint8')),check_contrast=False)
-        if not os.path.isdir(data_path + 'vein_binary_skeleton/'):
-            os.makedirs(data_path + 'vein_binary_skeleton/') 
-        io.imsave(data_path + 'vein_binary_skeleton/' + i, 255*(skeleton_b.astype('uint8')),check_contrast=False)
-        
-        
-        FD_boxcounting_r = fractal_dimension(img_r)
-        FD_boxcounting_b = fractal_dimension(img_b)
-        VD_r = vessel_density(img_r)
-        VD_b = vessel_density(img_b)
-        width_r = np.sum(img_r)/np.sum(skeleton_r)
-        width_b = np.sum(img_b)/np.sum(skeleton_b)
-        
-        FD_cal_r.append(FD_boxcounting_r)
-        name_list.append(i)
-        VD_cal_r.append(VD_r)
-        FD_cal_b.append(FD_boxcounting_b)
-        VD_cal_b.append(VD_b)
-        width_cal_r.append(width_r)
-        width_cal_b.append(width_b)
+    for i in name_list:
+        img=io.imread(data_path + 'resized/' + i)
+        pool.submit(postprocess, data_path, i, img)
     
-    return FD_cal_r,name_list,VD_cal_r,FD_cal_b,VD_cal_b,width_cal_r,width_cal_b
+    return collect(name_list, pool.results())
 
 
+def collect(name_list, results):
+    """The artery fractal dimensions, names, artery densities, vein fractal dimensions, vein densities, artery widths and vein widths, sorted by name."""
+    rows = sorted(zip(name_list, results), key=lambda row: row[0])
+    FD_cal_r = [result[0] for _, result in rows]
+    VD_cal_r = [result[1] for _, result in rows]
+    width_cal_r = [result[2] for _, result in rows]
+    FD_cal_b = [result[3] for _, result in rows]
+    VD_cal_b = [result[4] for _, result in rows]
+    width_cal_b = [result[5] for _, result in rows]
+    return FD_cal_r,[name for name, _ in rows],VD_cal_r,FD_cal_b,VD_cal_b,width_cal_r,width_cal_b
 
-def test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G_3, net_G_A_3, net_G_V_3, net_G_4, net_G_A_4, net_G_V_4, net_G_5, net_G_A_5, net_G_V_5, net_G_6, net_G_A_6, net_G_V_6, net_G_7, net_G_A_7, net_G_V_7, net_G_8, net_G_A_8, net_G_V_8, loader, device, mode, dataset):
+
+
+def test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G_3, net_G_A_3, net_G_V_3, net_G_4, net_G_A_4, net_G_V_4, net_G_5, net_G_A_5, net_G_V_5, net_G_6, net_G_A_6, net_G_V_6, net_G_7, net_G_A_7, net_G_V_7, net_G_8, net_G_A_8, net_G_V_8, loader, device, mode, dataset, pool=None):
+    """
+    Segments the arteries and veins of the images of the loader and writes the maps. When a pool is
+    given, the maps are post-processed in it, straight from memory, while the next batches are
+    segmented, and the names of the images submitted are returned.
+    """
 
     
     n_val = len(loader) 
 
     num = 0
+    members = [(net_G_1, net_G_A_1, net_G_V_1), (net_G_2, net_G_A_2, net_G_V_2), (net_G_3, net_G_A_3, net_G_V_3),
+               (net_G_4, net_G_A_4, net_G_V_4), (net_G_5, net_G_A_5, net_G_V_5), (net_G_6, net_G_A_6, net_G_V_6),
+               (net_G_7, net_G_A_7, net_G_V_7), (net_G_8, net_G_A_8, net_G_V_8)]
     
     seg_results_small_path = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/resized/'
     seg_results_raw_path = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/raw/'
@@ -114,6 +152,8 @@ def test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G
     if not os.path.isdir(seg_uncertainty_raw_path):
         os.makedirs(seg_uncertainty_raw_path)
         
+    submitted = []
+    memory_format = input_memory_format([net_G_1])
         
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in loader:
@@ -121,104 +161,29 @@ def test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G
             ori_width=batch['width']
             ori_height=batch['height']
             img_name = batch['name']
-            mask_pred_tensor_small_all = 0
-            imgs = imgs.to(device=device, dtype=torch.float32)
+            imgs = imgs.to(device=device, dtype=torch.float32, memory_format=memory_format)
 
-            with torch.no_grad():
+            with torch.inference_mode():
 
                 num +=1
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_1(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_1(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_1(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_1 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_1.type(torch.FloatTensor)
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_2(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_2(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_2(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_2 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_2.type(torch.FloatTensor)
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_3(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_3(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_3(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_3 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_3.type(torch.FloatTensor)                
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_4(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_4(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_4(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_4 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_4.type(torch.FloatTensor)    
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_5(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_5(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_5(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_5 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_5.type(torch.FloatTensor)    
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_6(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_6(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_6(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_6 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_6.type(torch.FloatTensor)   
-                
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_7(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_7(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_7(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_7 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_7.type(torch.FloatTensor)   
-                
-                
-                
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_8(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_8(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
-
-                mask_pred,_,_,_ = net_G_8(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_8 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_8.type(torch.FloatTensor)   
-                
-                mask_pred_tensor_small_all = (mask_pred_tensor_small_all/8).to(device=device)
-                
-                uncertainty_map = torch.sqrt((torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_1)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_2)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_3)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_4)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_5)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_6)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_7)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_8))/8)
+                # running mean and spread of the eight softmax maps, kept on the device
+                moments = RunningMoments()
+                forward, reduce = Stopwatch(device), Stopwatch(device)
+                for net_G, net_G_A, net_G_V in members:
+                    with forward:
+                        masks_pred_G_A, masks_pred_G_fusion_A = net_G_A(imgs)
+                        masks_pred_G_V, masks_pred_G_fusion_V = net_G_V(imgs)
+                        masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
+                        masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+
+                        mask_pred,_,_,_ = net_G(imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part)
+                    with reduce:
+                        moments.update(F.softmax(mask_pred.detach(),dim=1))
+                forward.record('M2.artery_vein.forward', images=imgs.shape[0])
+                reduce.record('M2.artery_vein.ensemble_reduce', images=imgs.shape[0])
+
+                mask_pred_tensor_small_all = moments.mean
+                uncertainty_map = moments.std()
             
                 _,prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
                 prediction_decode=prediction_decode.type(torch.FloatTensor)
@@ -234,46 +199,59 @@ def test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G
                 
                 for i in range(n_img):
                     
-                    save_image(uncertainty_map[i,...]*255, seg_uncertainty_small_path+img_name[i]+'.png')
-                    save_image(uncertainty_map[i,1,...]*255, seg_uncertainty_small_path+img_name[i]+'_artery.png')
-                    save_image(uncertainty_map[i,2,...]*255, seg_uncertainty_small_path+img_name[i]+'_vein.png')
+                    with span('M2.artery_vein.write', images=1, image=img_name[i]):
+                        save_image(uncertainty_map[i,...]*255, seg_uncertainty_small_path+img_name[i]+'.png')
+                        save_image(uncertainty_map[i,1,...]*255, seg_uncertainty_small_path+img_name[i]+'_artery.png')
+                        save_image(uncertainty_map[i,2,...]*255, seg_uncertainty_small_path+img_name[i]+'_vein.png')
                     
-                    uncertainty_img = Image.open(seg_uncertainty_small_path+img_name[i]+'.png')
-                    uncertainty_img = uncertainty_img.resize((int(ori_width[i]),int(ori_height[i])))
-                    uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
-                    save_image(uncertainty_tensor, seg_uncertainty_raw_path+img_name[i]+'.png')
+                        uncertainty_img = Image.open(seg_uncertainty_small_path+img_name[i]+'.png')
+                        uncertainty_img = uncertainty_img.resize((int(ori_width[i]),int(ori_height[i])))
+                        uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
+                        save_image(uncertainty_tensor, seg_uncertainty_raw_path+img_name[i]+'.png')
                 
                 
-                    img_r = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
-                    img_g = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
-                    img_b = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_r = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_g = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_b = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
                     
                     
-                    img_r[prediction_decode[i,...]==1]=255
-                    img_b[prediction_decode[i,...]==2]=255
-                    img_g[prediction_decode[i,...]==3]=255
+                        img_r[prediction_decode[i,...]==1]=255
+                        img_b[prediction_decode[i,...]==2]=255
+                        img_g[prediction_decode[i,...]==3]=255
 
-                    img_b = remove_small_objects(img_b>0, 30, connectivity=5)
-                    img_r = remove_small_objects(img_r>0, 30, connectivity=5)
+                        img_b = remove_small_objects(img_b>0, 30, connectivity=5)
+                        img_r = remove_small_objects(img_r>0, 30, connectivity=5)
 
-                    img_ = np.concatenate((img_b[...,np.newaxis], img_g[...,np.newaxis], img_r[...,np.newaxis]), axis=2)
+                        img_ = np.concatenate((img_b[...,np.newaxis], img_g[...,np.newaxis], img_r[...,np.newaxis]), axis=2)
                     
-                    cv2.imwrite(seg_results_small_path+ img_name[i]+ '.png', np.float32(img_)*255)
+                        cv2.imwrite(seg_results_small_path+ img_name[i]+ '.png', np.float32(img_)*255)
+
+                        if pool is not None:
+                            # the same RGB map as resized, without reading it back
+                            resized = np.stack((img_r, img_g > 0, img_b), axis=2).astype(np.uint8)*255
+                            pool.submit(postprocess, f'{AUTOMORPH_DATA}/Results/M2/artery_vein/', img_name[i]+'.png', resized)
+                            submitted.append(img_name[i]+'.png')
                     
-                    img_ww = cv2.resize(np.float32(img_)*255, (int(ori_width[i]),int(ori_height[i])), interpolation = cv2.INTER_NEAREST)
-                    cv2.imwrite(seg_results_raw_path+ img_name[i]+ '.png', img_ww)
+                        img_ww = cv2.resize(np.float32(img_)*255, (int(ori_width[i]),int(ori_height[i])), interpolation = cv2.INTER_NEAREST)
+                        cv2.imwrite(seg_results_raw_path+ img_name[i]+ '.png', img_ww)
                 
                 
                 
                 pbar.update(imgs.shape[0])
 
+    return submitted
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description='Train the UNet on images and target masks', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('--batch-size', type=int, default=6, help='Batch size', dest='batchsize')
     parser.add_argument('--num_workers', type=int, default=8, help='Number of worker processes for the DataLoader', dest='num_workers')
+    parser.add_argument('--postprocess_workers', type=int, default=None, help='Number of processes post-processing the maps during the inference, by default the cores the DataLoader workers leave, 1 runs it in this process', dest='postprocess_workers')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='Run the generators with PyTorch, or with ONNX Runtime on the graphs exported by automorph_onnx.py', dest='backend')
+    parser.add_argument('--onnx_folder', type=str, default=None, help='Folder of the exported graphs, for the onnx backend, by default the onnx folder of the stage', dest='onnx_folder')
+    parser.add_argument('--optimize', action='store_true', help='Fold the BatchNorm layers of the generators and convert them to channels-last, see automorph_optimize.py', dest='optimize')
+    parser.add_argument('--torchscript', action='store_true', help='Freeze the generators with TorchScript, the frozen models are cached, see automorph_optimize.py', dest='torchscript')
     parser.add_argument('--job_name', type=str, default='J', help='type of discriminator', dest='jn')
     parser.add_argument('--dataset', type=str, help='test dataset name', dest='dataset')
     parser.add_argument('--checkstart', type=int, help='test dataset name', dest='CS')
@@ -293,15 +271,10 @@ def get_args():
         dest='result_folder'
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-if __name__ == '__main__':
-
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    args = get_args()
-    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
-    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+def select_device():
     # Check if CUDA is available
     if torch.cuda.is_available():
         logging.info("CUDA is available. Using CUDA...")
@@ -315,33 +288,15 @@ if __name__ == '__main__':
 
     logging.info(f'Using device {device}')
 
-    img_size = Define_image_size(args.uniform, args.dataset)
-    dataset_name = args.dataset
-    checkpoint_saved = dataset_name + '/' +args.jn + '/Discriminator_unet/'
-    csv_save = 'test_csv/' + args.jn
-
-    if not os.path.isdir(csv_save):
-        os.makedirs(csv_save)
-
-    test_dir= f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
-    test_label = "./data/{}/test/1st_manual/".format(dataset_name)
-    test_mask =  "./data/{}/test/mask/".format(dataset_name)
-
-    mode = 'whole'
-
-
-
-    dataset = LearningAVSegData_OOD(test_dir, test_label, test_mask, img_size, dataset_name=dataset_name, train_or=False)
-    test_loader = DataLoader(
-        dataset,
-        batch_size=args.batchsize,
-        shuffle=False,
-        num_workers=args.num_workers,
-        pin_memory=False,
-        drop_last=False,
-    )
+    return device
 
 
+def load_models(job_name, device, torchscript=False, optimize=False):
+    """
+    Builds the eight main, artery and vein generator triplets on the device and loads their
+    checkpoints, so they can be reused over several calls of main. They are optimised for inference
+    with optimize, and frozen with torchscript, see automorph_optimize.
+    """
     net_G_1 = Generator_main(input_channels=3, n_filters = 32, n_classes=4, bilinear=False)
     net_G_A_1 = Generator_branch(input_channels=3, n_filters = 32, n_classes=4, bilinear=False)
     net_G_V_1 = Generator_branch(input_channels=3, n_filters = 32, n_classes=4, bilinear=False)
@@ -375,102 +330,151 @@ if __name__ == '__main__':
     net_G_V_8 = Generator_branch(input_channels=3, n_filters = 32, n_classes=4, bilinear=False)
 
 
-    checkpoint_saved_1="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,28)
-    checkpoint_saved_2="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,30)
-    checkpoint_saved_3="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,32)
-    checkpoint_saved_4="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,34)
-    checkpoint_saved_5="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,36)
-    checkpoint_saved_6="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,38)
-    checkpoint_saved_7="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,40)
-    checkpoint_saved_8="./ALL-AV/{}_{}/Discriminator_unet/".format( args.jn,42)
+    checkpoint_saved_1="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,28)
+    checkpoint_saved_2="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,30)
+    checkpoint_saved_3="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,32)
+    checkpoint_saved_4="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,34)
+    checkpoint_saved_5="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,36)
+    checkpoint_saved_6="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,38)
+    checkpoint_saved_7="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,40)
+    checkpoint_saved_8="./ALL-AV/{}_{}/Discriminator_unet/".format( job_name,42)
+
+    net_G_1.load_state_dict(torch.load(  checkpoint_saved_1 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_1.load_state_dict(torch.load( checkpoint_saved_1 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_1.load_state_dict(torch.load(checkpoint_saved_1 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_1.eval()
+    net_G_A_1.eval()
+    net_G_V_1.eval()
+    net_G_1.to(device=device)
+    net_G_A_1.to(device=device)
+    net_G_V_1.to(device=device)
+
+    net_G_2.load_state_dict(torch.load(  checkpoint_saved_2 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_2.load_state_dict(torch.load( checkpoint_saved_2 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_2.load_state_dict(torch.load(checkpoint_saved_2 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_2.eval()
+    net_G_A_2.eval()
+    net_G_V_2.eval()
+    net_G_2.to(device=device)
+    net_G_A_2.to(device=device)
+    net_G_V_2.to(device=device)
+    
+    net_G_3.load_state_dict(torch.load(  checkpoint_saved_3 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_3.load_state_dict(torch.load( checkpoint_saved_3 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_3.load_state_dict(torch.load(checkpoint_saved_3 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_3.eval()
+    net_G_A_3.eval()
+    net_G_V_3.eval()
+    net_G_3.to(device=device)
+    net_G_A_3.to(device=device)
+    net_G_V_3.to(device=device)
+    
+    net_G_4.load_state_dict(torch.load(  checkpoint_saved_4 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_4.load_state_dict(torch.load( checkpoint_saved_4 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_4.load_state_dict(torch.load(checkpoint_saved_4 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_4.eval()
+    net_G_A_4.eval()
+    net_G_V_4.eval()
+    net_G_4.to(device=device)
+    net_G_A_4.to(device=device)
+    net_G_V_4.to(device=device)
+    
+    net_G_5.load_state_dict(torch.load(  checkpoint_saved_5 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_5.load_state_dict(torch.load( checkpoint_saved_5 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_5.load_state_dict(torch.load(checkpoint_saved_5 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_5.eval()
+    net_G_A_5.eval()
+    net_G_V_5.eval()
+    net_G_5.to(device=device)
+    net_G_A_5.to(device=device)
+    net_G_V_5.to(device=device)
+    
+    net_G_6.load_state_dict(torch.load(  checkpoint_saved_6 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_6.load_state_dict(torch.load( checkpoint_saved_6 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_6.load_state_dict(torch.load(checkpoint_saved_6 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_6.eval()
+    net_G_A_6.eval()
+    net_G_V_6.eval()
+    net_G_6.to(device=device)
+    net_G_A_6.to(device=device)
+    net_G_V_6.to(device=device)
+    
+    net_G_7.load_state_dict(torch.load(  checkpoint_saved_7 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_7.load_state_dict(torch.load( checkpoint_saved_7 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_7.load_state_dict(torch.load(checkpoint_saved_7 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_7.eval()
+    net_G_A_7.eval()
+    net_G_V_7.eval()
+    net_G_7.to(device=device)
+    net_G_A_7.to(device=device)
+    net_G_V_7.to(device=device)
+    
+    net_G_8.load_state_dict(torch.load(  checkpoint_saved_8 + 'CP_best_F1_all.pth',map_location=device))
+    net_G_A_8.load_state_dict(torch.load( checkpoint_saved_8 + 'CP_best_F1_A.pth',map_location=device))
+    net_G_V_8.load_state_dict(torch.load(checkpoint_saved_8 + 'CP_best_F1_V.pth',map_location=device))
+    net_G_8.eval()
+    net_G_A_8.eval()
+    net_G_V_8.eval()
+    net_G_8.to(device=device)
+    net_G_A_8.to(device=device)
+    net_G_V_8.to(device=device)
+
+    checkpoints = [checkpoint_saved + name for checkpoint_saved in (
+        checkpoint_saved_1, checkpoint_saved_2, checkpoint_saved_3, checkpoint_saved_4, checkpoint_saved_5,
+        checkpoint_saved_6, checkpoint_saved_7, checkpoint_saved_8) for name in ('CP_best_F1_all.pth', 'CP_best_F1_A.pth', 'CP_best_F1_V.pth')]
+    return optimize_ensemble('artery_vein', [net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G_3, net_G_A_3, net_G_V_3, net_G_4, net_G_A_4, net_G_V_4, net_G_5, net_G_A_5, net_G_V_5, net_G_6, net_G_A_6, net_G_V_6, net_G_7, net_G_A_7, net_G_V_7, net_G_8, net_G_A_8, net_G_V_8],
+                             checkpoints, torchscript, optimize)
+
+
+def main(argv=None, models=None, images=None):
+    global AUTOMORPH_DATA
 
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    args = get_args(argv)
+    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
+    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+    device = select_device()
 
-    for i in range(1):
-        net_G_1.load_state_dict(torch.load(  checkpoint_saved_1 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_1.load_state_dict(torch.load( checkpoint_saved_1 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_1.load_state_dict(torch.load(checkpoint_saved_1 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_1.eval()
-        net_G_A_1.eval()
-        net_G_V_1.eval()
-        net_G_1.to(device=device)
-        net_G_A_1.to(device=device)
-        net_G_V_1.to(device=device)
-
-        net_G_2.load_state_dict(torch.load(  checkpoint_saved_2 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_2.load_state_dict(torch.load( checkpoint_saved_2 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_2.load_state_dict(torch.load(checkpoint_saved_2 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_2.eval()
-        net_G_A_2.eval()
-        net_G_V_2.eval()
-        net_G_2.to(device=device)
-        net_G_A_2.to(device=device)
-        net_G_V_2.to(device=device)
-        
-        net_G_3.load_state_dict(torch.load(  checkpoint_saved_3 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_3.load_state_dict(torch.load( checkpoint_saved_3 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_3.load_state_dict(torch.load(checkpoint_saved_3 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_3.eval()
-        net_G_A_3.eval()
-        net_G_V_3.eval()
-        net_G_3.to(device=device)
-        net_G_A_3.to(device=device)
-        net_G_V_3.to(device=device)
-        
-        net_G_4.load_state_dict(torch.load(  checkpoint_saved_4 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_4.load_state_dict(torch.load( checkpoint_saved_4 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_4.load_state_dict(torch.load(checkpoint_saved_4 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_4.eval()
-        net_G_A_4.eval()
-        net_G_V_4.eval()
-        net_G_4.to(device=device)
-        net_G_A_4.to(device=device)
-        net_G_V_4.to(device=device)
-        
-        net_G_5.load_state_dict(torch.load(  checkpoint_saved_5 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_5.load_state_dict(torch.load( checkpoint_saved_5 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_5.load_state_dict(torch.load(checkpoint_saved_5 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_5.eval()
-        net_G_A_5.eval()
-        net_G_V_5.eval()
-        net_G_5.to(device=device)
-        net_G_A_5.to(device=device)
-        net_G_V_5.to(device=device)
-        
-        net_G_6.load_state_dict(torch.load(  checkpoint_saved_6 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_6.load_state_dict(torch.load( checkpoint_saved_6 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_6.load_state_dict(torch.load(checkpoint_saved_6 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_6.eval()
-        net_G_A_6.eval()
-        net_G_V_6.eval()
-        net_G_6.to(device=device)
-        net_G_A_6.to(device=device)
-        net_G_V_6.to(device=device)
-        
-        net_G_7.load_state_dict(torch.load(  checkpoint_saved_7 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_7.load_state_dict(torch.load( checkpoint_saved_7 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_7.load_state_dict(torch.load(checkpoint_saved_7 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_7.eval()
-        net_G_A_7.eval()
-        net_G_V_7.eval()
-        net_G_7.to(device=device)
-        net_G_A_7.to(device=device)
-        net_G_V_7.to(device=device)
-        
-        net_G_8.load_state_dict(torch.load(  checkpoint_saved_8 + 'CP_best_F1_all.pth',map_location=device))
-        net_G_A_8.load_state_dict(torch.load( checkpoint_saved_8 + 'CP_best_F1_A.pth',map_location=device))
-        net_G_V_8.load_state_dict(torch.load(checkpoint_saved_8 + 'CP_best_F1_V.pth',map_location=device))
-        net_G_8.eval()
-        net_G_A_8.eval()
-        net_G_V_8.eval()
-        net_G_8.to(device=device)
-        net_G_A_8.to(device=device)
-        net_G_V_8.to(device=device)
-        
-        if mode != 'vessel':
-            test_net(net_G_1, net_G_A_1, net_G_V_1, net_G_2, net_G_A_2, net_G_V_2, net_G_3, net_G_A_3, net_G_V_3, net_G_4, net_G_A_4, net_G_V_4, net_G_5, net_G_A_5, net_G_V_5, net_G_6, net_G_A_6, net_G_V_6, net_G_7, net_G_A_7, net_G_V_7, net_G_8, net_G_A_8, net_G_V_8, loader=test_loader, device=device, mode=mode,dataset=dataset_name)
+    img_size = Define_image_size(args.uniform, args.dataset)
+    dataset_name = args.dataset
+    checkpoint_saved = dataset_name + '/' +args.jn + '/Discriminator_unet/'
+    csv_save = 'test_csv/' + args.jn
+
+    if not os.path.isdir(csv_save):
+        os.makedirs(csv_save)
+
+    test_dir= f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
+    test_label = "./data/{}/test/1st_manual/".format(dataset_name)
+    test_mask =  "./data/{}/test/mask/".format(dataset_name)
+
+    mode = 'whole'
 
 
-        FD_list_r,name_list,VD_list_r,FD_list_v,VD_list_b,width_cal_r,width_cal_b = filter_frag(data_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/')
+
+    dataset = LearningAVSegData_OOD(test_dir, test_label, test_mask, img_size, dataset_name=dataset_name, train_or=False, images=images)
+    test_loader = DataLoader(
+        dataset,
+        batch_size=args.batchsize,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=False,
+        drop_last=False,
+    )
+
+    if models is None and args.backend != 'torch':
+        models = load_ensemble(args.onnx_folder or ONNX_FOLDER, 'artery_vein')
+    elif models is None:
+        models = load_models(args.jn, device, args.torchscript, args.optimize)
+
+    for i in range(1):
+        # the maps of a batch are post-processed while the next batches are segmented
+        with TaskPool(args.postprocess_workers, initializer=_init_worker, reserved=args.num_workers) as pool:
+            if mode != 'vessel':
+                submitted = test_net(*models, loader=test_loader, device=device, mode=mode,dataset=dataset_name, pool=pool)
+                with span('M2.artery_vein.postprocess', images=len(submitted)):
+                    FD_list_r,name_list,VD_list_r,FD_list_v,VD_list_b,width_cal_r,width_cal_b = collect(submitted, pool.results())
+            else:
+                FD_list_r,name_list,VD_list_r,FD_list_v,VD_list_b,width_cal_r,width_cal_b = filter_frag(data_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/', pool=pool)
         
         
         #Data4stage2 = pd.DataFrame({'Image_id':name_list, 'FD_boxC_artery':FD_list_r, 'Vessel_Density_artery':VD_list_r})
@@ -479,3 +483,6 @@ if __name__ == '__main__':
         #Data4stage2 = pd.DataFrame({'Image_id':name_list, 'FD_boxC_vein':FD_list_v, 'Vessel_Density_vein':VD_list_b})
         #Data4stage2.to_csv('../Results/M3/Vein_Features_Measurement.csv', index = None, encoding='utf8')
 
+
+if __name__ == '__main__':
+    main()
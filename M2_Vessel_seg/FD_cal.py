@@ -1,41 +1,9 @@
-import scipy.misc
+import sys
+from pathlib import Path
 import numpy as np
 
-
-def fractal_dimension(Z):
-
-    # Only for 2d image
-    assert(len(Z.shape) == 2)
-
-    def boxcount(Z, k):
-        S = np.add.reduceat(
-            np.add.reduceat(Z, np.arange(0, Z.shape[0], k), axis=0),
-                               np.arange(0, Z.shape[1], k), axis=1)
-
-        # We count non-empty (0) and non-full boxes (k*k)
-        return len(np.where((S > 0) & (S < k*k))[0])
-
-
-    # Minimal dimension of image
-    p = min(Z.shape)
-
-    # Greatest power of 2 less than or equal to p
-    n = 2**np.floor(np.log(p)/np.log(2))
-
-    # Extract the exponent
-    n = int(np.log(n)/np.log(2))
-
-    # Build successive box sizes (from 2**n down to 2**1)
-    sizes = 2**np.arange(n, 1, -1)
-
-    # Actual box counting with decreasing size
-    counts = []
-    for size in sizes:
-        counts.append(boxcount(Z, size))
-
-    # Fit the successive log(sizes) with log (counts)
-    coeffs = np.polyfit(np.log(sizes), np.log(counts), 1)
-    return -coeffs[0]
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from automorph_fractal import fractal_dimension, fractal_dimensions
 
 
 
@@ -48,4 +16,3 @@ def vessel_density(Z):
     pixel_total_count = Z.shape[0]*Z.shape[1]
     
     return vessel_total_count/pixel_total_count
-
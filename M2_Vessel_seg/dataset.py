@@ -185,7 +185,7 @@ class SEDataset(Dataset):
     
     
 class SEDataset_out(Dataset):
-    def __init__(self, imgs_dir, label_dir, mask_dir, img_size, dataset_name, pthrehold, uniform, train_or=True):
+    def __init__(self, imgs_dir, label_dir, mask_dir, img_size, dataset_name, pthrehold, uniform, train_or=True, images=None):
         self.imgs_dir = imgs_dir
         self.label_dir = label_dir
         self.mask_dir = mask_dir
@@ -194,11 +194,16 @@ class SEDataset_out(Dataset):
         self.pthrehold = pthrehold
         self.uniform = uniform
         self.train_or = train_or
+        # optional ImageStore holding the gradable images, used instead of the PNGs in imgs_dir
+        self.images = images
 
         
         i = 0
-        self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
-                    if not file.startswith('.')]
+        if images is not None:
+            self.ids = images.names()
+        else:
+            self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
+                        if not file.startswith('.')]
         #logging.info(f'Creating dataset with {(self.ids)} ')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
@@ -257,14 +262,18 @@ class SEDataset_out(Dataset):
 
     def __getitem__(self, i):
         idx = self.ids[i]
-        img_file = glob(self.imgs_dir + idx + '.*')
+        if self.images is not None:
+            ori_width, ori_height = self.images.open(idx).size
+            img = self.images.resized(idx, self.img_size)
+        else:
+            img_file = glob(self.imgs_dir + idx + '.*')
 
-        assert len(img_file) == 1, \
-            f'Either no image or multiple images found for the ID {idx}: {img_file}'
+            assert len(img_file) == 1, \
+                f'Either no image or multiple images found for the ID {idx}: {img_file}'
 
-        img = Image.open(img_file[0])
-        ori_width, ori_height = img.size
-        img = img.resize(self.img_size)
+            img = Image.open(img_file[0])
+            ori_width, ori_height = img.size
+            img = img.resize(self.img_size)
         img = self.preprocess(img, self.dataset_name, self.img_size, self.train_or, self.pthrehold)
 
         i += 1
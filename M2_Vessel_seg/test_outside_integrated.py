@@ -2,6 +2,7 @@
 import argparse
 import logging
 import os
+import cv2
 import torch
 import numpy as np
 from tqdm import tqdm
@@ -21,49 +22,85 @@ import sys
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from automorph_paths import prepare_automorph_data
+from automorph_ensemble import FusedEnsemble
+from automorph_onnx import BACKENDS, ONNX_FOLDER, load_ensemble
+from automorph_optimize import optimize_ensemble
+from automorph_timing import span
+from automorph_workers import TaskPool
 
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
 
 AUTOMORPH_DATA = DEFAULT_AUTOMORPH_DATA
 
-def filter_frag(data_path):
+def _init_worker():
+    # the images are already spread over the processes, one OpenCV thread each avoids oversubscription
+    cv2.setNumThreads(1)
+
+
+def postprocess(data_path, name, vessel):
+    """
+    Removes the small fragments of a binary vessel map, writes it and its skeleton, and measures it.
+
+    :param data_path: the M2/binary_vessel folder
+    :param name: the PNG file name of the image
+    :param vessel: the boolean vessel map at the size of the model
+    :return: the fractal dimension, the vessel density and the width of the vessels
+    """
+    img2 = remove_small_objects(vessel, 30, connectivity=5)
+    
+    if not os.path.isdir(data_path + 'binary_process/'):
+        os.makedirs(data_path + 'binary_process/', exist_ok=True)
+    io.imsave(data_path + 'binary_process/' + name , 255*(img2.astype('uint8')),check_contrast=False)
+
+    with span('M2.vessel.skeletonize', images=1, image=name):
+        skeleton = skeletonize(img2)
+    
+    if not os.path.isdir(data_path + 'binary_skeleton/'):
+        os.makedirs(data_path + 'binary_skeleton/', exist_ok=True)
+    io.imsave(data_path + 'binary_skeleton/' + name, 255*(skeleton.astype('uint8')),check_contrast=False)
+    
+    FD_boxcounting = fractal_dimension(img2)
+    VD = vessel_density(img2)
+    width = np.sum(img2)/np.sum(skeleton)
+    return FD_boxcounting, VD, width
+
+
+def filter_frag(data_path, pool=None):
+    """
+    Post-processes the binary maps written in resize_binary, see postprocess.
+
+    :param pool: optional TaskPool the images are spread over
+    """
     if os.path.isdir(data_path + 'resize_binary/.ipynb_checkpoints'):
         shutil.rmtree(data_path + 'resize_binary/.ipynb_checkpoints')
 
     image_list=os.listdir(data_path + 'resize_binary')
-    FD_cal=[]
-    name_list=[]
-    VD_cal=[]
-    width_cal=[]
+    pool = pool or TaskPool(1)
+    name_list=sorted(image_list)
 
-    for i in sorted(image_list):
+    for i in name_list:
         img=io.imread(data_path + 'resize_binary/' + i, as_gray=True).astype(np.int64)
-        img2=img>0
-        img2 = remove_small_objects(img2, 30, connectivity=5)
-        
-        if not os.path.isdir(data_path + 'binary_process/'):
-            os.makedirs(data_path + 'binary_process/') 
-        io.imsave(data_path + 'binary_process/' + i , 255*(img2.astype('uint8')),check_contrast=False)
-
-        skeleton = skeletonize(img2)
-        
-        if not os.path.isdir(data_path + 'binary_skeleton/'):
-            os.makedirs(data_path + 'binary_skeleton/') 
-        io.imsave(data_path + 'binary_skeleton/' + i, 255*(skeleton.astype('uint8')),check_contrast=False)
-        
-        FD_boxcounting = fractal_dimension(img2)
-        VD = vessel_density(img2)
-        width = np.sum(img2)/np.sum(skeleton)
-        FD_cal.append(FD_boxcounting)
-        name_list.append(i)
-        VD_cal.append(VD)
-        width_cal.append(width)
+        pool.submit(postprocess, data_path, i, img>0)
     
-    return FD_cal,name_list,VD_cal,width_cal
+    return collect(name_list, pool.results())
+
 
+def collect(name_list, results):
+    """The fractal dimensions, names, vessel densities and widths of the images, sorted by name."""
+    rows = sorted(zip(name_list, results), key=lambda row: row[0])
+    FD_cal = [result[0] for _, result in rows]
+    VD_cal = [result[1] for _, result in rows]
+    width_cal = [result[2] for _, result in rows]
+    return FD_cal,[name for name, _ in rows],VD_cal,width_cal
 
-def segment_fundus(data_path, net_1, net_2, net_3, net_4, net_5, net_6, net_7, net_8, net_9, net_10, loader, device, dataset_name, job_name, mask_or, train_or):
+
+def segment_fundus(data_path, ensemble, loader, device, dataset_name, job_name, mask_or, train_or, pool=None):
+    """
+    Segments the vessels of the images of the loader and writes the maps. When a pool is given,
+    the binary maps are post-processed in it, straight from memory, while the next batches are
+    segmented, and the names of the images submitted are returned.
+    """
 
     n_val = len(loader) 
     tot = 0
@@ -101,6 +138,7 @@ def segment_fundus(data_path, net_1, net_2, net_3, net_4, net_5, net_6, net_7, n
     if not os.path.isdir(seg_uncertainty_raw_path):
         os.makedirs(seg_uncertainty_raw_path)
         
+    submitted = []
         
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in loader:
@@ -112,32 +150,10 @@ def segment_fundus(data_path, net_1, net_2, net_3, net_4, net_5, net_6, net_7, n
             
             imgs = imgs.to(device=device, dtype=torch.float32)
 
-            with torch.no_grad():
-                mask_pred_1 = net_1(imgs)
-                mask_pred_2 = net_2(imgs)
-                mask_pred_3 = net_3(imgs)
-                mask_pred_4 = net_4(imgs)
-                mask_pred_5 = net_5(imgs)
-                mask_pred_6 = net_6(imgs)
-                mask_pred_7 = net_7(imgs)
-                mask_pred_8 = net_8(imgs)
-                mask_pred_9 = net_9(imgs)
-                mask_pred_10 = net_10(imgs)
-                
-            mask_pred_sigmoid_1 = torch.sigmoid(mask_pred_1)
-            mask_pred_sigmoid_2 = torch.sigmoid(mask_pred_2)
-            mask_pred_sigmoid_3 = torch.sigmoid(mask_pred_3)
-            mask_pred_sigmoid_4 = torch.sigmoid(mask_pred_4)
-            mask_pred_sigmoid_5 = torch.sigmoid(mask_pred_5)
-            mask_pred_sigmoid_6 = torch.sigmoid(mask_pred_6)
-            mask_pred_sigmoid_7 = torch.sigmoid(mask_pred_7)
-            mask_pred_sigmoid_8 = torch.sigmoid(mask_pred_8)
-            mask_pred_sigmoid_9 = torch.sigmoid(mask_pred_9)
-            mask_pred_sigmoid_10 = torch.sigmoid(mask_pred_10)
-            
-            mask_pred_sigmoid=(mask_pred_sigmoid_1+mask_pred_sigmoid_2+mask_pred_sigmoid_3+mask_pred_sigmoid_4+mask_pred_sigmoid_5+mask_pred_sigmoid_6+mask_pred_sigmoid_7+mask_pred_sigmoid_8+mask_pred_sigmoid_9+mask_pred_sigmoid_10)/10
-            
-            uncertainty_map = torch.sqrt((torch.square(mask_pred_sigmoid-mask_pred_sigmoid_1)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_2)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_3)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_4)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_5)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_6)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_7)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_8)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_9)+torch.square(mask_pred_sigmoid-mask_pred_sigmoid_10))/10)
+            # one pass of the fused ensemble gives the mean and the spread of the ten sigmoid maps,
+            # the forward of the members and their reduction are interleaved so they are timed together
+            with torch.no_grad(), span('M2.vessel.forward', images=imgs.shape[0], device=device):
+                mask_pred_sigmoid, uncertainty_map = ensemble.mean_std(imgs, activation=torch.sigmoid)
             
             
             n_image = mask_pred_sigmoid.shape[0]
@@ -148,48 +164,44 @@ def segment_fundus(data_path, net_1, net_2, net_3, net_4, net_5, net_6, net_7, n
                 n_ori_width = ori_width[i]
                 n_ori_height = ori_height[i]
 
-                save_image(torch.unsqueeze(uncertainty_map[i,...], 0), seg_uncertainty_small_path+n_img_name+'.png')
-                uncertainty_img = Image.open(seg_uncertainty_small_path+n_img_name+'.png').resize((n_ori_width,n_ori_height)).convert('L') 
-                uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
-                save_image(uncertainty_tensor, seg_uncertainty_raw_path+n_img_name+'.png')
+                with span('M2.vessel.write', images=1, image=n_img_name):
+                    save_image(torch.unsqueeze(uncertainty_map[i,...], 0), seg_uncertainty_small_path+n_img_name+'.png')
+                    uncertainty_img = Image.open(seg_uncertainty_small_path+n_img_name+'.png').resize((n_ori_width,n_ori_height)).convert('L') 
+                    uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
+                    save_image(uncertainty_tensor, seg_uncertainty_raw_path+n_img_name+'.png')
+
+                    save_image(torch.unsqueeze(mask_pred_sigmoid[i,...], 0), seg_results_small_path+n_img_name+'.png')
+                    mask_pred_resize_bin=torch.zeros(torch.unsqueeze(mask_pred_sigmoid[i,...], 0).shape)
+                    mask_pred_resize_bin[torch.unsqueeze(mask_pred_sigmoid[i,...], 0)>=0.5]=1
+                    save_image(mask_pred_resize_bin, seg_results_small_binary_path+n_img_name+'.png')
 
-                save_image(torch.unsqueeze(mask_pred_sigmoid[i,...], 0), seg_results_small_path+n_img_name+'.png')
-                mask_pred_resize_bin=torch.zeros(torch.unsqueeze(mask_pred_sigmoid[i,...], 0).shape)
-                mask_pred_resize_bin[torch.unsqueeze(mask_pred_sigmoid[i,...], 0)>=0.5]=1
-                save_image(mask_pred_resize_bin, seg_results_small_binary_path+n_img_name+'.png')
+                    if pool is not None:
+                        # the same map as resize_binary, without reading it back
+                        pool.submit(postprocess, data_path, n_img_name+'.png', mask_pred_resize_bin[0,0].numpy() > 0)
+                        submitted.append(n_img_name+'.png')
 
-                mask_pred_img = Image.open(seg_results_small_path+n_img_name+'.png').resize((n_ori_width,n_ori_height)).convert('L') 
-                mask_pred_tensor = torchvision.transforms.ToTensor()(mask_pred_img)
+                    mask_pred_img = Image.open(seg_results_small_path+n_img_name+'.png').resize((n_ori_width,n_ori_height)).convert('L') 
+                    mask_pred_tensor = torchvision.transforms.ToTensor()(mask_pred_img)
 
-                mask_pred_numpy_bin=torch.zeros(mask_pred_tensor.shape)
-                mask_pred_numpy_bin[mask_pred_tensor>=0.5]=1
+                    mask_pred_numpy_bin=torch.zeros(mask_pred_tensor.shape)
+                    mask_pred_numpy_bin[mask_pred_tensor>=0.5]=1
 
-                save_image(mask_pred_tensor, seg_results_raw_path+n_img_name+'.png')
-                save_image(mask_pred_numpy_bin, seg_results_raw_binary_path+n_img_name+'.png')
+                    save_image(mask_pred_tensor, seg_results_raw_path+n_img_name+'.png')
+                    save_image(mask_pred_numpy_bin, seg_results_raw_binary_path+n_img_name+'.png')
 
             pbar.update(imgs.shape[0])
 
+    return submitted
 
-def test_net(data_path, batch_size, num_workers, device, dataset_train, dataset_test, image_size, job_name, threshold, checkpoint_mode, mask_or=True, train_or=False):
 
-    #test_dir = "./data/{}/test/images/".format(dataset_test)
-    test_dir = f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
-    mask_dir = "./data/{}/test/mask/".format(dataset_test)
-    test_label = "./data/{}/test/1st_manual/".format(dataset_test)
-    FD_list = []
-    Name_list = []
-    VD_list = []
-    
-    dataset_data = SEDataset_out(test_dir, test_label, mask_dir, image_size, dataset_test, threshold, uniform='True', train_or=False)
-    test_loader = DataLoader(
-        dataset_data,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=False,
-        drop_last=False,
-    )
-    
+def load_models(dataset_train, job_name, device, ensemble_chunk=1, optimize=False):
+    """
+    Builds the ten vessel segmenters on the device and loads their checkpoints, so they can be
+    reused over several calls of test_net. They are optimised for inference with optimize, see automorph_optimize,
+    and returned stacked in a FusedEnsemble, which runs ensemble_chunk of them per forward pass.
+    One keeps the activation memory of the former loop over the segmenters, None runs all of them
+    at once.
+    """
     dir_checkpoint_1="./Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(dataset_train,job_name,24)
     dir_checkpoint_2="./Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(dataset_train,job_name,26)
     dir_checkpoint_3="./Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(dataset_train,job_name,28)
@@ -244,10 +256,43 @@ def test_net(data_path, batch_size, num_workers, device, dataset_train, dataset_
     net_10.load_state_dict(torch.load(dir_checkpoint_10 + 'G_best_F1_epoch.pth',map_location=device))
     net_10.eval()
     net_10.to(device=device)
-        
-    segment_fundus(data_path, net_1, net_2, net_3, net_4, net_5, net_6, net_7, net_8, net_9, net_10, test_loader, device, dataset_train, job_name, mask_or, train_or)
+
+    checkpoints = [dir_checkpoint + 'G_best_F1_epoch.pth' for dir_checkpoint in (
+        dir_checkpoint_1, dir_checkpoint_2, dir_checkpoint_3, dir_checkpoint_4, dir_checkpoint_5,
+        dir_checkpoint_6, dir_checkpoint_7, dir_checkpoint_8, dir_checkpoint_9, dir_checkpoint_10)]
+    return FusedEnsemble(optimize_ensemble('vessel', [net_1, net_2, net_3, net_4, net_5, net_6, net_7, net_8, net_9, net_10], checkpoints, optimize=optimize),
+                         chunk_size=ensemble_chunk)
+
+
+def test_net(data_path, batch_size, num_workers, device, dataset_train, dataset_test, image_size, job_name, threshold, checkpoint_mode, mask_or=True, train_or=False, models=None, images=None, postprocess_workers=None, ensemble_chunk=1, optimize=False):
+
+    #test_dir = "./data/{}/test/images/".format(dataset_test)
+    test_dir = f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
+    mask_dir = "./data/{}/test/mask/".format(dataset_test)
+    test_label = "./data/{}/test/1st_manual/".format(dataset_test)
+    FD_list = []
+    Name_list = []
+    VD_list = []
     
-    FD_list, Name_list, VD_list, width_cal = filter_frag(data_path)
+    dataset_data = SEDataset_out(test_dir, test_label, mask_dir, image_size, dataset_test, threshold, uniform='True', train_or=False, images=images)
+    test_loader = DataLoader(
+        dataset_data,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=False,
+        drop_last=False,
+    )
+    
+    if models is None:
+        models = load_models(dataset_train, job_name, device, ensemble_chunk, optimize)
+
+    # the maps of a batch are post-processed while the next batches are segmented
+    with TaskPool(postprocess_workers, initializer=_init_worker, reserved=num_workers) as pool:
+        submitted = segment_fundus(data_path, models, test_loader, device, dataset_train, job_name, mask_or, train_or, pool=pool)
+        with span('M2.vessel.postprocess', images=len(submitted)):
+            results = pool.results()
+    FD_list, Name_list, VD_list, width_cal = collect(submitted, results)
     
     if not os.path.exists(f'{AUTOMORPH_DATA}/Results/M3/'):
         os.makedirs(f'{AUTOMORPH_DATA}/Results/M3/')
@@ -257,7 +302,7 @@ def test_net(data_path, batch_size, num_workers, device, dataset_train, dataset_
         
         
 
-def get_args():
+def get_args(argv=None):
     
     parser = argparse.ArgumentParser(description='Utilize the symmetric equilibrium segmentation net',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -271,6 +316,11 @@ def get_args():
     parser.add_argument('--jn', type=str, default='unet', help='type of discriminator', dest='jn')
     parser.add_argument('--num_workers', type=int, help='Number of worker processes for the DataLoader', dest='num_workers')
     parser.add_argument('--worker_num', type=int, help='Number of worker processes for the DataLoader (deprecated alias)', dest='num_workers')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='Run the segmenters with PyTorch, or with ONNX Runtime on the graphs exported by automorph_onnx.py', dest='backend')
+    parser.add_argument('--onnx_folder', type=str, default=None, help='Folder of the exported graphs, for the onnx backend, by default the onnx folder of the stage', dest='onnx_folder')
+    parser.add_argument('--postprocess_workers', type=int, default=None, help='Number of processes post-processing the binary maps during the inference, by default the cores the DataLoader workers leave, 1 runs it in this process', dest='postprocess_workers')
+    parser.add_argument('--ensemble_chunk', type=int, default=1, help='Number of segmenters evaluated at once, each one takes the activation memory of a single model', dest='ensemble_chunk')
+    parser.add_argument('--optimize', action='store_true', help='Fold the BatchNorm layers of the segmenters, see automorph_optimize.py', dest='optimize')
     parser.add_argument('--save_model', type=str, default='regular', help='type of discriminator', dest='save')
     parser.add_argument('--train_test_mode', type=str, default='trainandtest', help='train and test, or directly test', dest='ttmode') 
     parser.add_argument('--pre_threshold', type=float, default=0.0, help='threshold in standalisation', dest='pthreshold')   
@@ -304,18 +354,13 @@ def get_args():
     parser.add_argument('--beta', type=float, default=1.1, help='Loss weight of segmentation cross entropy', dest='beta')
     parser.add_argument('--gamma', type=float, default=0.5, help='Loss weight of segmentation mean square error', dest='gamma')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.num_workers is None:
         args.num_workers = 8
     return args
 
 
-if __name__ == '__main__':
-
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    args = get_args()
-    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
-    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+def select_device():
     # Check if CUDA is available
     if torch.cuda.is_available():
         logging.info("CUDA is available. Using CUDA...")
@@ -329,9 +374,23 @@ if __name__ == '__main__':
 
     logging.info(f'Using device {device}')
 
+    return device
+
+
+def main(argv=None, models=None, images=None):
+    global AUTOMORPH_DATA
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    args = get_args(argv)
+    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
+    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+    device = select_device()
 
     image_size = Define_image_size(args.uniform, args.dataset)
     lr = args.lr
+
+    if models is None and args.backend != 'torch':
+        models = load_ensemble(args.onnx_folder or ONNX_FOLDER, 'vessel')
     
     test_net(data_path=args.data_path,
              batch_size=args.batchsize,
@@ -344,5 +403,14 @@ if __name__ == '__main__':
              threshold=args.pthreshold,
              checkpoint_mode=args.save,
              mask_or=True, 
-             train_or=False)
+             train_or=False,
+             models=models,
+             images=images,
+             postprocess_workers=args.postprocess_workers,
+             ensemble_chunk=args.ensemble_chunk,
+             optimize=args.optimize)
+
+
+if __name__ == '__main__':
+    main()
  
\ No newline at end of file
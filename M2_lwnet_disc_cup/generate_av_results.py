@@ -21,6 +21,12 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from automorph_paths import prepare_automorph_data
+from automorph_ensemble import RunningMoments
+from automorph_onnx import BACKENDS, ONNX_FOLDER, load_ensemble
+from automorph_optimize import input_memory_format, optimize_ensemble
+from automorph_metadata import crop_info
+from automorph_timing import Stopwatch, span
+from automorph_zones import NO_DISC, write_zone_info
 
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
 
@@ -39,184 +45,38 @@ parser.add_argument('--device', type=str, default='cuda:0', help='where to run t
 parser.add_argument('--results_path', type=str, default='results', help='path to save predictions (defaults to results')
 parser.add_argument('--batch_size', type=int, default=16, help='Batch size for inference dataloaders')
 parser.add_argument('--num_workers', type=int, default=8, help='Number of worker processes for inference dataloaders')
+parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS,
+                    help='Run the W-Nets with PyTorch, or with ONNX Runtime on the graphs exported by automorph_onnx.py')
+parser.add_argument('--onnx_folder', type=str, default=None,
+                    help='Folder of the exported graphs, for the onnx backend, by default the onnx folder of the stage')
+parser.add_argument('--optimize', action='store_true',
+                    help='Fold the BatchNorm layers of the W-Nets and convert them to channels-last, see automorph_optimize.py')
+parser.add_argument('--torchscript', action='store_true',
+                    help='Freeze the W-Nets with TorchScript, the frozen models are cached, see automorph_optimize.py')
 parser.add_argument('--image_folder', type=str, default=str(Path(DEFAULT_AUTOMORPH_DATA) / 'images'),
                     help='Path to the folder containing input images')
 parser.add_argument('--result_folder', type=str, default=str(Path(DEFAULT_AUTOMORPH_DATA) / 'Results'),
                     help='Path to the AutoMorph results folder')
 
 
-def intersection(mask,vessel_, it_x, it_y):
+def optic_disc_centre(result_path):
     """
-    Remove the intersection in case the whole vessel is too long
-    """
-    x_less = max(0, it_x - 1)
-    y_less = max(0, it_y - 1)
-    x_more = min(vessel_.shape[0] - 1, it_x + 1)
-    y_more = min(vessel_.shape[1] - 1, it_y + 1)
-
-    active_neighbours = (vessel_[x_less, y_less]>0).astype('float')+ \
-                        (vessel_[x_less, it_y]>0).astype('float')+ \
-                        (vessel_[x_less, y_more]>0).astype('float')+ \
-                        (vessel_[it_x, y_less]>0).astype('float')+ \
-                        (vessel_[it_x, y_more]>0).astype('float')+ \
-                        (vessel_[x_more, y_less]>0).astype('float')+ \
-                        (vessel_[x_more, it_y]>0).astype('float')+ \
-                        (vessel_[x_more, y_more]>0).astype('float')
-
-    if active_neighbours > 2:
-        cv2.circle(mask,(it_y,it_x),radius=1,color=(0,0,0),thickness=-1)
-    
-
-    return mask,active_neighbours   
-    
-    
+    Measures the optic disc and cup of every image, sorts the images into disc and macular centred
+    ones and records the disc centre and radius the zones B and C are drawn from in
+    M2/optic_disc_cup/zone_info.csv, see automorph_zones.
 
-def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
+    :param result_path: the folder of the disc/cup maps
+    """
     if os.path.exists(result_path+'.ipynb_checkpoints'):
         shutil.rmtree(result_path+'.ipynb_checkpoints')
         
     optic_binary_result_path = f'{AUTOMORPH_DATA}/Results/M3/Disc_centred/'
     macular_binary_result_path = f'{AUTOMORPH_DATA}/Results/M3/Macular_centred/'
     
-    #2023/08/24
-    disc_process_binary_vessel_path = binary_vessel_path + 'disc_centred_binary_process/'
-    disc_process_artery_path = artery_vein_path + 'disc_centred_artery_process/'
-    disc_process_vein_path = artery_vein_path + 'disc_centred_vein_process/'
-    
-    disc_skeleton_binary_vessel_path = binary_vessel_path + 'disc_centred_binary_skeleton/'
-    disc_skeleton_artery_path = artery_vein_path + 'disc_centred_artery_skeleton/'
-    disc_skeleton_vein_path = artery_vein_path + 'disc_centred_vein_skeleton/'
-    
-    
-    B_optic_process_binary_vessel_path = binary_vessel_path + 'Zone_B_disc_centred_binary_process/'
-    B_optic_process_artery_path = artery_vein_path + 'Zone_B_disc_centred_artery_process/'
-    B_optic_process_vein_path = artery_vein_path + 'Zone_B_disc_centred_vein_process/'
-    
-    B_optic_skeleton_binary_vessel_path = binary_vessel_path + 'Zone_B_disc_centred_binary_skeleton/'
-    B_optic_skeleton_artery_path = artery_vein_path + 'Zone_B_disc_centred_artery_skeleton/'
-    B_optic_skeleton_vein_path = artery_vein_path + 'Zone_B_disc_centred_vein_skeleton/'
-
-    C_optic_process_binary_vessel_path = binary_vessel_path + 'Zone_C_disc_centred_binary_process/'
-    C_optic_process_artery_path = artery_vein_path + 'Zone_C_disc_centred_artery_process/'
-    C_optic_process_vein_path = artery_vein_path + 'Zone_C_disc_centred_vein_process/'
-    
-    C_optic_skeleton_binary_vessel_path = binary_vessel_path + 'Zone_C_disc_centred_binary_skeleton/'
-    C_optic_skeleton_artery_path = artery_vein_path + 'Zone_C_disc_centred_artery_skeleton/'
-    C_optic_skeleton_vein_path = artery_vein_path + 'Zone_C_disc_centred_vein_skeleton/'
-    
-    
-    macular_process_binary_vessel_path = binary_vessel_path + 'macular_centred_binary_process/'
-    macular_process_artery_path = artery_vein_path + 'macular_centred_artery_process/'
-    macular_process_vein_path = artery_vein_path + 'macular_centred_vein_process/'
-    
-    macular_skeleton_binary_vessel_path = binary_vessel_path + 'macular_centred_binary_skeleton/'
-    macular_skeleton_artery_path = artery_vein_path + 'macular_centred_artery_skeleton/'
-    macular_skeleton_vein_path = artery_vein_path + 'macular_centred_vein_skeleton/'
-    
-    #2021/11/2
-    zone_b_macular_process_binary_vessel_path = binary_vessel_path + 'macular_Zone_B_centred_binary_process/'
-    zone_b_macular_process_artery_path = artery_vein_path + 'macular_Zone_B_centred_artery_process/'
-    zone_b_macular_process_vein_path = artery_vein_path + 'macular_Zone_B_centred_vein_process/'
-    
-    zone_b_macular_skeleton_binary_vessel_path = binary_vessel_path + 'macular_Zone_B_centred_binary_skeleton/'
-    zone_b_macular_skeleton_artery_path = artery_vein_path + 'macular_Zone_B_centred_artery_skeleton/'
-    zone_b_macular_skeleton_vein_path = artery_vein_path + 'macular_Zone_B_centred_vein_skeleton/'
-    #2021/11/2
-    zone_c_macular_process_binary_vessel_path = binary_vessel_path + 'macular_Zone_C_centred_binary_process/'
-    zone_c_macular_process_artery_path = artery_vein_path + 'macular_Zone_C_centred_artery_process/'
-    zone_c_macular_process_vein_path = artery_vein_path + 'macular_Zone_C_centred_vein_process/'
-    
-    zone_c_macular_skeleton_binary_vessel_path = binary_vessel_path + 'macular_Zone_C_centred_binary_skeleton/'
-    zone_c_macular_skeleton_artery_path = artery_vein_path + 'macular_Zone_C_centred_artery_skeleton/'
-    zone_c_macular_skeleton_vein_path = artery_vein_path + 'macular_Zone_C_centred_vein_skeleton/'
-    
     if not os.path.exists(optic_binary_result_path):
         os.makedirs(optic_binary_result_path)
     if not os.path.exists(macular_binary_result_path):
         os.makedirs(macular_binary_result_path)
-    
-    
-    #2023/08/24
-    if not os.path.exists(disc_process_binary_vessel_path):
-        os.makedirs(disc_process_binary_vessel_path)
-    if not os.path.exists(disc_process_artery_path):
-        os.makedirs(disc_process_artery_path)
-    if not os.path.exists(disc_process_vein_path):
-        os.makedirs(disc_process_vein_path)
-    if not os.path.exists(disc_skeleton_binary_vessel_path):
-        os.makedirs(disc_skeleton_binary_vessel_path)
-    if not os.path.exists(disc_skeleton_artery_path):
-        os.makedirs(disc_skeleton_artery_path)
-    if not os.path.exists(disc_skeleton_vein_path):
-        os.makedirs(disc_skeleton_vein_path)
-        
-        
-    if not os.path.exists(B_optic_process_binary_vessel_path):
-        os.makedirs(B_optic_process_binary_vessel_path)
-    if not os.path.exists(B_optic_process_artery_path):
-        os.makedirs(B_optic_process_artery_path)
-    if not os.path.exists(B_optic_process_vein_path):
-        os.makedirs(B_optic_process_vein_path)
-    if not os.path.exists(B_optic_skeleton_binary_vessel_path):
-        os.makedirs(B_optic_skeleton_binary_vessel_path)
-    if not os.path.exists(B_optic_skeleton_artery_path):
-        os.makedirs(B_optic_skeleton_artery_path)
-    if not os.path.exists(B_optic_skeleton_vein_path):
-        os.makedirs(B_optic_skeleton_vein_path)
-
-    if not os.path.exists(C_optic_process_binary_vessel_path):
-        os.makedirs(C_optic_process_binary_vessel_path)
-    if not os.path.exists(C_optic_process_artery_path):
-        os.makedirs(C_optic_process_artery_path)
-    if not os.path.exists(C_optic_process_vein_path):
-        os.makedirs(C_optic_process_vein_path)
-    if not os.path.exists(C_optic_skeleton_binary_vessel_path):
-        os.makedirs(C_optic_skeleton_binary_vessel_path)
-    if not os.path.exists(C_optic_skeleton_artery_path):
-        os.makedirs(C_optic_skeleton_artery_path)
-    if not os.path.exists(C_optic_skeleton_vein_path):
-        os.makedirs(C_optic_skeleton_vein_path)
-        
-        
-    if not os.path.exists(macular_process_binary_vessel_path):
-        os.makedirs(macular_process_binary_vessel_path)
-    if not os.path.exists(macular_process_artery_path):
-        os.makedirs(macular_process_artery_path)
-    if not os.path.exists(macular_process_vein_path):
-        os.makedirs(macular_process_vein_path)
-    if not os.path.exists(macular_skeleton_binary_vessel_path):
-        os.makedirs(macular_skeleton_binary_vessel_path)
-    if not os.path.exists(macular_skeleton_artery_path):
-        os.makedirs(macular_skeleton_artery_path)
-    if not os.path.exists(macular_skeleton_vein_path):
-        os.makedirs(macular_skeleton_vein_path)
-    
-
-    if not os.path.exists(zone_b_macular_process_binary_vessel_path):
-        os.makedirs(zone_b_macular_process_binary_vessel_path)
-    if not os.path.exists(zone_b_macular_process_artery_path):
-        os.makedirs(zone_b_macular_process_artery_path)
-    if not os.path.exists(zone_b_macular_process_vein_path):
-        os.makedirs(zone_b_macular_process_vein_path)
-    if not os.path.exists(zone_b_macular_skeleton_binary_vessel_path):
-        os.makedirs(zone_b_macular_skeleton_binary_vessel_path)
-    if not os.path.exists(zone_b_macular_skeleton_artery_path):
-        os.makedirs(zone_b_macular_skeleton_artery_path)
-    if not os.path.exists(zone_b_macular_skeleton_vein_path):
-        os.makedirs(zone_b_macular_skeleton_vein_path)
-        
-    if not os.path.exists(zone_c_macular_process_binary_vessel_path):
-        os.makedirs(zone_c_macular_process_binary_vessel_path)
-    if not os.path.exists(zone_c_macular_process_artery_path):
-        os.makedirs(zone_c_macular_process_artery_path)
-    if not os.path.exists(zone_c_macular_process_vein_path):
-        os.makedirs(zone_c_macular_process_vein_path)
-    if not os.path.exists(zone_c_macular_skeleton_binary_vessel_path):
-        os.makedirs(zone_c_macular_skeleton_binary_vessel_path)
-    if not os.path.exists(zone_c_macular_skeleton_artery_path):
-        os.makedirs(zone_c_macular_skeleton_artery_path)
-    if not os.path.exists(zone_c_macular_skeleton_vein_path):
-        os.makedirs(zone_c_macular_skeleton_vein_path)
         
     optic_vertical_CDR,optic_vertical_disc,optic_vertical_cup = [],[],[]
     optic_horizontal_CDR,optic_horizontal_disc,optic_horizontal_cup = [],[],[]
@@ -226,10 +86,11 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
     
     optic_centre_list = []
     macular_centre_list = []
+    zone_rows = []
     
     disc_cup_list = sorted(os.listdir(result_path))
     
-    resolution_list = pd.read_csv(result_path.split('M2')[0]+'M0/crop_info.csv')
+    resolution_list = crop_info(result_path.split('M2')[0])
         
     
     
@@ -238,7 +99,7 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
         disc_cup_ = cv2.imread(path_)
         disc_cup_912 = cv2.resize(disc_cup_,(912,912),interpolation = cv2.INTER_NEAREST)
         
-        resolution_scale = resolution_list['Scale_resolution'][resolution_list['Name']==i].values[0]
+        resolution_scale = resolution_list.get(i, 'Scale_resolution')
         #image_ = cv2.imread('../Results/M1/Good_quality/'+i)
         #IMAGE_912 = cv2.resize(image_,(912,912),interpolation = cv2.INTER_AREA)
         #disc_cup_912 = disc_cup_
@@ -269,7 +130,6 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
             disc_index_height = disc_index[0]
             disc_horizontal_width = np.max(disc_index_width)-np.min(disc_index_width)
             disc_vertical_height = np.max(disc_index_height)-np.min(disc_index_height)
-
             
             cup_index = np.where(cup_>0)
             cup_index_width = cup_index[1]
@@ -292,97 +152,14 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
                 vertical_distance = np.absolute(np.mean(whole_index_width)-disc_cup_912.shape[0]/2)
                 distance_ = np.sqrt(np.square(horizontal_distance)+np.square(vertical_distance))
 
-
-                binary_process_ = cv2.imread(binary_vessel_path+'binary_process/'+i)[...,0]
-                artery_process_ = cv2.imread(artery_vein_path+'artery_binary_process/'+i)[...,0]
-                vein_process_ = cv2.imread(artery_vein_path+'vein_binary_process/'+i)[...,0]
-
-                binary_skeleton_ = cv2.imread(binary_vessel_path+'binary_skeleton/'+i)[...,0]
-                artery_skeleton_ = cv2.imread(artery_vein_path+'artery_binary_skeleton/'+i)[...,0]
-                vein_skeleton_ = cv2.imread(artery_vein_path+'vein_binary_skeleton/'+i)[...,0]
-
-                # remove the intersection of binary_skeleton_
-                ignored_pixels = 1
-
-                mask_ = np.ones((binary_skeleton_.shape))
-                for it_x in range(ignored_pixels, mask_.shape[0] - ignored_pixels):
-                    for it_y in range(ignored_pixels, mask_.shape[1] - ignored_pixels):
-                        if binary_skeleton_[it_x, it_y] > 0:
-                            mask,active_neighbours = intersection(mask_,binary_skeleton_, it_x, it_y)
-
-                binary_skeleton_ = binary_skeleton_ * mask
-
-                # remove the intersection of artery_skeleton_
-                mask_ = np.ones((artery_skeleton_.shape))
-                for it_x in range(ignored_pixels, mask_.shape[0] - ignored_pixels):
-                    for it_y in range(ignored_pixels, mask_.shape[1] - ignored_pixels):
-                        if artery_skeleton_[it_x, it_y] > 0:
-                            mask,active_neighbours = intersection(mask_,artery_skeleton_, it_x, it_y)
-
-                artery_skeleton_ = artery_skeleton_ * mask
-
-                # remove the intersection of vein_skeleton_
-                mask_ = np.ones((vein_skeleton_.shape))
-                for it_x in range(ignored_pixels, mask_.shape[0] - ignored_pixels):
-                    for it_y in range(ignored_pixels, mask_.shape[1] - ignored_pixels):
-                        if vein_skeleton_[it_x, it_y] > 0:
-                            mask,active_neighbours = intersection(mask_,vein_skeleton_, it_x, it_y)
-
-                vein_skeleton_ = vein_skeleton_ * mask
-
-
-                zone_mask_B = np.zeros(binary_process_.shape)
-                zone_mask_C = np.zeros(binary_process_.shape)
+                # the zones are drawn around this centre by the M3 zone scripts
                 zone_centre = (int(np.mean(whole_index_width)), int(np.mean(whole_index_height)))
                 radius = max(int(disc_horizontal_width/2),int(disc_vertical_height/2))
-                cv2.circle(zone_mask_B,zone_centre,radius=3*radius,color=(255,255,255),thickness=-1)
-                cv2.circle(zone_mask_B,zone_centre,radius=2*radius,color=(0,0,0),thickness=-1)
-                zone_mask_B = zone_mask_B/255
-
-                binary_process_B = binary_process_*zone_mask_B 
-                artery_process_B = artery_process_*zone_mask_B 
-                vein_process_B = vein_process_*zone_mask_B
-                binary_skeleton_B = binary_skeleton_*zone_mask_B
-                artery_skeleton_B = artery_skeleton_*zone_mask_B
-                vein_skeleton_B = vein_skeleton_*zone_mask_B
-
-                cv2.circle(zone_mask_C,zone_centre,radius=5*radius,color=(255,255,255),thickness=-1)
-                cv2.circle(zone_mask_C,zone_centre,radius=2*radius,color=(0,0,0),thickness=-1)
-                zone_mask_C = zone_mask_C/255            
-
-                binary_process_C = binary_process_*zone_mask_C 
-                artery_process_C = artery_process_*zone_mask_C 
-                vein_process_C = vein_process_*zone_mask_C
-                binary_skeleton_C = binary_skeleton_*zone_mask_C
-                artery_skeleton_C = artery_skeleton_*zone_mask_C
-                vein_skeleton_C = vein_skeleton_*zone_mask_C
-
 
 
                 if (distance_/disc_cup_912.shape[1])<0.1:
                     optic_centre_list.append(i)
-                    cv2.imwrite(B_optic_process_binary_vessel_path+i,binary_process_B)
-                    cv2.imwrite(B_optic_process_artery_path+i,artery_process_B)
-                    cv2.imwrite(B_optic_process_vein_path+i,vein_process_B)
-                    cv2.imwrite(B_optic_skeleton_binary_vessel_path+i,binary_skeleton_B)
-                    cv2.imwrite(B_optic_skeleton_artery_path+i,artery_skeleton_B)
-                    cv2.imwrite(B_optic_skeleton_vein_path+i,vein_skeleton_B)
-
-                    cv2.imwrite(C_optic_process_binary_vessel_path+i,binary_process_C)
-                    cv2.imwrite(C_optic_process_artery_path+i,artery_process_C)
-                    cv2.imwrite(C_optic_process_vein_path+i,vein_process_C)
-                    cv2.imwrite(C_optic_skeleton_binary_vessel_path+i,binary_skeleton_C)
-                    cv2.imwrite(C_optic_skeleton_artery_path+i,artery_skeleton_C)
-                    cv2.imwrite(C_optic_skeleton_vein_path+i,vein_skeleton_C)   
-                    
-                    #2023/08/24
-                    shutil.copy(binary_vessel_path+'binary_process/'+i,disc_process_binary_vessel_path+i)
-                    shutil.copy(artery_vein_path+'artery_binary_process/'+i,disc_process_artery_path+i)
-                    shutil.copy(artery_vein_path+'vein_binary_process/'+i,disc_process_vein_path+i)
-                    shutil.copy(binary_vessel_path+'binary_skeleton/'+i,disc_skeleton_binary_vessel_path+i)
-                    shutil.copy(artery_vein_path+'artery_binary_skeleton/'+i,disc_skeleton_artery_path+i)
-                    shutil.copy(artery_vein_path+'vein_binary_skeleton/'+i,disc_skeleton_vein_path+i)
-
+                    zone_rows.append((i, 'Disc_centred') + zone_centre + (radius,))
 
                     optic_vertical_disc.append(disc_vertical_height*resolution_scale)
                     optic_horizontal_disc.append(disc_horizontal_width*resolution_scale)
@@ -396,27 +173,7 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
 
                 else:
                     macular_centre_list.append(i)
-                    cv2.imwrite(zone_b_macular_process_binary_vessel_path+i,binary_process_B)
-                    cv2.imwrite(zone_b_macular_process_artery_path+i,artery_process_B)
-                    cv2.imwrite(zone_b_macular_process_vein_path+i,vein_process_B)
-                    cv2.imwrite(zone_b_macular_skeleton_binary_vessel_path+i,binary_skeleton_B)
-                    cv2.imwrite(zone_b_macular_skeleton_artery_path+i,artery_skeleton_B)
-                    cv2.imwrite(zone_b_macular_skeleton_vein_path+i,vein_skeleton_B)
-
-                    cv2.imwrite(zone_c_macular_process_binary_vessel_path+i,binary_process_C)
-                    cv2.imwrite(zone_c_macular_process_artery_path+i,artery_process_C)
-                    cv2.imwrite(zone_c_macular_process_vein_path+i,vein_process_C)
-                    cv2.imwrite(zone_c_macular_skeleton_binary_vessel_path+i,binary_skeleton_C)
-                    cv2.imwrite(zone_c_macular_skeleton_artery_path+i,artery_skeleton_C)
-                    cv2.imwrite(zone_c_macular_skeleton_vein_path+i,vein_skeleton_C)
-
-
-                    shutil.copy(binary_vessel_path+'binary_process/'+i,macular_process_binary_vessel_path+i)
-                    shutil.copy(artery_vein_path+'artery_binary_process/'+i,macular_process_artery_path+i)
-                    shutil.copy(artery_vein_path+'vein_binary_process/'+i,macular_process_vein_path+i)
-                    shutil.copy(binary_vessel_path+'binary_skeleton/'+i,macular_skeleton_binary_vessel_path+i)
-                    shutil.copy(artery_vein_path+'artery_binary_skeleton/'+i,macular_skeleton_artery_path+i)
-                    shutil.copy(artery_vein_path+'vein_binary_skeleton/'+i,macular_skeleton_vein_path+i)
+                    zone_rows.append((i, 'Macular_centred') + zone_centre + (radius,))
 
                     macular_vertical_disc.append(disc_vertical_height*resolution_scale)
                     macular_horizontal_disc.append(disc_horizontal_width*resolution_scale)
@@ -430,12 +187,7 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
             
             else:
                 macular_centre_list.append(i)
-                shutil.copy(binary_vessel_path+'binary_process/'+i,macular_process_binary_vessel_path+i)
-                shutil.copy(artery_vein_path+'artery_binary_process/'+i,macular_process_artery_path+i)
-                shutil.copy(artery_vein_path+'vein_binary_process/'+i,macular_process_vein_path+i)
-                shutil.copy(binary_vessel_path+'binary_skeleton/'+i,macular_skeleton_binary_vessel_path+i)
-                shutil.copy(artery_vein_path+'artery_binary_skeleton/'+i,macular_skeleton_artery_path+i)
-                shutil.copy(artery_vein_path+'vein_binary_skeleton/'+i,macular_skeleton_vein_path+i)
+                zone_rows.append((i, 'Macular_centred', NO_DISC, NO_DISC, NO_DISC))
 
                 macular_vertical_disc.append(-1)
                 macular_horizontal_disc.append(-1)
@@ -448,12 +200,7 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
                 
         except:
             macular_centre_list.append(i)
-            shutil.copy(binary_vessel_path+'binary_process/'+i,macular_process_binary_vessel_path+i)
-            shutil.copy(artery_vein_path+'artery_binary_process/'+i,macular_process_artery_path+i)
-            shutil.copy(artery_vein_path+'vein_binary_process/'+i,macular_process_vein_path+i)
-            shutil.copy(binary_vessel_path+'binary_skeleton/'+i,macular_skeleton_binary_vessel_path+i)
-            shutil.copy(artery_vein_path+'artery_binary_skeleton/'+i,macular_skeleton_artery_path+i)
-            shutil.copy(artery_vein_path+'vein_binary_skeleton/'+i,macular_skeleton_vein_path+i)
+            zone_rows.append((i, 'Macular_centred', NO_DISC, NO_DISC, NO_DISC))
 
             macular_vertical_disc.append(-1)
             macular_horizontal_disc.append(-1)
@@ -474,6 +221,7 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
 
     Pd_macular_centre.to_csv(macular_binary_result_path + 'Disc_cup_results.csv', index = None, encoding='utf8')        
     
+    write_zone_info(result_path.split('M2')[0], zone_rows)
 
     
 def misc_measures(true_vessel_arr, pred_vessel_arr):
@@ -517,69 +265,31 @@ def prediction_eval(model_1,model_2,model_3,model_4,model_5,model_6,model_7,mode
         os.makedirs(seg_uncertainty_raw_path)
         
     
+    memory_format = input_memory_format([model_1])
     with tqdm(total=n_val, desc='Validation round', unit='batch', leave=False) as pbar:
         for batch in test_loader:
             imgs = batch['image']
             img_name = batch['name']
             ori_width=batch['original_sz'][0]
             ori_height=batch['original_sz'][1]
-            mask_pred_tensor_small_all = 0
             
-            imgs = imgs.to(device=device, dtype=torch.float32)
-
-            with torch.no_grad():
-
-                _,mask_pred = model_1(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_1 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_1.type(torch.FloatTensor)
-                
-                
-                _,mask_pred= model_2(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_2 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_2.type(torch.FloatTensor)
-                
-
-                _,mask_pred = model_3(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_3 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_3.type(torch.FloatTensor)                
-                
-
-                _,mask_pred = model_4(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_4 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_4.type(torch.FloatTensor)    
-                
-
-                _,mask_pred = model_5(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_5 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_5.type(torch.FloatTensor)    
-                
-
-                _,mask_pred = model_6(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_6 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_6.type(torch.FloatTensor)   
-                
-
-                _,mask_pred = model_7(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_7 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_7.type(torch.FloatTensor)   
-                
-
-                _,mask_pred = model_8(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_8 = F.softmax(mask_pred_tensor_small,dim=1)
-                mask_pred_tensor_small_all+=mask_pred_tensor_small_8.type(torch.FloatTensor)   
-                
-                mask_pred_tensor_small_all = (mask_pred_tensor_small_all/8).to(device=device)
-                
-                
-                uncertainty_map = torch.sqrt((torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_1)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_2)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_3)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_4)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_5)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_6)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_7)+torch.square(mask_pred_tensor_small_all-mask_pred_tensor_small_8))/8)
+            imgs = imgs.to(device=device, dtype=torch.float32, memory_format=memory_format)
+
+            with torch.inference_mode():
+
+                # running mean and spread of the eight softmax maps, kept on the device
+                moments = RunningMoments()
+                forward, reduce = Stopwatch(device), Stopwatch(device)
+                for model in (model_1,model_2,model_3,model_4,model_5,model_6,model_7,model_8):
+                    with forward:
+                        _,mask_pred = model(imgs)
+                    with reduce:
+                        moments.update(F.softmax(mask_pred.detach(),dim=1))
+                forward.record('M2.disc_cup.forward', images=imgs.shape[0])
+                reduce.record('M2.disc_cup.ensemble_reduce', images=imgs.shape[0])
+
+                mask_pred_tensor_small_all = moments.mean
+                uncertainty_map = moments.std()
             
                 _,prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
                 prediction_decode=prediction_decode.type(torch.FloatTensor)
@@ -593,32 +303,33 @@ def prediction_eval(model_1,model_2,model_3,model_4,model_5,model_6,model_7,mode
                 
                 for i in range(n_img):
                     
-                    save_image(uncertainty_map[i,...]*255, seg_uncertainty_small_path+img_name[i]+'.png')
-                    save_image(uncertainty_map[i,1,...]*255, seg_uncertainty_small_path+img_name[i]+'_disc.png')
-                    save_image(uncertainty_map[i,2,...]*255, seg_uncertainty_small_path+img_name[i]+'_cup.png')
+                    with span('M2.disc_cup.write', images=1, image=img_name[i]):
+                        save_image(uncertainty_map[i,...]*255, seg_uncertainty_small_path+img_name[i]+'.png')
+                        save_image(uncertainty_map[i,1,...]*255, seg_uncertainty_small_path+img_name[i]+'_disc.png')
+                        save_image(uncertainty_map[i,2,...]*255, seg_uncertainty_small_path+img_name[i]+'_cup.png')
                     
-                    uncertainty_img = Image.open(seg_uncertainty_small_path+img_name[i]+'.png')
-                    uncertainty_img = uncertainty_img.resize((int(ori_width[i]),int(ori_height[i])))
-                    uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
-                    save_image(uncertainty_tensor, seg_uncertainty_raw_path+img_name[i]+'.png')
+                        uncertainty_img = Image.open(seg_uncertainty_small_path+img_name[i]+'.png')
+                        uncertainty_img = uncertainty_img.resize((int(ori_width[i]),int(ori_height[i])))
+                        uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
+                        save_image(uncertainty_tensor, seg_uncertainty_raw_path+img_name[i]+'.png')
                     
-                    img_r = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
-                    img_g = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
-                    img_b = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_r = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_g = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
+                        img_b = np.zeros((prediction_decode[i,...].shape[0],prediction_decode[i,...].shape[1]))
                     
                     
-                    img_r[prediction_decode[i,...]==1]=255
-                    img_b[prediction_decode[i,...]==2]=255
+                        img_r[prediction_decode[i,...]==1]=255
+                        img_b[prediction_decode[i,...]==2]=255
 
-                    img_b = remove_small_objects(img_b>0, 50)
-                    img_r = remove_small_objects(img_r>0, 100)
+                        img_b = remove_small_objects(img_b>0, 50)
+                        img_r = remove_small_objects(img_r>0, 100)
 
-                    img_ = np.concatenate((img_b[...,np.newaxis], img_g[...,np.newaxis], img_r[...,np.newaxis]), axis=2)
+                        img_ = np.concatenate((img_b[...,np.newaxis], img_g[...,np.newaxis], img_r[...,np.newaxis]), axis=2)
                     
-                    cv2.imwrite(seg_results_small_path+ img_name[i]+ '.png', np.float32(img_)*255)
+                        cv2.imwrite(seg_results_small_path+ img_name[i]+ '.png', np.float32(img_)*255)
                     
-                    img_ww = cv2.resize(np.float32(img_)*255, (int(ori_width[i]),int(ori_height[i])), interpolation = cv2.INTER_NEAREST)
-                    cv2.imwrite(seg_results_raw_path+ img_name[i]+ '.png', img_ww)
+                        img_ww = cv2.resize(np.float32(img_)*255, (int(ori_width[i]),int(ori_height[i])), interpolation = cv2.INTER_NEAREST)
+                        cv2.imwrite(seg_results_raw_path+ img_name[i]+ '.png', img_ww)
                 
                 
                 
@@ -627,13 +338,17 @@ def prediction_eval(model_1,model_2,model_3,model_4,model_5,model_6,model_7,mode
                 
 
 
-if __name__ == '__main__':
+def load_config(args):
+    # parse config file if provided
+    config_file = args.config_file
+    if config_file is not None:
+        if not osp.isfile(config_file): raise Exception('non-existent config file')
+        with open(args.config_file, 'r') as f:
+            args.__dict__ = json.load(f)
+    return args
 
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    args = parser.parse_args()
-    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
-    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
-    results_path = args.results_path
+
+def select_device():
     # Check if CUDA is available
     if torch.cuda.is_available():
         logging.info("CUDA is available. Using CUDA...")
@@ -647,37 +362,15 @@ if __name__ == '__main__':
 
     logging.info(f'Using device {device}')
 
+    return device
 
-    # parse config file if provided
-    config_file = args.config_file
-    if config_file is not None:
-        if not osp.isfile(config_file): raise Exception('non-existent config file')
-        with open(args.config_file, 'r') as f:
-            args.__dict__ = json.load(f)
-    experiment_path = args.experiment_path  # this should exist in a config file
-    model_name = args.model_name
-
-    if experiment_path is None: raise Exception('must specify path to experiment')
-
-    im_size = tuple([int(item) for item in args.im_size.split(',')])
-    if isinstance(im_size, tuple) and len(im_size) == 1:
-        tg_size = (im_size[0], im_size[0])
-    elif isinstance(im_size, tuple) and len(im_size) == 2:
-        tg_size = (im_size[0], im_size[1])
-    else:
-        sys.exit('im_size should be a number or a tuple of two numbers')
-
-    data_path = f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
 
-    csv_path = 'test_all.csv'
-    test_loader = get_test_dataset(
-        data_path,
-        csv_path=csv_path,
-        tg_size=tg_size,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-    )
-    
+def load_models(model_name, device, torchscript=False, optimize=False):
+    """
+    Builds the eight disc/cup W-Nets on the device and loads their checkpoints, so they can be
+    reused over several calls of main. They are optimised for inference with optimize, and frozen
+    with torchscript, see automorph_optimize.
+    """
     model_1 = get_arch(model_name, n_classes=3).to(device)
     model_2 = get_arch(model_name, n_classes=3).to(device)
     model_3 = get_arch(model_name, n_classes=3).to(device)
@@ -721,12 +414,63 @@ if __name__ == '__main__':
     model_8, stats = load_model(model_8, experiment_path_8, device)
     model_8.eval()
 
+    checkpoints = [os.path.join(experiment_path, 'model_checkpoint.pth') for experiment_path in (
+        experiment_path_1, experiment_path_2, experiment_path_3, experiment_path_4,
+        experiment_path_5, experiment_path_6, experiment_path_7, experiment_path_8)]
+    return optimize_ensemble('disc_cup', [model_1, model_2, model_3, model_4, model_5, model_6, model_7, model_8],
+                             checkpoints, torchscript, optimize)
+
 
-    prediction_eval(model_1,model_2,model_3,model_4,model_5,model_6,model_7,model_8, test_loader)
+def main(argv=None, models=None, images=None):
+    global AUTOMORPH_DATA, device
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    args = parser.parse_args(argv)
+    AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
+    os.environ['AUTOMORPH_DATA'] = AUTOMORPH_DATA
+    results_path = args.results_path
+    device = select_device()
+    # the config file replaces the arguments
+    backend, onnx_folder, torchscript, optimize = args.backend, args.onnx_folder, args.torchscript, args.optimize
+
+    args = load_config(args)
+
+    experiment_path = args.experiment_path  # this should exist in a config file
+    model_name = args.model_name
+
+    if experiment_path is None: raise Exception('must specify path to experiment')
+
+    im_size = tuple([int(item) for item in args.im_size.split(',')])
+    if isinstance(im_size, tuple) and len(im_size) == 1:
+        tg_size = (im_size[0], im_size[0])
+    elif isinstance(im_size, tuple) and len(im_size) == 2:
+        tg_size = (im_size[0], im_size[1])
+    else:
+        sys.exit('im_size should be a number or a tuple of two numbers')
+
+    data_path = f'{AUTOMORPH_DATA}/Results/M1/Good_quality/'
+
+    csv_path = 'test_all.csv'
+    test_loader = get_test_dataset(
+        data_path,
+        csv_path=csv_path,
+        tg_size=tg_size,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        images=images,
+    )
+
+    if models is None and backend != 'torch':
+        models = load_ensemble(onnx_folder or ONNX_FOLDER, 'disc_cup')
+    elif models is None:
+        models = load_models(model_name, device, torchscript, optimize)
+
+    prediction_eval(*models, test_loader)
     
     result_path = f'{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/resized/'
-    binary_vessel_path = f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/'
-    artery_vein_path = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/'
-    
-    optic_disc_centre(result_path,binary_vessel_path, artery_vein_path)
     
+    optic_disc_centre(result_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -78,7 +78,7 @@ class TrainDataset(Dataset):
         return len(self.ids)
 
 class TestDataset(Dataset):
-    def __init__(self, csv_path, tg_size):
+    def __init__(self, csv_path, tg_size, images=None):
         
         self.im_list = csv_path
         #self.gt_list = csv_path + '1st_manual/'
@@ -86,8 +86,13 @@ class TestDataset(Dataset):
         #self.transforms = transforms
         #self.label_values = label_values  # for use in label_encoding
         
-        self.ids = [splitext(file)[0] for file in listdir(self.im_list)
-                    if not file.startswith('.')]
+        # optional ImageStore holding the gradable images, used instead of the PNGs in im_list
+        self.images = images
+        if images is not None:
+            self.ids = images.names()
+        else:
+            self.ids = [splitext(file)[0] for file in listdir(self.im_list)
+                        if not file.startswith('.')]
         logging.info(f'Creating dataset with {(self.ids)} ')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
         
@@ -104,8 +109,11 @@ class TestDataset(Dataset):
         # # load image and mask
         idx = self.ids[index]
 
-        img_file = glob(self.im_list + idx + '.*')  
-        img = Image.open(img_file[0])
+        if self.images is not None:
+            img = self.images.open(idx)
+        else:
+            img_file = glob(self.im_list + idx + '.*')  
+            img = Image.open(img_file[0])
         
         #mask = Image.open(self.mask_list[index]).convert('L')
         #img, coords_crop = self.crop_to_fov(img, mask)
@@ -215,11 +223,11 @@ def get_train_val_loaders(csv_path_train, csv_path_val, seed_num, batch_size=4,
     val_loader = DataLoader(dataset=val_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=torch.cuda.is_available())
     return train_loader, val_loader
 
-def get_test_dataset(data_path, csv_path='test.csv', tg_size=(512, 512), batch_size=16, num_workers=8):
+def get_test_dataset(data_path, csv_path='test.csv', tg_size=(512, 512), batch_size=16, num_workers=8, images=None):
     # csv_path will only not be test.csv when we want to build training set predictions
     #path_test_csv = osp.join(data_path, csv_path)
     path_test_csv = data_path
-    test_dataset = TestDataset(csv_path=path_test_csv, tg_size=tg_size)
+    test_dataset = TestDataset(csv_path=path_test_csv, tg_size=tg_size, images=images)
     test_loader = DataLoader(
         dataset=test_dataset,
         batch_size=batch_size,
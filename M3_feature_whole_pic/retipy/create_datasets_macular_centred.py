@@ -23,7 +23,6 @@ estimated value and it is sorted by image file name.
 """
 
 import argparse
-import glob
 # import numpy as np
 import os
 import sys
@@ -35,6 +34,8 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[2]))
 from automorph_paths import prepare_automorph_data
+from automorph_skeleton import skeleton_graph
+from automorph_zones import centred_images
 
 from retipy import configuration, retina, tortuosity_measures
 
@@ -85,21 +86,21 @@ name_binary_list = []
 name_artery_list = []
 name_vein_list = []
 
-Artery_PATH = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_artery_skeleton'
-Vein_PATH = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_vein_skeleton'
-Binary_PATH = f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_centred_binary_skeleton'
+Centred_images = centred_images(f'{AUTOMORPH_DATA}/Results', 'Macular_centred')
 
-for filename in sorted(glob.glob(os.path.join(Binary_PATH, '*.png'))):
+for name in Centred_images:
+    filename = f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/binary_skeleton/{name}'
     
     try:
-        segmentedImage = retina.Retina(None, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_centred_binary_process')
+        segmentedImage = retina.Retina(None, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/binary_process')
         #segmentedImage.threshold_image()
         #segmentedImage.reshape_square()
         #window_sizes = segmentedImage.get_window_sizes()
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_centred_binary_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename.split('/')[-1]).vessels('binary', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/binary_process/', vessels=vessels)
         #print(window.tags)
         binary_t2_list.append(t2)
         binary_t4_list.append(t4)
@@ -119,15 +120,17 @@ for filename in sorted(glob.glob(os.path.join(Binary_PATH, '*.png'))):
         name_binary_list.append(filename.split('/')[-1])
 
 
-for filename in sorted(glob.glob(os.path.join(Artery_PATH, '*.png'))):
+for name in Centred_images:
+    filename = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/artery_binary_skeleton/{name}'
 
     try:
         
-        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_artery_process')
+        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/artery_binary_process')
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_artery_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename.split('/')[-1]).vessels('artery', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/artery_binary_process/', vessels=vessels)
         #print(window.tags)
         artery_t2_list.append(t2)
         artery_t4_list.append(t4)
@@ -148,14 +151,16 @@ for filename in sorted(glob.glob(os.path.join(Artery_PATH, '*.png'))):
         name_artery_list.append(filename.split('/')[-1])  
 
 
-for filename in sorted(glob.glob(os.path.join(Vein_PATH, '*.png'))):
+for name in Centred_images:
+    filename = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/vein_binary_skeleton/{name}'
 
     try:
-        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_vein_process')
+        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/vein_binary_process')
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_centred_vein_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename.split('/')[-1]).vessels('vein', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width, t2, t4, td = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/vein_binary_process/', vessels=vessels)
         #print(window.tags)
         vein_t2_list.append(t2)
         vein_t4_list.append(t4)
@@ -23,7 +23,6 @@ estimated value and it is sorted by image file name.
 """
 
 import argparse
-import glob
 # import numpy as np
 import os
 import sys
@@ -35,6 +34,8 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[2]))
 from automorph_paths import prepare_automorph_data
+from automorph_skeleton import skeleton_graph
+from automorph_zones import centred_images, zone_maps
 
 from retipy import configuration, retina, tortuosity_measures
 
@@ -65,12 +66,6 @@ args = parser.parse_args()
 
 AUTOMORPH_DATA, _ = prepare_automorph_data(args.image_folder, args.result_folder)
 
-if os.path.exists(f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_artery_skeleton/.ipynb_checkpoints'):
-    shutil.rmtree(f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_artery_skeleton/.ipynb_checkpoints')
-if os.path.exists(f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_Zone_B_centred_vein_skeleton/.ipynb_checkpoints'):
-    shutil.rmtree(f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_Zone_B_centred_vein_skeleton/.ipynb_checkpoints')
-if os.path.exists(f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_binary_skeleton/.ipynb_checkpoints'):
-    shutil.rmtree(f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_binary_skeleton/.ipynb_checkpoints')
 if not os.path.exists(f'{AUTOMORPH_DATA}/Results/M3/Macular_centred/Width/'):
     os.makedirs(f'{AUTOMORPH_DATA}/Results/M3/Macular_centred/Width/')
 
@@ -93,21 +88,22 @@ name_artery_list = []
 name_vein_list = []
 
 
-Artery_PATH = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_artery_skeleton'
-Vein_PATH = f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_vein_skeleton'
-Binary_PATH = f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_Zone_B_centred_binary_skeleton'
+# the images whose disc was found, the zone is cut out of their M2 maps around it
+Zone_images = centred_images(f'{AUTOMORPH_DATA}/Results', 'Macular_centred', zoned=True)
 
-for filename in sorted(glob.glob(os.path.join(Binary_PATH, '*.png'))):
+for filename in Zone_images:
 
     try:
-        segmentedImage = retina.Retina(None, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_Zone_B_centred_binary_process')
+        skeleton, vessel = zone_maps(f'{AUTOMORPH_DATA}/Results', filename, 'binary', 'B', size=912)
+        segmentedImage = retina.Retina(skeleton, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/binary_process', vessel_image=vessel)
         #segmentedImage.threshold_image()
         #segmentedImage.reshape_square()
         #window_sizes = segmentedImage.get_window_sizes()
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average, _, _,_,_ = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/macular_Zone_B_centred_binary_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename).vessels('binary', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average, _, _,_,_ = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/binary_vessel/binary_process/', vessels=vessels)
         #print(window.tags)
         binary_t2_list.append(t2)
         binary_t4_list.append(t4)
@@ -115,7 +111,7 @@ for filename in sorted(glob.glob(os.path.join(Binary_PATH, '*.png'))):
         binary_FD_binary.append(FD_binary)
         binary_VD_binary.append(VD_binary)
         binary_Average_width.append(Average_width)
-        name_binary_list.append(filename.split('/')[-1])
+        name_binary_list.append(filename)
     
     except:
         binary_t2_list.append(-1)
@@ -124,19 +120,21 @@ for filename in sorted(glob.glob(os.path.join(Binary_PATH, '*.png'))):
         binary_FD_binary.append(-1)
         binary_VD_binary.append(-1)
         binary_Average_width.append(-1)
-        name_binary_list.append(filename.split('/')[-1])
+        name_binary_list.append(filename)
 
 
 
-for filename in sorted(glob.glob(os.path.join(Artery_PATH, '*.png'))):
+for filename in Zone_images:
 
     
     try:
-        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_artery_process')
+        skeleton, vessel = zone_maps(f'{AUTOMORPH_DATA}/Results', filename, 'artery', 'B', size=912)
+        segmentedImage = retina.Retina(skeleton, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/artery_binary_process', vessel_image=vessel)
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average,CRAE_Hubbard, _,CRAE_Knudtson,_ = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_artery_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename).vessels('artery', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average,CRAE_Hubbard, _,CRAE_Knudtson,_ = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/artery_binary_process/', vessels=vessels)
         #print(window.tags)
         artery_t2_list.append(t2)
         artery_t4_list.append(t4)
@@ -146,7 +144,7 @@ for filename in sorted(glob.glob(os.path.join(Artery_PATH, '*.png'))):
         artery_Average_width.append(Average_width)
         CRAE_Hubbard_list.append(CRAE_Hubbard)
         CRAE_Knudtson_list.append(CRAE_Knudtson)
-        name_artery_list.append(filename.split('/')[-1])
+        name_artery_list.append(filename)
 
     except:
         artery_t2_list.append(-1)
@@ -157,22 +155,24 @@ for filename in sorted(glob.glob(os.path.join(Artery_PATH, '*.png'))):
         artery_Average_width.append(-1)
         CRAE_Hubbard_list.append(-1)
         CRAE_Knudtson_list.append(-1)    
-        name_artery_list.append(filename.split('/')[-1])
+        name_artery_list.append(filename)
 
 ####################################3
 
 
-for filename in sorted(glob.glob(os.path.join(Vein_PATH, '*.png'))):
+for filename in Zone_images:
 
     try:
-        segmentedImage = retina.Retina(None, filename,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_vein_process')
+        skeleton, vessel = zone_maps(f'{AUTOMORPH_DATA}/Results', filename, 'vein', 'B', size=912)
+        segmentedImage = retina.Retina(skeleton, filename, store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/vein_binary_process', vessel_image=vessel)
         #segmentedImage.threshold_image()
         #segmentedImage.reshape_square()
         #window_sizes = segmentedImage.get_window_sizes()
         window_sizes = [912]
         window = retina.Window(
             segmentedImage, window_sizes[-1], min_pixels=CONFIG.pixels_per_window)
-        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average,_, CRVE_Hubbard,_,CRVE_Knudtson = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/macular_Zone_B_centred_vein_process/')
+        vessels = skeleton_graph(f'{AUTOMORPH_DATA}/Results', filename).vessels('vein', within=segmentedImage.np_image > 0)
+        FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average,_, CRVE_Hubbard,_,CRVE_Knudtson = tortuosity_measures.evaluate_window(window, CONFIG.pixels_per_window, CONFIG.sampling_size, CONFIG.r_2_threshold,store_path=f'{AUTOMORPH_DATA}/Results/M2/artery_vein/vein_binary_process/', vessels=vessels)
         #print(window.tags)
         vein_t2_list.append(t2)
         vein_t4_list.append(t4)
@@ -182,7 +182,7 @@ for filename in sorted(glob.glob(os.path.join(Vein_PATH, '*.png'))):
         vein_Average_width.append(Average_width)
         CRVE_Hubbard_list.append(CRVE_Hubbard)
         CRVE_Knudtson_list.append(CRVE_Knudtson)
-        name_vein_list.append(filename.split('/')[-1])
+        name_vein_list.append(filename)
 
     except:
         
@@ -194,7 +194,7 @@ for filename in sorted(glob.glob(os.path.join(Vein_PATH, '*.png'))):
         vein_Average_width.append(-1)
         CRVE_Hubbard_list.append(-1)
         CRVE_Knudtson_list.append(-1)
-        name_vein_list.append(filename.split('/')[-1])
+        name_vein_list.append(filename)
         
         
 
@@ -31,6 +31,13 @@ from skimage import color, feature, filters, io
 from skimage.morphology import skeletonize
 import cv2
 import pandas as pd
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[3]))
+from automorph_calibre import VesselCalibre
+from automorph_metadata import crop_info
+from automorph_skeleton import remove_junctions, trace_segments
 
 class Retina(object):
     """
@@ -39,10 +46,15 @@ class Retina(object):
 
     :param image: a numpy array with the image data
     :param image_path: path to an image to be open
+    :param vessel_image: the already decoded vessel segmentation, read from the store path when None
+    :param resolution: the scaled resolution of the image, looked up in M0/crop_info.csv when None
     """
     @staticmethod
     def _open_image(img_path):
-        return cv2.resize(io.imread(img_path), dsize=(912, 912), interpolation=cv2.INTER_CUBIC)
+        image = io.imread(img_path)
+        if image.shape[:2] == (912, 912):
+            return image
+        return cv2.resize(image, dsize=(912, 912), interpolation=cv2.INTER_CUBIC)
 
     @staticmethod
     def get_base64_image(image: np.ndarray, is_luminance: bool = True):
@@ -54,14 +66,14 @@ class Retina(object):
         temp_image.save(buffer, format="png")
         return str(base64.b64encode(buffer.getvalue()).decode('utf-8'))
 
-    def __init__(self, image: np.ndarray, image_path: str, store_path:str):
+    def __init__(self, image: np.ndarray, image_path: str, store_path:str, vessel_image: np.ndarray = None,
+                 resolution: float = None):
         #print('!!!',image_path)
         #print('@@@@',store_path)
         
         if image is None:
             self.np_image = self._open_image(image_path)
             self.segmentation_path = store_path+image_path.split('_skeleton')[1]
-            self.vessel_image = self._open_image(self.segmentation_path)
             
             _, file = path.split(image_path)
             self._file_name = file
@@ -70,27 +82,30 @@ class Retina(object):
             self._file_name = image_path
 
             self.segmentation_path = store_path
-            self.vessel_image = self._open_image(self.segmentation_path)
-            
-        
-        if '/' in image_path:
-            img_name = image_path.split('_skeleton/')[1]
-        elif 'window' in image_path:
-            img_name = image_path.split('window{}')[1]
-        else:
-            img_name = image_path
-        
-        resolution_list = pd.read_csv(store_path.split('M2')[0]+'M0/crop_info.csv')
+        self.vessel_image = self._open_image(self.segmentation_path) if vessel_image is None else vessel_image
         
-        self.resolution = resolution_list['Scale_resolution'][resolution_list['Name']==img_name].values[0]
+        if resolution is None:
+            if '/' in image_path:
+                img_name = image_path.split('_skeleton/')[1]
+            elif 'window' in image_path:
+                img_name = image_path.split('window{}')[1]
+            else:
+                img_name = image_path
+
+            # read once per process, every window of every image looks its resolution up in it
+            resolution = crop_info(store_path.split('M2')[0]).get(img_name, 'Scale_resolution')
+        self.resolution = resolution
         
         # average value
         #self.resolution = 0.83
         
         self.segmented = False
         self.old_image = None
+        self._calibre = None
         #self.np_image = color.rgb2gray(self.np_image)
-        self.original_base64 = self.get_base64_image(self.np_image)
+        # encoded on first use, the feature scripts never read it
+        self._original_image = self.np_image
+        self._original_base64 = None
         self.depth = 1
         self.shape = self.np_image.shape
 
@@ -230,6 +245,20 @@ class Retina(object):
         """
         self.np_image = self.old_image
 
+    @property
+    def calibre(self):
+        """Returns the calibre engine of the vessel image, built on first use and reused afterwards."""
+        if self._calibre is None:
+            self._calibre = VesselCalibre(self.vessel_image)
+        return self._calibre
+
+    @property
+    def original_base64(self):
+        """Returns the image the object was built with as a base64 encoded PNG."""
+        if self._original_base64 is None:
+            self._original_base64 = self.get_base64_image(self._original_image)
+        return self._original_base64
+
     @property
     def filename(self):
         """Returns the filename of the retina image."""
@@ -268,7 +297,9 @@ class Window(Retina):
         super(Window, self).__init__(
             image.np_image,
             image.filename,
-            image.segmentation_path)
+            image.segmentation_path,
+            vessel_image=image.vessel_image,
+            resolution=image.resolution)
         self.windows, self.w_pos = Window.create_windows(image, dimension, method, min_pixels)
         if len(self.windows) == 0:
             raise ValueError("No windows were created for the given retinal image")
@@ -403,7 +434,8 @@ class Window(Retina):
                            Set to zero to add all windows
         :return: a tuple with its first element as a numpy array with the structure
                  [window, depth, height, width] and its second element as [window, 2, 2]
-                 with the window position
+                 with the window position. The windows keep the dtype of the image, and a single
+                 window covering the whole image is a view of it
         """
 
         if image.shape[0] % dimension != 0 or image.shape[1] % dimension != 0:
@@ -411,56 +443,38 @@ class Window(Retina):
                 "image shape is not the same or the dimension value does not divide the image "
                 "completely: sx:{} sy:{} dim:{}".format(image.shape[0], image.shape[1], dimension))
 
-        #                      window_count
-        windows = []
-        windows_position = []
-        window_id = 0
-        img_dimension = image.shape[0] if image.shape[0] > image.shape[1] else image.shape[1]
         if method == "separated":
-            windows = np.empty(
-                [(img_dimension // dimension) ** 2, image.depth, dimension, dimension])
-            windows_position = np.empty([(img_dimension // dimension) ** 2, 2, 2], dtype=np.int32)
-            for x in range(0, image.shape[0], dimension):
-                for y in range(0, image.shape[1], dimension):
-                    cw = windows_position[window_id]
-                    cw[0, 0] = x
-                    cw[1, 0] = x + dimension
-                    cw[0, 1] = y
-                    cw[1, 1] = y + dimension
-                    t_window = image.np_image[cw[0, 0]:cw[1, 0], cw[0, 1]:cw[1, 1]]
-                    if t_window.sum() >= min_pixels:
-                        windows[window_id, 0] = t_window
-                        window_id += 1
+            step = dimension
+            stop_x, stop_y = image.shape[0], image.shape[1]
         elif method == "combined":
-            new_dimension = dimension // 2
-            windows = np.empty(
-                [(img_dimension // new_dimension) ** 2, image.depth, dimension, dimension])
-            windows_position = np.empty([(img_dimension // new_dimension) ** 2, 2, 2], dtype=np.int32)
-            if image.shape[0] % new_dimension != 0:
+            step = dimension // 2
+            if image.shape[0] % step != 0:
                 raise ValueError(
                     "Dimension value '{}' is not valid, choose a value that its half value can split the image evenly"
                     .format(dimension))
-            for x in range(0, image.shape[0] - new_dimension, new_dimension):
-                for y in range(0, image.shape[1] - new_dimension, new_dimension):
-                    cw = windows_position[window_id]
-                    cw[0, 0] = x
-                    cw[1, 0] = x + dimension
-                    cw[0, 1] = y
-                    cw[1, 1] = y + dimension
-                    t_window = image.np_image[cw[0, 0]:cw[1, 0], cw[0, 1]:cw[1, 1]]
-                    if t_window.sum() >= min_pixels:
-                        windows[window_id, 0] = t_window
-                        window_id += 1
-        if window_id <= windows.shape[0]:
-            if window_id == 0:
-                windows = []
-                windows_position = []
-            else:
-                windows = np.resize(
-                    windows, [window_id, windows.shape[1], windows.shape[2], windows.shape[3]])
-                windows_position = np.resize(windows_position, [window_id, 2, 2])
+            stop_x, stop_y = image.shape[0] - step, image.shape[1] - step
+        else:
+            raise ValueError("Unknown window method '{}'".format(method))
 
-        #  print('created ' + str(window_id) + " windows")
+        # the windows are views of the image until they are stacked, in the dtype of the image
+        windows = []
+        windows_position = []
+        for x in range(0, stop_x, step):
+            for y in range(0, stop_y, step):
+                t_window = image.np_image[x:x + dimension, y:y + dimension]
+                if t_window.sum() >= min_pixels:
+                    windows.append(t_window)
+                    windows_position.append([[x, y], [x + dimension, y + dimension]])
+
+        if len(windows) == 1:
+            # a single window covering the whole image, the common case, is not copied
+            windows = windows[0][np.newaxis, np.newaxis]
+        elif windows:
+            windows = np.stack(windows)[:, np.newaxis]
+        if windows_position:
+            windows_position = np.array(windows_position, dtype=np.int32)
+
+        #  print('created ' + str(len(windows)) + " windows")
         return windows, windows_position
 
 
@@ -469,182 +483,19 @@ def detect_vessel_border(image: Retina, ignored_pixels=1):
     Extracts the vessel border of the given image, this method will try to extract all vessel
     borders that does not overlap.
 
-    Returns a list of lists with the points of each vessel.
+    Returns a list of [x, y] int32 arrays with the points of each vessel, the pixels of a vessel are
+    listed breadth first from its first pixel in raster order. Like the former tracing, the image
+    is left without the junctions and the traced pixels.
 
     :param image: the retinal image to extract its vessels
     :param ignored_pixels: how many pixels will be ignored from borders.
     """
+    # remove the intersection in case the whole vessel is too long
+    image.np_image = remove_junctions(image.np_image, ignored_pixels)
 
-    def neighbours(pixel, window):  # pragma: no cover
-        """
-        Creates a list of the neighbouring pixels for the given one. It will only
-        add to the list if the pixel has value.
-
-        :param pixel: the pixel position to extract its neighbours
-        :param window:  the window with the pixels information
-        :return: a list of pixels (list of tuples)
-        """
-        x_less = max(0, pixel[0] - 1)
-        y_less = max(0, pixel[1] - 1)
-        x_more = min(window.shape[0] - 1, pixel[0] + 1)
-        y_more = min(window.shape[1] - 1, pixel[1] + 1)
-
-        active_neighbours = []
-
-        if window.np_image[x_less, y_less] > 0:
-            active_neighbours.append([x_less, y_less])
-        if window.np_image[x_less, pixel[1]] > 0:
-            active_neighbours.append([x_less, pixel[1]])
-        if window.np_image[x_less, y_more] > 0:
-            active_neighbours.append([x_less, y_more])
-        if window.np_image[pixel[0], y_less] > 0:
-            active_neighbours.append([pixel[0], y_less])
-        if window.np_image[pixel[0], y_more] > 0:
-            active_neighbours.append([pixel[0], y_more])
-        if window.np_image[x_more, y_less] > 0:
-            active_neighbours.append([x_more, y_less])
-        if window.np_image[x_more, pixel[1]] > 0:
-            active_neighbours.append([x_more, pixel[1]])
-        if window.np_image[x_more, y_more] > 0:
-            active_neighbours.append([x_more, y_more])
-
-        return active_neighbours
-    
-    
-    def intersection(mask,image, it_x, it_y):
-        """
-        Remove the intersection in case the whole vessel is too long
-        """
-        vessel_ = image.np_image
-        x_less = max(0, it_x - 1)
-        y_less = max(0, it_y - 1)
-        x_more = min(vessel_.shape[0] - 1, it_x + 1)
-        y_more = min(vessel_.shape[1] - 1, it_y + 1)
-
-        active_neighbours = (vessel_[x_less, y_less]>0).astype('float')+ \
-                            (vessel_[x_less, it_y]>0).astype('float')+ \
-                            (vessel_[x_less, y_more]>0).astype('float')+ \
-                            (vessel_[it_x, y_less]>0).astype('float')+ \
-                            (vessel_[it_x, y_more]>0).astype('float')+ \
-                            (vessel_[x_more, y_less]>0).astype('float')+ \
-                            (vessel_[x_more, it_y]>0).astype('float')+ \
-                            (vessel_[x_more, y_more]>0).astype('float')
-
-        if active_neighbours > 2:
-            cv2.circle(mask,(it_y,it_x),radius=1,color=(0,0,0),thickness=-1)
-        
-
-        return mask,active_neighbours        
-        
-    '''
-    # original remove x duplicate
-    def vessel_extractor(window, start_x, start_y):
-        """
-        Extracts a vessel using adjacent points, when each point is extracted is deleted from the
-        original image
-        & Measure width
-        """
-        vessel = []
-        width_list = []
-        width_mask = np.zeros((window.np_image.shape))
-        pending_pixels = [[start_x, start_y]]
-        while pending_pixels:
-            pixel = pending_pixels.pop(0)
-            if window.np_image[pixel[0], pixel[1]] > 0:
-                vessel.append(pixel)
-                window.np_image[pixel[0], pixel[1]] = 0
-
-                # add the neighbours with value to pending list:
-                pending_pixels.extend(neighbours(pixel, window))
-
-        # sort by x position
-        vessel.sort(key=lambda item: item[0])
-
-        # remove all repeating x values???????????
-        current_x = -1
-        filtered_vessel = []
-        for pixel in vessel:
-            if pixel[0] == current_x:
-                pass
-            else:
-                filtered_vessel.append(pixel)
-                current_x = pixel[0]
-
-        vessel_x = []
-        vessel_y = []
-        for pixel in filtered_vessel:
-            vessel_x.append(pixel[0])
-            vessel_y.append(pixel[1])
-            
+    #cv2.imwrite('./intersection_test/{}.png'.format(image._file_name),image.np_image)
 
-        return [vessel_x, vessel_y]
-    '''
-    
-    # 2021/10/31 remove setting of the sort & x duplication
-    def vessel_extractor(window, start_x, start_y):
-        """
-        Extracts a vessel using adjacent points, when each point is extracted is deleted from the
-        original image
-        & Measure width
-        """
-        vessel = []
-        width_list = []
-        width_mask = np.zeros((window.np_image.shape))
-        pending_pixels = [[start_x, start_y]]
-        while pending_pixels:
-            pixel = pending_pixels.pop(0)
-            if window.np_image[pixel[0], pixel[1]] > 0:
-                vessel.append(pixel)
-                window.np_image[pixel[0], pixel[1]] = 0
-
-                # add the neighbours with value to pending list:
-                pending_pixels.extend(neighbours(pixel, window))
-
-        # sort by x position
-        '''
-        vessel.sort(key=lambda item: item[0])
-
-        # remove all repeating x values???????????
-        current_x = -1
-        filtered_vessel = []
-        for pixel in vessel:
-            if pixel[0] == current_x:
-                pass
-            else:
-                filtered_vessel.append(pixel)
-                current_x = pixel[0]
-        '''
-        filtered_vessel = vessel
-        vessel_x = []
-        vessel_y = []
-        for pixel in filtered_vessel:
-            vessel_x.append(pixel[0])
-            vessel_y.append(pixel[1])
-            
+    coords, offsets = trace_segments(image.np_image, ignored_pixels)
+    image.np_image[coords[:, 0], coords[:, 1]] = 0
 
-        return [vessel_x, vessel_y]
-    
-    
-    vessels = []
-    active_neighbours_list = []
-    width_list_all = []
-    mask_ = np.ones((image.np_image.shape))
-    
-    for it_x in range(ignored_pixels, image.shape[0] - ignored_pixels):
-        for it_y in range(ignored_pixels, image.shape[1] - ignored_pixels):
-            if image.np_image[it_x, it_y] > 0:
-                mask,active_neighbours = intersection(mask_,image, it_x, it_y)
-                active_neighbours_list.append(active_neighbours)
-    
-    image.np_image = image.np_image * mask
-    
-    #cv2.imwrite('./intersection_test/{}.png'.format(image._file_name),image.np_image)
-    
-    for it_x in range(ignored_pixels, image.shape[0] - ignored_pixels):
-        for it_y in range(ignored_pixels, image.shape[1] - ignored_pixels):
-            if image.np_image[it_x, it_y] > 0:
-                vessel = vessel_extractor(image, it_x, it_y)
-                vessels.append(vessel)
-    
-                
-    return vessels
+    return [[coords[begin:end, 0], coords[begin:end, 1]] for begin, end in zip(offsets[:-1], offsets[1:])]
@@ -18,38 +18,16 @@
 
 import math
 import numpy as np
-from function_ import fractal_dimension, smoothing
+from function_ import smoothing
 from retipy import math as m
 from retipy.retina import Retina, Window, detect_vessel_border
+from automorph_timing import Stopwatch
+from automorph_fractal import fractal_dimension
+from automorph_tortuosity import VesselBatch, pack_vessels
 from scipy.interpolate import CubicSpline
 from PIL import Image
-import time
 import cv2
 
-def fractal_dimension(Z):
-
-    assert(len(Z.shape) == 2)
-
-    def boxcount(Z, k):
-        S = np.add.reduceat(
-            np.add.reduceat(Z, np.arange(0, Z.shape[0], k), axis=0),
-                               np.arange(0, Z.shape[1], k), axis=1)
-
-        return len(np.where((S > 0) & (S < k*k))[0])
-
-    p = min(Z.shape)
-    n = 2**np.floor(np.log(p)/np.log(2))
-    n = int(np.log(n)/np.log(2))
-    sizes = 2**np.arange(n, 1, -1)
-    counts = []
-    for size in sizes:
-        counts.append(boxcount(Z, size))
-
-    coeffs = np.polyfit(np.log(sizes), np.log(counts), 1)
-    return -coeffs[0]
-
-
-
 def vessel_density(Z):
 
     assert(len(Z.shape) == 2)
@@ -278,12 +256,12 @@ def fractal_tortuosity(retinal_image: Retina):
     :param retinal_image:  a retinal image.
     :return: the fractal dimension of the given image
     """
-    return fractal_dimension.fractal_dimension(retinal_image.np_image)
+    return fractal_dimension(retinal_image.np_image)
 
 
 def fractal_tortuosity_curve(x, y):
     image = _curve_to_image(x, y)
-    return fractal_dimension.fractal_dimension(image.np_image)
+    return fractal_dimension(image.np_image)
 
 
 def tortuosity_density(x, y):
@@ -367,61 +345,30 @@ def width_measurement(x, y, vessel_map):
 
 
 
-def width_measurement(x, y, retinal):    
-    
-    width_list = []
-    vessel_map = retinal.vessel_image
-    
-    for i in range(0, len(x) - 1):
-        width = 0
-        width_matrix = 1
-        width_mask = np.zeros((vessel_map.shape))
-        width_cal = 0
-    
-        while width_matrix:
-            width+=1
-            cv2.circle(width_mask,(y[i],x[i]),radius=width,color=(255,255,255),thickness=-1)
-            masked_vessel = vessel_map[width_mask>0]
-            width_matrix = np.all(masked_vessel>0)
-            
-            #2021/10/31 test
-            #test_case = vessel_map.copy()[...,np.newaxis]
-            #test_case = np.concatenate((test_case,test_case,test_case),axis=2)
-            
-        #cv2.circle(test_case,(y[i],x[i]),radius=width,color=(0,0,255),thickness=-1)
-        #cv2.imwrite('./intersection_test/test_{}_{}_{}.png'.format(y[i],x[i],width),test_case)
-        #print(width*2)
-        
-        #print(np.shape(masked_vessel))
-        #print(np.unique(masked_vessel))
-        #print('255 is ',np.sum(masked_vessel==255))
-        #print('0000 is ',np.sum(masked_vessel==0))
-        #print('00000 is ',np.where(masked_vessel==0))
-        
-        if np.sum(masked_vessel==0)==1:
-            width_cal = width*2
-        elif np.sum(masked_vessel==0)==2:
-            width_cal = width*2-1
-        elif np.sum(masked_vessel==0)==3:
-            width_cal = width*2-1
-        else:
-            width_cal = width*2
-        
-        width_cal = width_cal*retinal.resolution
-        
-        width_list.append(width_cal)
-        
-    return width_list
+def width_measurement(x, y, retinal):
+    """
+    Measures the vessel width at every centreline pixel, except the last one, as the diameter of
+    the first circle that reaches the background. Circles reaching two or three background pixels
+    count one pixel less. The distance transform of the vessel map is computed once per retina.
+
+    :param x: the x component of the vessel centreline
+    :param y: the y component of the vessel centreline
+    :param retinal: the Retina holding the vessel map and its resolution
+    :return: a list with the widths scaled by the retina resolution
+    """
+    return [width_cal*retinal.resolution for width_cal in retinal.calibre.widths(x, y)]
 
 
 
-def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r2_threshold=0.80, store_path='/home/jupyter/Deep_rias/Results/M2/artery_vein/vein_binary_process'):  # pragma: no cover
+def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r2_threshold=0.80, store_path='/home/jupyter/Deep_rias/Results/M2/artery_vein/vein_binary_process', vessels=None):  # pragma: no cover
     """
     Evaluates a Window object and sets the tortuosity values in the tag parameter.
     :param window: The window object to be evaluated
     :param min_pixels_per_vessel:
     :param sampling_size:
     :param r2_threshold:
+    :param vessels: the vessels of the image as returned by detect_vessel_border, e.g. from its
+                    skeleton graph. Only used when the window object holds a single window
     """
     #tags = np.empty([window.shape[0], 7])
     tags = np.empty([window.shape[0], 13])
@@ -435,6 +382,7 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
     FD_binary,VD_binary,Average_width = 0,0,0
     CRAE_first_round,CRAE_second_round,CRVE_first_round,CRVE_second_round = [],[],[],[]
 
+    tortuosity, widths = Stopwatch(), Stopwatch()
     for i in range(0, window.shape[0], 1):
 
         bw_window = window.windows[i, 0, :, :]
@@ -442,11 +390,14 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
         vessel_total_count = np.sum(bw_window==1)
         pixel_total_count = bw_window.shape[0]*bw_window.shape[1]
         
-        retina = Retina(bw_window, "window{}" + window.filename,store_path=store_path+window.filename)
+        # the window shares the vessel map and the resolution of its image, nothing is read again
+        retina = Retina(bw_window, "window{}" + window.filename, store_path=store_path+window.filename,
+                        vessel_image=window.vessel_image, resolution=window.resolution)
         
         FD_binary,VD_binary,Average_width = global_cal(retina)
         
-        vessels = detect_vessel_border(retina)
+        if vessels is None or window.shape[0] > 1:
+            vessels = detect_vessel_border(retina)
         vessel_count = 0
         vessel_count_1 = 0
         bifurcation_t = 0
@@ -457,38 +408,37 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
         w1_list_average = []
         vessel_count_list = []
 
+        # the measures of every vessel long enough, in a single pass over their pixels
+        with tortuosity:
+            measures = VesselBatch(*pack_vessels(
+                [vessel for vessel in vessels if len(vessel[0]) > min_pixels_per_vessel])).measures(sampling_size)
+
         for vessel in vessels:
             vessel_count_1 += 1
 
             if len(vessel[0]) > min_pixels_per_vessel:
-                s1=time.time()
-                vessel_count += 1
-                if linear_regression_tortuosity(vessel[0], vessel[1], sampling_size) > r2_threshold:
+                if measures['linear_regression'][vessel_count] > r2_threshold:
                     t1 += 1
-                
-                s2=time.time()
-                t2 += distance_measure_tortuosity(vessel[0], vessel[1])
-                tcurve += _curve_length(vessel[0], vessel[1])
-                
-                s3=time.time()
-                t3_1, bifurcation = distance_inflection_count_tortuosity(vessel[0], vessel[1])
-                t3 += t3_1
-                bifurcation_t += bifurcation
-                
-                s4=time.time()
-                t4 += squared_curvature_tortuosity(vessel[0], vessel[1])
-                
-                s5=time.time()
-                td += tortuosity_density(vessel[0], vessel[1])
-                
-                s6=time.time()
-                
-                w1 = width_measurement(vessel[0], vessel[1],retina)
+
+                t2 += measures['distance_measure'][vessel_count]
+                tcurve += measures['curve_length'][vessel_count]
+
+                t3 += measures['distance_inflection_count'][vessel_count]
+                bifurcation_t += measures['inflection_count'][vessel_count]
+
+                t4 += measures['squared_curvature'][vessel_count]
+
+                td += measures['tortuosity_density'][vessel_count]
+
+                vessel_count += 1
+                # the widths are searched pixel by pixel, faster on Python integers
+                vessel = [np.asarray(vessel[0]).tolist(), np.asarray(vessel[1]).tolist()]
+                with widths:
+                    w1 = width_measurement(vessel[0], vessel[1],retina)
                 w1_list_average.append(sum(w1)/len(w1))
                 w1_list.append(w1)
                 vessel_count_list.append(vessel_count)
                 #tfi += fractal_tortuosity_curve(vessel[0], vessel[1])
-                s7=time.time()
         
         if vessel_count > 0:
             t1 = t1/vessel_count
@@ -561,4 +511,7 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
     except:
         CRAE_Hubbard, CRVE_Hubbard,CRAE_Knudtson,CRVE_Knudtson = -1, -1, -1, -1
     
+    tortuosity.record('M3.tortuosity', images=1, image=window.filename)
+    widths.record('M3.width_measurement', images=1, image=window.filename)
+
     return FD_binary,VD_binary,Average_width,t2, t4, td, vessel_count_list, w1_list, w1_list_average, CRAE_Hubbard, CRVE_Hubbard,CRAE_Knudtson,CRVE_Knudtson
@@ -0,0 +1,546 @@
+"""Reproducible benchmark of the AutoMorph steps, with golden outputs guarding the clinical measurements.
+
+The benchmark runs on synthetic fundus photographs and vessel maps drawn from a fixed seed at
+several resolutions, and on the sample photographs of images/. Every micro-benchmark times one
+step of the pipeline and compares what it computed with the values stored in
+automorph_benchmark_golden.json, so a faster implementation can be shown to give the same centres,
+radii, fractal dimensions, vessels, widths, cup-to-disc ratios and ensemble outputs. The end-to-end
+benchmark runs the pipeline on a folder of synthetic photographs and reports its images per second.
+
+Benchmarks whose stage cannot be imported here, e.g. without torch or without the checkpoints, are
+reported as skipped. Golden values are only written with --update_golden, after checking that a
+change is meant to alter the measurements. A benchmark that ran without golden values fails like a
+changed one, until they are recorded in an environment where its stage runs. The benchmarks of the
+torch stages, filter_frag, optic_disc_centre and the ensembles, have none yet and only run when
+named with --only, e.g. with --update_golden to record them.
+
+    python automorph_benchmark.py                      # every micro-benchmark with golden values
+    python automorph_benchmark.py --only get_mask fractal_dimension --repeat 10
+    python automorph_benchmark.py --only vessel_ensemble --backend onnx
+    python automorph_benchmark.py --end_to_end 20 --no_quality --no_segmentation --no_feature
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+from automorph_onnx import BACKENDS
+from automorph_pipeline import AutoMorphPipeline, Stage
+from automorph_synthetic import ENSEMBLE_SIZES, SEED, ensemble_input, synthetic_fundus
+
+GOLDEN_FILE = ROOT / 'automorph_benchmark_golden.json'
+SAMPLE_FOLDER = ROOT / 'images'
+
+# widths of the synthetic photographs, 3:2 like the samples, and sides of the synthetic vessel maps
+FUNDUS_WIDTHS = (912, 1632, 2464)
+VESSEL_SIZES = (512, 912)
+SAMPLE_RESOLUTION = 0.008
+# the largest side of the mask get_mask_max_size locates the rim at
+MASK_MAX_SIZE = 1024
+
+
+def fundus_samples() -> Dict[str, np.ndarray]:
+    """The synthetic photographs at every width of FUNDUS_WIDTHS, then the photographs of images/."""
+    samples = {}
+    for width in FUNDUS_WIDTHS:
+        height = int(round(width * 2 / 3))
+        samples[f'synthetic-{width}x{height}'] = synthetic_fundus(width, height)['image']
+    if SAMPLE_FOLDER.is_dir():
+        for path in sorted(SAMPLE_FOLDER.iterdir()):
+            image = cv2.imread(str(path))
+            if image is not None:
+                samples[f'images/{path.name}'] = image
+    return samples
+
+
+def vessel_samples() -> Dict[str, Dict[str, np.ndarray]]:
+    """Synthetic cropped fundus maps, square like the M2 outputs, at every size of VESSEL_SIZES."""
+    return {f'synthetic-{size}': synthetic_fundus(size, size) for size in VESSEL_SIZES}
+
+
+def write_results_tree(result_folder: str, samples: Dict[str, Dict[str, np.ndarray]]) -> List[str]:
+    """
+    Writes the M0 and M2 outputs the M2 post-processing and M3 read, from synthetic maps.
+
+    :param result_folder: the Results folder to fill
+    :param samples: the synthetic maps, by sample name
+    :return: the image names, <sample>.png
+    """
+    from skimage.morphology import skeletonize
+
+    folders = {
+        'vessel': ('M2/binary_vessel/resize_binary', 'M2/binary_vessel/binary_process'),
+        'artery': ('M2/artery_vein/artery_binary_process',),
+        'vein': ('M2/artery_vein/vein_binary_process',),
+    }
+    skeleton_folders = {
+        'vessel': 'M2/binary_vessel/binary_skeleton',
+        'artery': 'M2/artery_vein/artery_binary_skeleton',
+        'vein': 'M2/artery_vein/vein_binary_skeleton',
+    }
+    for relative_path in [path for paths in folders.values() for path in paths] + list(skeleton_folders.values()) + \
+            ['M0', 'M2/optic_disc_cup/raw']:
+        os.makedirs(os.path.join(result_folder, relative_path), exist_ok=True)
+
+    names, rows = [], []
+    for sample, maps in samples.items():
+        name = sample + '.png'
+        names.append(name)
+        size = maps['vessel'].shape[0]
+        for kind, relative_paths in folders.items():
+            for relative_path in relative_paths:
+                cv2.imwrite(os.path.join(result_folder, relative_path, name), maps[kind].astype(np.uint8) * 255)
+            cv2.imwrite(os.path.join(result_folder, skeleton_folders[kind], name),
+                        skeletonize(maps[kind]).astype(np.uint8) * 255)
+        disc_cup = np.zeros(maps['disc'].shape + (3,), np.uint8)
+        disc_cup[maps['disc'] & ~maps['cup'], 2] = 255
+        disc_cup[maps['cup'], 0] = 255
+        cv2.imwrite(os.path.join(result_folder, 'M2/optic_disc_cup/raw', name), disc_cup)
+        scale = size / 912
+        rows.append((name, size // 2, size // 2, size // 2, scale, scale * SAMPLE_RESOLUTION * 1000))
+    pd.DataFrame(rows, columns=['Name', 'centre_w', 'centre_h', 'radius', 'Scale', 'Scale_resolution']).to_csv(
+        os.path.join(result_folder, 'M0', 'crop_info.csv'), index=False, encoding='utf8')
+    return names
+
+
+class Benchmark(object):
+    """
+    One timed step and the outputs it is checked on.
+
+    :param name: the benchmark name, the key of its golden values
+    :param stage: the stage folder the step is imported from, active while it runs
+    :param samples: returns the samples, by name
+    :param setup: prepares the input of a sample, untimed and called before every repetition
+    :param run: the timed step, returns its outputs as a dict of numbers or lists of numbers
+    :param rtol: relative tolerance of the golden comparison
+    :param atol: absolute tolerance of the golden comparison
+    :param default: run without --only, only once its golden values are recorded
+    """
+
+    def __init__(self, name: str, stage: str, samples: Callable[[], dict], setup: Callable, run: Callable,
+                 rtol: float = 1e-7, atol: float = 1e-9, default: bool = True):
+        self.name = name
+        self.stage = stage
+        self.samples = samples
+        self.setup = setup
+        self.run = run
+        self.rtol = rtol
+        self.atol = atol
+        self.default = default
+
+
+def _get_mask(stage: Stage, sample: np.ndarray):
+    return stage.module('fundus_prep'), sample
+
+
+def _run_get_mask(state, max_size: Optional[int] = None) -> dict:
+    fundus_prep, image = state
+    _, bbox, center, radius = fundus_prep.get_mask(image, max_size)
+    return {'center': [float(value) for value in center], 'radius': float(radius), 'bbox': [float(value) for value in bbox]}
+
+
+def _fractal_dimension(stage: Stage, sample: dict):
+    return stage.module('retipy.tortuosity_measures'), sample['vessel'].astype(np.float64)
+
+
+def _run_fractal_dimension(state) -> dict:
+    tortuosity_measures, vessel = state
+    return {'fractal_dimension': float(tortuosity_measures.fractal_dimension(vessel))}
+
+
+def _retina(stage: Stage, sample: dict, folder: str):
+    # the Retina of the skeleton of a sample, reading its vessel map and resolution from a results tree
+    from skimage.morphology import skeletonize
+
+    retina = stage.module('retipy.retina')
+    name = _sample_name(sample)
+    skeleton = skeletonize(sample['vessel']).astype(np.uint8)
+    return retina, retina.Retina(skeleton, name, os.path.join(folder, 'M2/binary_vessel/binary_process', name))
+
+
+def _detect_vessel_border(stage: Stage, sample: dict):
+    retina, image = _retina(stage, sample, _tree_folder())
+    return retina, image
+
+
+def _run_detect_vessel_border(state) -> dict:
+    retina, image = state
+    vessels = retina.detect_vessel_border(image)
+    return {'vessels': len(vessels), 'pixels': [len(vessel[0]) for vessel in vessels],
+            'first_pixels': [[int(vessel[0][0]), int(vessel[1][0])] for vessel in vessels]}
+
+
+def _width_measurement(stage: Stage, sample: dict):
+    retina, image = _retina(stage, sample, _tree_folder())
+    vessels = [vessel for vessel in retina.detect_vessel_border(image) if len(vessel[0]) > 10]
+    return stage.module('retipy.tortuosity_measures'), image, vessels
+
+
+def _run_width_measurement(state) -> dict:
+    tortuosity_measures, image, vessels = state
+    widths = [tortuosity_measures.width_measurement(vessel[0], vessel[1], image) for vessel in vessels]
+    return {'mean_widths': [sum(width) / len(width) for width in widths], 'measures': sum(len(width) for width in widths)}
+
+
+def _filter_frag(stage: Stage, sample):
+    # a copy of the vessel maps, filter_frag writes its outputs next to them
+    data_path = tempfile.mkdtemp(prefix='binary_vessel_', dir=str(Path(_tree_folder()).parent)) + '/'
+    shutil.copytree(os.path.join(_tree_folder(), 'M2/binary_vessel/resize_binary'), data_path + 'resize_binary')
+    return stage.module('test_outside_integrated'), data_path
+
+
+def _run_filter_frag(state) -> dict:
+    test_outside, data_path = state
+    fd, names, vd, width = test_outside.filter_frag(data_path)
+    return {'names': len(names), 'fractal_dimension': [float(value) for value in fd],
+            'vessel_density': [float(value) for value in vd], 'width': [float(value) for value in width]}
+
+
+def _optic_disc_centre(stage: Stage, sample):
+    generate_av_results = stage.module('generate_av_results')
+    folder = _tree_folder()
+    generate_av_results.AUTOMORPH_DATA = str(Path(folder).parent)
+    shutil.rmtree(os.path.join(folder, 'M3'), ignore_errors=True)
+    return generate_av_results, folder
+
+
+def _run_optic_disc_centre(state) -> dict:
+    generate_av_results, folder = state
+    generate_av_results.optic_disc_centre(folder + '/M2/optic_disc_cup/raw/')
+    outputs = {}
+    for centred in ('Disc_centred', 'Macular_centred'):
+        table = pd.read_csv(os.path.join(folder, 'M3', centred, 'Disc_cup_results.csv'))
+        for column in table.columns.drop('Name'):
+            outputs[f'{centred}.{column}'] = [float(value) for value in table[column]]
+        outputs[f'{centred}.images'] = len(table)
+    return outputs
+
+
+def _ensemble(name: str):
+    def setup(stage: Stage, sample):
+        import torch
+
+        models = _PIPELINE.ensemble(name)
+        if hasattr(models, 'device'):
+            device = models.device
+        elif not hasattr(models[0], 'parameters'):
+            # the ONNX Runtime graphs run on the CPU
+            device = 'cpu'
+        elif isinstance(models[0], torch.jit.ScriptModule):
+            # the frozen members keep no parameters, they are on the device the stages pick first
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        else:
+            device = next(models[0].parameters()).device
+        x = ensemble_input(name, device)
+        if name != 'vessel':
+            from automorph_optimize import input_memory_format
+
+            # the layout the loops of the stages give the members
+            x = x.contiguous(memory_format=input_memory_format(models))
+        return models, x
+    return setup
+
+
+def _run_ensemble(name: str):
+    def run(state) -> dict:
+        import torch
+        import torch.nn.functional as F
+        from automorph_ensemble import RunningMoments
+
+        models, x = state
+        with torch.no_grad():
+            if name == 'vessel':
+                mean, std = models.mean_std(x, activation=torch.sigmoid)
+            else:
+                moments = RunningMoments()
+                if name == 'artery_vein':
+                    for net_G, net_G_A, net_G_V in zip(models[0::3], models[1::3], models[2::3]):
+                        _, fusion_A = net_G_A(x)
+                        _, fusion_V = net_G_V(x)
+                        prediction = net_G(x, fusion_A.detach(), fusion_V.detach())[0]
+                        moments.update(F.softmax(prediction, dim=1))
+                else:
+                    for model in models:
+                        prediction = model(x)
+                        if name == 'disc_cup':
+                            prediction = prediction[1]
+                        moments.update(F.softmax(prediction, dim=1))
+                mean, std = moments.mean, moments.std()
+        dims = [dim for dim in range(mean.dim()) if dim != 1]
+        return {'mean': mean.mean(dim=dims).cpu().tolist(), 'std': std.mean(dim=dims).cpu().tolist(),
+                'positive': (mean > 0.5).float().mean(dim=dims).cpu().tolist()}
+    return run
+
+
+def _sample_name(sample: dict) -> str:
+    return f"synthetic-{sample['vessel'].shape[0]}.png"
+
+
+_TREE = {}  # type: Dict[str, str]
+_PIPELINE = AutoMorphPipeline()
+
+
+def _tree_folder() -> str:
+    # the results tree of the synthetic vessel maps, written once per benchmark run
+    if 'folder' not in _TREE:
+        base = tempfile.mkdtemp(prefix='automorph_benchmark_')
+        folder = os.path.join(base, 'Results')
+        write_results_tree(folder, vessel_samples())
+        _TREE['folder'] = folder
+    return _TREE['folder']
+
+
+def _tree_samples() -> dict:
+    # the steps that go through the whole results tree at once
+    return {'synthetic-' + '+'.join(str(size) for size in VESSEL_SIZES): None}
+
+
+BENCHMARKS = [
+    Benchmark('get_mask', 'M0_Preprocess', fundus_samples, _get_mask, _run_get_mask),
+    # the same golden values as get_mask, the subsampled mask only locates the rim
+    Benchmark('get_mask_max_size', 'M0_Preprocess', fundus_samples, _get_mask,
+              lambda state: _run_get_mask(state, MASK_MAX_SIZE)),
+    Benchmark('fractal_dimension', 'M3_feature_zone/retipy', vessel_samples, _fractal_dimension, _run_fractal_dimension),
+    Benchmark('detect_vessel_border', 'M3_feature_zone/retipy', vessel_samples, _detect_vessel_border,
+              _run_detect_vessel_border),
+    Benchmark('width_measurement', 'M3_feature_zone/retipy', vessel_samples, _width_measurement, _run_width_measurement),
+    # no golden values yet, they need torch
+    Benchmark('filter_frag', 'M2_Vessel_seg', _tree_samples, _filter_frag, _run_filter_frag, default=False),
+    Benchmark('optic_disc_centre', 'M2_lwnet_disc_cup', _tree_samples, _optic_disc_centre, _run_optic_disc_centre,
+              default=False),
+] + [
+    Benchmark(f'{name}_ensemble', stage, lambda: {f'synthetic-{ENSEMBLE_SIZES[name]}': None}, _ensemble(name),
+              _run_ensemble(name), default=False)
+    for name, stage in (('quality', 'M1_Retinal_Image_quality_EyePACS'), ('vessel', 'M2_Vessel_seg'),
+                        ('artery_vein', 'M2_Artery_vein'), ('disc_cup', 'M2_lwnet_disc_cup'))
+]
+
+
+def compare(outputs: dict, golden: dict, rtol: float, atol: float) -> List[str]:
+    """The outputs that differ from their golden values, empty when all of them match."""
+    differences = []
+    for key in sorted(set(outputs) | set(golden)):
+        if key not in outputs or key not in golden:
+            differences.append(f'{key}: missing')
+            continue
+        value, expected = np.asarray(outputs[key], dtype=float), np.asarray(golden[key], dtype=float)
+        if value.shape != expected.shape:
+            differences.append(f'{key}: shape {value.shape} instead of {expected.shape}')
+        elif not np.allclose(value, expected, rtol=rtol, atol=atol, equal_nan=True):
+            worst = float(np.max(np.abs(value - expected))) if value.size else 0.0
+            differences.append(f'{key}: differs by up to {worst:.3g}')
+    return differences
+
+
+def run_benchmark(benchmark: Benchmark, golden: dict, repeat: int, update: bool) -> List[dict]:
+    """
+    Times a benchmark on each of its samples and checks its outputs.
+
+    :param golden: the golden values of the benchmark, by sample, updated in place with update
+    :param repeat: the number of timed runs, after one untimed warm-up run
+    :param update: record the outputs as the new golden values instead of checking them
+    :return: one result per sample, with its 'status' among ok, changed, new, updated and skipped
+    """
+    stage = Stage(benchmark.stage)
+    results = []
+    try:
+        with stage.active():
+            samples = benchmark.samples()
+            for sample_name, sample in samples.items():
+                times = []
+                outputs = None
+                for index in range(repeat + 1):
+                    state = benchmark.setup(stage, sample)
+                    start = time.perf_counter()
+                    outputs = benchmark.run(state)
+                    if index:
+                        times.append(time.perf_counter() - start)
+                outputs = json.loads(json.dumps(outputs))
+                result = {'benchmark': benchmark.name, 'sample': sample_name, 'median_s': statistics.median(times),
+                          'min_s': min(times), 'images_per_s': 1.0 / statistics.median(times)}
+                if update:
+                    result['status'] = 'updated'
+                    golden[sample_name] = outputs
+                elif sample_name not in golden:
+                    result['status'] = 'new'
+                else:
+                    differences = compare(outputs, golden[sample_name], benchmark.rtol, benchmark.atol)
+                    result['status'] = 'changed' if differences else 'ok'
+                    if differences:
+                        result['differences'] = differences
+                results.append(result)
+    except (ImportError, FileNotFoundError) as error:
+        # the stage needs torch or checkpoints that are not there
+        results.append({'benchmark': benchmark.name, 'sample': '-', 'status': 'skipped',
+                        'reason': f'{type(error).__name__}: {error}'})
+    return results
+
+
+def end_to_end(count: int, width: int, skip: Dict[str, bool], golden: dict, update: bool) -> dict:
+    """
+    Runs the pipeline on a folder of synthetic photographs and reports its throughput.
+
+    The crop of every image and, when M3 runs, the features of the final tables are checked
+    against their golden values.
+
+    :param count: the number of photographs, drawn with consecutive seeds
+    :param width: their width, with the 3:2 shape of the samples
+    :param skip: the no_process, no_quality, no_segmentation and no_feature flags of the run
+    """
+    base = tempfile.mkdtemp(prefix='automorph_end_to_end_')
+    try:
+        image_folder = os.path.join(base, 'images')
+        result_folder = os.path.join(base, 'Results')
+        trace_dir = os.path.join(base, 'trace')
+        os.makedirs(image_folder)
+        height = int(round(width * 2 / 3))
+        for index in range(count):
+            cv2.imwrite(os.path.join(image_folder, f'synthetic_{index:04d}.png'),
+                        synthetic_fundus(width, height, SEED + index)['image'])
+
+        start = time.perf_counter()
+        _PIPELINE.run(image_folder, result_folder, trace_dir=trace_dir, **skip)
+        wall = time.perf_counter() - start
+        with open(os.path.join(trace_dir, 'timing.json'), encoding='utf-8') as handle:
+            steps = json.load(handle)['steps']
+
+        outputs = {}
+        crop_info = os.path.join(result_folder, 'M0', 'crop_info.csv')
+        if os.path.exists(crop_info):
+            table = pd.read_csv(crop_info).sort_values('Name')
+            for column in ('centre_w', 'centre_h', 'radius'):
+                outputs[f'crop_info.{column}'] = [float(value) for value in table[column]]
+        for features in ('Disc_Features.csv', 'Macular_Features.csv'):
+            path = os.path.join(result_folder, 'M3', features)
+            if os.path.exists(path):
+                table = pd.read_csv(path).sort_values('Name')
+                for column in table.select_dtypes('number').columns:
+                    outputs[f'{features}.{column}'] = [float(value) for value in table[column]]
+
+        flags = ('no_process', 'no_quality', 'no_segmentation', 'no_feature')
+        key = f'{count}x{width}/' + ','.join(stage for stage, flag in zip(('M0', 'M1', 'M2', 'M3'), flags)
+                                             if not skip.get(flag))
+        # the stages, M2 being split in its three segmentations, without their sub-steps
+        stages = {name: {'wall_s': step['wall_s'], 'images_per_s': step['images_per_s']}
+                  for name, step in steps.items() if name.count('.') == (1 if name.startswith('M2.') else 0)}
+        result = {'benchmark': 'end_to_end', 'sample': key, 'wall_s': wall, 'images_per_s': count / wall,
+                  'stages': stages}
+        if update:
+            result['status'] = 'updated'
+            golden[key] = outputs
+        elif key not in golden:
+            result['status'] = 'new'
+        else:
+            differences = compare(outputs, golden[key], 1e-6, 1e-6)
+            result['status'] = 'changed' if differences else 'ok'
+            if differences:
+                result['differences'] = differences
+        return result
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def load_golden(path: Path = GOLDEN_FILE) -> dict:
+    if not path.is_file():
+        return {}
+    with path.open(encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+def save_golden(golden: dict, path: Path = GOLDEN_FILE):
+    # one line per benchmark and sample, so a change of the golden values reads well in a diff
+    lines = []
+    for name, samples in sorted(golden.items()):
+        entries = [f'    {json.dumps(sample)}: {json.dumps(outputs, sort_keys=True)}' for sample, outputs in sorted(samples.items())]
+        lines.append(f'  {json.dumps(name)}: {{\n' + ',\n'.join(entries) + '\n  }')
+    with path.open('w', encoding='utf-8') as handle:
+        handle.write('{\n' + ',\n'.join(lines) + '\n}\n')
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AutoMorph steps on synthetic and sample images, '
+                                                 'checking their outputs against golden values.')
+    parser.add_argument('--only', nargs='+', default=None, choices=[benchmark.name for benchmark in BENCHMARKS],
+                        help='Only run these micro-benchmarks, also the ones without golden values.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of every benchmark, after a warm-up run.')
+    parser.add_argument('--end_to_end', type=int, default=0, metavar='N',
+                        help='Also run the pipeline on N synthetic photographs, no micro-benchmark runs unless --only is given.')
+    parser.add_argument('--width', type=int, default=FUNDUS_WIDTHS[-1], help='Width of the end-to-end photographs.')
+    parser.add_argument('--no_process', action='store_true', help='End-to-end run without the preprocessing stage.')
+    parser.add_argument('--no_quality', action='store_true', help='End-to-end run without the quality stage.')
+    parser.add_argument('--no_segmentation', action='store_true', help='End-to-end run without the segmentation stage.')
+    parser.add_argument('--no_feature', action='store_true', help='End-to-end run without the feature stage.')
+    parser.add_argument('--backend', default='torch', choices=BACKENDS,
+                        help='Run the ensembles with PyTorch, or with the ONNX Runtime graphs of automorph_onnx.py.')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Fold the BatchNorm layers of the members of the ensembles, see automorph_optimize.py.')
+    parser.add_argument('--torchscript', action='store_true',
+                        help='Freeze the members of the ensembles with TorchScript, see automorph_optimize.py.')
+    parser.add_argument('--update_golden', action='store_true',
+                        help='Record the outputs as the new golden values instead of checking them.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = get_args(argv)
+    _PIPELINE.backend = args.backend
+    _PIPELINE.torchscript = args.torchscript
+    _PIPELINE.optimize = args.optimize
+    golden = load_golden()
+    results = []
+
+    if args.only or not args.end_to_end:
+        for benchmark in BENCHMARKS:
+            if benchmark.name not in args.only if args.only else not benchmark.default:
+                continue
+            results.extend(run_benchmark(benchmark, golden.setdefault(benchmark.name, {}), args.repeat,
+                                         args.update_golden))
+    if args.end_to_end:
+        skip = {'no_process': args.no_process, 'no_quality': args.no_quality,
+                'no_segmentation': args.no_segmentation, 'no_feature': args.no_feature}
+        results.append(end_to_end(args.end_to_end, args.width, skip, golden.setdefault('end_to_end', {}),
+                                  args.update_golden))
+    if 'folder' in _TREE:
+        shutil.rmtree(Path(_TREE['folder']).parent, ignore_errors=True)
+
+    print(f"{'benchmark':<24} {'sample':<28} {'median ms':>10} {'images/s':>10}  status")
+    for result in results:
+        median = result.get('median_s', result.get('wall_s'))
+        timing = f"{1000 * median:>10.1f} {result['images_per_s']:>10.2f}" if median is not None else f"{'':>10} {'':>10}"
+        print(f"{result['benchmark']:<24} {result['sample']:<28} {timing}  {result['status']}")
+        for name, stage in result.get('stages', {}).items():
+            rate = f"{stage['images_per_s']:>10.2f}" if stage['images_per_s'] else ''
+            print(f"    {name:<49} {1000 * stage['wall_s']:>10.1f} {rate}")
+        for line in result.get('differences', []) + ([result['reason']] if 'reason' in result else []):
+            print(f'    {line}')
+
+    if args.update_golden:
+        save_golden({name: values for name, values in golden.items() if values})
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2)
+    new = [result for result in results if result['status'] == 'new']
+    if new:
+        # a benchmark without golden values checks nothing, they are recorded on purpose
+        print(f'{len(new)} result(s) without golden values, record them with --update_golden')
+    return 1 if any(result['status'] in ('changed', 'new') for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Inference helpers for the model ensembles of the M1 and M2 stages."""
+from __future__ import annotations
+
+import copy
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class RunningMoments(object):
+    """
+    Mean and variance of the member outputs of an ensemble, gathered as the members are evaluated.
+
+    The outputs stay on their device and are reduced with the arithmetic of the former loops: their
+    sum in member order divided by the count, then the sum of their squared deviations from that
+    mean in member order, so the maps and the sd columns are those of the original code.
+    """
+
+    def __init__(self):
+        self._outputs = []  # type: List[torch.Tensor]
+        self._mean = None  # type: Optional[torch.Tensor]
+
+    @property
+    def count(self) -> int:
+        """The number of member outputs added."""
+        return len(self._outputs)
+
+    def update(self, x: torch.Tensor):
+        """
+        Adds the output of one member.
+
+        :param x: the output, every member has to give the same shape
+        """
+        self._outputs.append(x.detach().float())
+        self._mean = None
+
+    def update_stacked(self, xs: torch.Tensor):
+        """
+        Adds the outputs of several members at once.
+
+        :param xs: the outputs stacked on the leading dimension, in member order
+        """
+        self._outputs.extend(xs.detach().float().unbind(0))
+        self._mean = None
+
+    @property
+    def mean(self) -> torch.Tensor:
+        """The mean of the outputs."""
+        if self._mean is None:
+            total = self._outputs[0].clone()
+            for x in self._outputs[1:]:
+                total.add_(x)
+            self._mean = total / self.count
+        return self._mean
+
+    def variance(self, correction: int = 0) -> torch.Tensor:
+        """The variance, by default the population one as numpy.std and the former uncertainty maps used."""
+        mean = self.mean
+        total = torch.square(mean - self._outputs[0])
+        for x in self._outputs[1:]:
+            total.add_(torch.square(mean - x))
+        return total / (self.count - correction)
+
+    def std(self, correction: int = 0) -> torch.Tensor:
+        """The standard deviation, see variance()."""
+        return torch.sqrt(self.variance(correction))
+
+
+class FusedEnsemble(object):
+    """
+    Ensemble of models sharing one architecture, evaluated in a single batched call.
+
+    The weights and buffers of the members are stacked along a new leading dimension and the
+    architecture is mapped over it with torch.func.vmap, so every layer runs once for the whole
+    ensemble instead of once per member. The members should already be on their device and in eval
+    mode, their stacked copies replace them.
+
+    :param models: the members of the ensemble, all instances of the same class and configuration
+    :param chunk_size: optional number of members evaluated at once, to bound the activation memory,
+                       by default the whole ensemble runs in one call
+    """
+
+    def __init__(self, models: Sequence[nn.Module], chunk_size: Optional[int] = None):
+        models = list(models)
+        if not models:
+            raise ValueError('the ensemble needs at least one model')
+        if any(type(model) is not type(models[0]) for model in models):
+            raise ValueError('every model of the ensemble must have the same architecture')
+        self._params, self._buffers = stack_module_state(models)
+        for params in self._params.values():
+            params.requires_grad_(False)
+        # the architecture only, the weights come from the stacked tensors at every call
+        self._base = copy.deepcopy(models[0]).to('meta')
+        self._base.eval()
+        self.chunk_size = chunk_size
+        self._size = len(models)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def device(self) -> torch.device:
+        """The device the stacked weights are on."""
+        return next(iter(self._params.values())).device
+
+    def members(self) -> List[nn.Module]:
+        """Separate copies of the members, in eval mode on the device of the ensemble, e.g. to export them."""
+        models = []
+        for index in range(self._size):
+            model = copy.deepcopy(self._base).to_empty(device=self.device)
+            with torch.no_grad():
+                for name, tensor in model.named_parameters():
+                    tensor.copy_(self._params[name][index])
+                for name, tensor in model.named_buffers():
+                    tensor.copy_(self._buffers[name][index])
+            models.append(model.eval())
+        return models
+
+    def _member_forward(self, params, buffers, x):
+        return functional_call(self._base, (params, buffers), (x,))
+
+    def _chunks(self, x: torch.Tensor) -> Iterator[torch.Tensor]:
+        forward = vmap(self._member_forward, in_dims=(0, 0, None))
+        chunk_size = self.chunk_size or self._size
+        for start in range(0, self._size, chunk_size):
+            members = slice(start, start + chunk_size)
+            yield forward({name: value[members] for name, value in self._params.items()},
+                          {name: value[members] for name, value in self._buffers.items()}, x)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Evaluates every member on the same batch.
+
+        :param x: the input batch
+        :return: the outputs of the members stacked on a new leading dimension, in member order
+        """
+        return torch.cat(list(self._chunks(x)), dim=0)
+
+    def mean_std(self, x: torch.Tensor,
+                 activation: Callable[[torch.Tensor], torch.Tensor] = torch.sigmoid) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Mean and population standard deviation of the activated member outputs, computed on the
+        device the ensemble runs on.
+
+        :param x: the input batch
+        :param activation: applied to the output of every member before the reduction
+        :return: the mean and the standard deviation, both shaped like the output of one member
+        """
+        moments = RunningMoments()
+        for outputs in self._chunks(x):
+            moments.update_stacked(activation(outputs))
+        return moments.mean, moments.std()
@@ -0,0 +1,283 @@
+"""Run manifest of the incremental AutoMorph runs, and the helpers that move per-image results."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+STAGES = ('M0', 'M1', 'M2', 'M3')
+MANIFEST_NAME = 'automorph_manifest.json'
+
+# suffixes the stages append to the image name for the per-class maps (uncertainty of M2)
+OUTPUT_SUFFIXES = ('_artery', '_vein', '_disc', '_cup')
+
+# files that make a model or a configuration version, larger ones are identified by size and mtime
+_FINGERPRINT_SUFFIXES = {'.py', '.pth', '.pt', '.cfg', '.json', '.yaml', '.yml', '.csv', '.onnx'}
+# the exported graphs only count for the backend that runs them, the pipeline adds their folder itself,
+# the quantized ones are not run by the pipeline
+_IGNORED_FOLDERS = {'__pycache__', 'test_csv', 'outside_test', 'onnx', 'onnx_int8'}
+_SMALL_FILE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(paths: Iterable[Path], config: Optional[dict] = None) -> str:
+    """
+    Fingerprint of the code, the checkpoints and the configuration of a stage.
+
+    :param paths: the stage folders and files, every model, config and source file under them counts
+    :param config: the options of the stage that change its results
+    """
+    digest = hashlib.sha256(json.dumps(config or {}, sort_keys=True).encode())
+    for root in paths:
+        root = Path(root)
+        if root.is_file():
+            files = [root]
+        else:
+            files = sorted(path for path in root.rglob('*')
+                           if path.is_file() and path.suffix in _FINGERPRINT_SUFFIXES
+                           and not any(part in _IGNORED_FOLDERS or part.startswith(('.', 'Ensemble_exp'))
+                                       for part in path.relative_to(root).parts[:-1]))
+        for path in files:
+            stat = path.stat()
+            digest.update(str(path.relative_to(root.parent)).encode())
+            if stat.st_size <= _SMALL_FILE:
+                digest.update(file_digest(str(path)).encode())
+            else:
+                digest.update('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def chain_key(*parts: str) -> str:
+    """Key of a stage result, from the key of its input and the fingerprint of the stage."""
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def image_stem(name: str) -> str:
+    """The image name without folder and extension, as every stage names its outputs."""
+    return os.path.splitext(os.path.basename(str(name)))[0]
+
+
+class RunManifest(object):
+    """
+    Record of the input images of a results folder and of the stage results computed for them.
+
+    For every image it keeps the content digest of the input, with the size and mtime used to
+    avoid hashing unchanged files again, and for every stage the key of the result stored in the
+    results folder.
+
+    :param path: the manifest file
+    :param images: the records of the images, by file name
+    """
+
+    def __init__(self, path: str, images: Optional[Dict[str, dict]] = None):
+        self.path = Path(path)
+        self.images = {} if images is None else images
+
+    @classmethod
+    def load(cls, result_folder: str) -> 'RunManifest':
+        """Loads the manifest of a results folder, an empty one when there is none yet."""
+        path = Path(result_folder) / MANIFEST_NAME
+        if not path.is_file():
+            return cls(path)
+        with path.open(encoding='utf-8') as handle:
+            return cls(path, json.load(handle).get('images', {}))
+
+    def save(self):
+        """Writes the manifest atomically."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=str(self.path.parent), prefix=self.path.name, suffix='.tmp',
+                                         delete=False, encoding='utf-8') as handle:
+            json.dump({'version': 1, 'images': self.images}, handle)
+        os.replace(handle.name, str(self.path))
+
+    def scan(self, image_folder: str, num_workers: int = 8) -> Dict[str, dict]:
+        """
+        Digests of the images of a folder, only the new or modified files are read.
+
+        :return: for every image file name, its 'digest', 'size' and 'mtime_ns'
+        """
+        entries = sorted((entry for entry in os.scandir(image_folder) if entry.is_file()), key=lambda entry: entry.name)
+        scanned = {}
+        pending = []
+        for entry in entries:
+            stat = entry.stat()
+            record = self.images.get(entry.name, {})
+            scanned[entry.name] = {'digest': record.get('digest'), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if record.get('size') != stat.st_size or record.get('mtime_ns') != stat.st_mtime_ns or not record.get('digest'):
+                pending.append(entry)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for entry, digest in zip(pending, executor.map(lambda entry: file_digest(entry.path), pending)):
+                scanned[entry.name]['digest'] = digest
+        return scanned
+
+    def stage_keys(self, name: str) -> Dict[str, str]:
+        """The keys of the stage results recorded for an image."""
+        return self.images.get(name, {}).get('stages', {})
+
+    def record(self, name: str, scanned: dict, stage_keys: Dict[str, str]):
+        """Records the input of an image and the keys of the stage results just computed for it."""
+        record = self.images.setdefault(name, {})
+        record.update(scanned)
+        record.setdefault('stages', {}).update(stage_keys)
+
+    def forget(self, name: str):
+        """Removes an image from the manifest."""
+        self.images.pop(name, None)
+
+
+def stage_files(result_folder: str, stage: str, stems: Set[str]) -> List[Path]:
+    """
+    The per-image files a stage wrote for the given images, CSV tables excluded.
+
+    :param result_folder: the results folder
+    :param stage: the stage folder, one of STAGES
+    :param stems: the image names without extension
+    """
+    root = Path(result_folder) / stage
+    if not root.is_dir() or not stems:
+        return []
+    found = []
+    for path in root.rglob('*'):
+        if path.suffix == '.csv' or not path.is_file():
+            continue
+        stem = path.stem
+        if stem in stems or any(stem.endswith(suffix) and stem[:-len(suffix)] in stems for suffix in OUTPUT_SUFFIXES):
+            found.append(path)
+    return found
+
+
+def stage_tables(result_folder: str, stage: str) -> List[Path]:
+    """The CSV tables of a stage with one row per image, keyed by their Name column."""
+    root = Path(result_folder) / stage
+    if not root.is_dir():
+        return []
+    return sorted(path for path in root.rglob('*.csv') if 'Name' in pd.read_csv(path, nrows=0).columns)
+
+
+def _read_table(path: Path) -> pd.DataFrame:
+    # everything as text, so the rows that are kept are written back unchanged
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def _reroot(name: str, source_folder: str, target_folder: str) -> str:
+    # names holding a path into a results folder, like the M0 images of results_ensemble.csv
+    if os.sep not in name:
+        return name
+    if name.startswith(source_folder + os.sep):
+        return target_folder + name[len(source_folder):]
+    marker = os.sep + 'Results' + os.sep
+    if marker in name:
+        return os.path.join(target_folder, name.split(marker, 1)[1])
+    return name
+
+
+def remove_results(result_folder: str, stage: str, stems: Set[str]):
+    """Removes the files and the table rows of the given images from a stage."""
+    for path in stage_files(result_folder, stage, stems):
+        path.unlink()
+    for table in stage_tables(result_folder, stage):
+        rows = _read_table(table)
+        keep = ~rows['Name'].map(image_stem).isin(stems)
+        if not keep.all():
+            rows[keep].to_csv(table, index=False, encoding='utf8')
+
+
+def transfer_results(source_folder: str, target_folder: str, stage: str, stems: Optional[Set[str]] = None,
+                     link: bool = False):
+    """
+    Moves the results of a stage from a results folder to another one, merging the table rows.
+
+    The rows of the target tables that belong to the transferred images are replaced, the others
+    are kept, and the tables are sorted by name.
+
+    :param source_folder: the results folder the results come from
+    :param target_folder: the results folder the results go to
+    :param stage: the stage folder, one of STAGES
+    :param stems: only the results of these images, all of them by default
+    :param link: hard link the files instead of moving them, to seed a run with earlier results
+    """
+    source_root = Path(source_folder) / stage
+    if not source_root.is_dir():
+        return
+    if stems is None:
+        files = [path for path in source_root.rglob('*') if path.is_file() and path.suffix != '.csv']
+    else:
+        files = stage_files(source_folder, stage, stems)
+    for path in files:
+        target = Path(target_folder) / path.relative_to(source_folder)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if link:
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
+        else:
+            os.replace(path, target)
+
+    for table in stage_tables(source_folder, stage):
+        rows = _read_table(table)
+        if stems is not None:
+            rows = rows[rows['Name'].map(image_stem).isin(stems)]
+        rows = rows.assign(Name=rows['Name'].map(lambda name: _reroot(name, str(source_folder), str(target_folder))))
+        _merge_table(Path(target_folder) / table.relative_to(source_folder), [rows])
+
+
+def _merge_table(target: Path, frames: List[pd.DataFrame]):
+    # the rows of the target that belong to the images of the frames are replaced
+    rows = pd.concat(frames, ignore_index=True).fillna('')
+    if target.is_file():
+        previous = _read_table(target)
+        previous = previous[~previous['Name'].map(image_stem).isin(set(rows['Name'].map(image_stem)))]
+        rows = pd.concat([previous, rows], ignore_index=True).fillna('')
+    target.parent.mkdir(parents=True, exist_ok=True)
+    rows.sort_values('Name', kind='stable').to_csv(target, index=False, encoding='utf8')
+
+
+def merge_results(source_folders: List[str], target_folder: str, stage: str):
+    """
+    Moves the results of a stage from several results folders holding disjoint images to another
+    one, like transfer_results for each of them but writing every table once.
+
+    :param source_folders: the results folders the results come from, their rows are merged in this order
+    :param target_folder: the results folder the results go to
+    :param stage: the stage folder, one of STAGES
+    """
+    tables = {}  # type: Dict[Path, List[pd.DataFrame]]
+    for source_folder in source_folders:
+        source_root = Path(source_folder) / stage
+        if not source_root.is_dir():
+            continue
+        for path in source_root.rglob('*'):
+            if path.is_file() and path.suffix != '.csv':
+                target = Path(target_folder) / path.relative_to(source_folder)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(path, target)
+        for table in stage_tables(source_folder, stage):
+            rows = _read_table(table)
+            rows = rows.assign(Name=rows['Name'].map(lambda name: _reroot(name, str(source_folder), str(target_folder))))
+            tables.setdefault(table.relative_to(source_folder), []).append(rows)
+    for relative_path, frames in sorted(tables.items()):
+        _merge_table(Path(target_folder) / relative_path, frames)
+
+
+def first_stale_stage(keys: Dict[str, str], recorded: Dict[str, str], stages: Tuple[str, ...]) -> Optional[int]:
+    """Index in STAGES of the first of the given stages whose recorded result key differs, None if all match."""
+    for index, stage in enumerate(STAGES):
+        if stage in stages and recorded.get(stage) != keys[stage]:
+            return index
+    return None
@@ -0,0 +1,99 @@
+"""Per-process cache of the per-image tables the stages look images up in, M0/crop_info.csv, resolution_information.csv and M2/optic_disc_cup/zone_info.csv."""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+import pandas as pd
+
+# centring and optic disc of every image, written by the disc/cup stage of M2
+ZONE_INFO_PATH = os.path.join('M2', 'optic_disc_cup', 'zone_info.csv')
+
+_lock = threading.Lock()
+_tables = {}  # type: Dict[Tuple[str, str], Tuple[Tuple[int, int], ImageTable]]
+
+
+class ImageTable(object):
+    """
+    The columns of a per-image table as numpy arrays, and the row of every image name.
+
+    An image listed more than once keeps its first row, as the boolean-mask lookups it replaces did.
+
+    :param frame: the table
+    :param name_column: the column of the image names
+    """
+
+    def __init__(self, frame: pd.DataFrame, name_column: str):
+        self.name_column = name_column
+        self.columns = {column: frame[column].to_numpy() for column in frame.columns}
+        self._rows = {}  # type: Dict[str, int]
+        for row, name in enumerate(frame[name_column].astype(str)):
+            self._rows.setdefault(name, row)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._rows
+
+    def get(self, name: str, column: str) -> Any:
+        """
+        The value of an image in a column.
+
+        :raises KeyError: when the image is not in the table
+        """
+        row = self._rows.get(name)
+        if row is None:
+            raise KeyError(f'{name} is not in the {self.name_column} column of the table')
+        return self.columns[column][row]
+
+    def mapping(self, column: str) -> Dict[str, Any]:
+        """The values of a column by image name."""
+        values = self.columns[column]
+        return {name: values[row] for name, row in self._rows.items()}
+
+
+def load_table(path: str, name_column: str = 'Name') -> ImageTable:
+    """
+    Reads a per-image CSV table once per process.
+
+    The table is parsed again only when the file changed since, e.g. when M0 runs again in the same
+    process, so a lookup only costs a stat of the file.
+
+    :param path: the CSV file
+    :param name_column: the column of the image names
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    key = (path, name_column)
+    with _lock:
+        cached = _tables.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    table = ImageTable(pd.read_csv(path), name_column)
+    with _lock:
+        _tables[key] = (version, table)
+    return table
+
+
+def crop_info(result_folder: str) -> ImageTable:
+    """The M0/crop_info.csv table of a results folder, by image name."""
+    return load_table(os.path.join(result_folder, 'M0', 'crop_info.csv'))
+
+
+def zone_info(result_folder: str) -> ImageTable:
+    """The M2/optic_disc_cup/zone_info.csv table of a results folder, by image name."""
+    return load_table(os.path.join(result_folder, ZONE_INFO_PATH))
+
+
+def resolution_information(path: str) -> ImageTable:
+    """A resolution_information.csv file, by image file name."""
+    return load_table(path, name_column='fundus')
+
+
+def clear():
+    """Forgets every table read so far."""
+    with _lock:
+        _tables.clear()
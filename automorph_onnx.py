@@ -0,0 +1,346 @@
+"""Export of the model ensembles to ONNX, and their evaluation with ONNX Runtime on the CPU.
+
+Every member of an ensemble is exported to its own graph, <stage>/onnx/<ensemble>_<index>.onnx,
+in the order the load_models function of its stage returns the members: the eight EfficientNets of
+the quality grading, the ten vessel Segmenters, the main, artery and vein generators of the eight
+artery/vein triplets one after the other, and the eight disc/cup W-Nets. The batch dimension of
+the graphs is dynamic, their other dimensions are the input size of the stage.
+
+With the onnx backend, a stage gets OnnxModel stand-ins for its torch members, called the same way
+on torch tensors, and the vessel stage an OnnxEnsemble in place of its FusedEnsemble. The graphs
+are optimised by ONNX Runtime when they are loaded.
+
+After exporting a graph, the export checks that ONNX Runtime gives the outputs of the torch model
+on a synthetic fundus, at another batch size than the one it was traced with. The check of every
+graph of an ensemble is recorded next to them in <ensemble>_parity.json, with the digest of the
+graph, and the backends only load graphs whose record shows they passed: graphs exported with
+--no_check, that failed or that were replaced since are refused.
+
+    python automorph_onnx.py                           # export and check every ensemble
+    python automorph_onnx.py --only vessel artery_vein --rtol 1e-3 --atol 1e-4
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+BACKENDS = ('torch', 'onnx')
+# the folder of the graphs, in the stage folder of their ensemble
+ONNX_FOLDER = 'onnx'
+OPSET_VERSION = 17
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as error:
+        raise ImportError('the onnx backend needs ONNX Runtime, pip install onnxruntime') from error
+    return onnxruntime
+
+
+def graph_path(folder: str, name: str, index: int) -> str:
+    """The graph of a member of an ensemble."""
+    return os.path.join(folder, f'{name}_{index}.onnx')
+
+
+def parity_path(folder: str, name: str) -> str:
+    """The record of the parity check of the graphs of an ensemble."""
+    return os.path.join(folder, f'{name}_parity.json')
+
+
+def graph_paths(folder: str, name: str) -> List[str]:
+    """The graphs of every member of an ensemble, in member order."""
+    paths = glob.glob(os.path.join(folder, f'{name}_*.onnx'))
+    paths = [path for path in paths if Path(path).stem[len(name) + 1:].isdigit()]
+    if not paths:
+        raise FileNotFoundError(f'no ONNX graph of the {name} ensemble in {folder}, export them with automorph_onnx.py')
+    return sorted(paths, key=lambda path: int(Path(path).stem[len(name) + 1:]))
+
+
+class OnnxModel(object):
+    """
+    An exported member evaluated with ONNX Runtime, called like the torch model it was exported from.
+
+    :param path: the graph
+    :param num_threads: optional number of threads of every operator, ONNX Runtime picks it by default
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        onnxruntime = _onnxruntime()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self._session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self._input_names = [node.name for node in self._session.get_inputs()]
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        # the graphs always run on the CPU, see __call__
+        return self
+
+    def __call__(self, *inputs):
+        """
+        Evaluates the graph.
+
+        :param inputs: the torch tensors the model takes
+        :return: the output, or the tuple of the outputs, as float32 tensors on the device of the first input
+        """
+        import torch
+
+        feeds = {name: np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+                 for name, x in zip(self._input_names, inputs)}
+        outputs = [torch.from_numpy(output).to(inputs[0].device) for output in self._session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class OnnxEnsemble(object):
+    """
+    The exported members of an ensemble evaluated one after the other, with the interface of
+    automorph_ensemble.FusedEnsemble.
+
+    :param models: the members
+    """
+
+    def __init__(self, models: Sequence[OnnxModel]):
+        self._models = list(models)
+        if not self._models:
+            raise ValueError('the ensemble needs at least one model')
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    @property
+    def device(self):
+        import torch
+        return torch.device('cpu')
+
+    def __call__(self, x):
+        """The outputs of the members stacked on a new leading dimension, in member order."""
+        import torch
+        return torch.stack([model(x) for model in self._models])
+
+    def mean_std(self, x, activation: Optional[Callable] = None):
+        """Mean and population standard deviation of the activated member outputs, see FusedEnsemble.mean_std."""
+        import torch
+        from automorph_ensemble import RunningMoments
+
+        activation = activation or torch.sigmoid
+        moments = RunningMoments()
+        for model in self._models:
+            moments.update(activation(model(x)))
+        return moments.mean, moments.std()
+
+
+def write_parity(folder: str, name: str, results: Sequence[Tuple[str, float, bool]], rtol: float, atol: float):
+    """
+    Records the parity check of the graphs of an ensemble, see check_parity.
+
+    :param results: the graph, largest difference and parity of every member, as export_ensemble returns them
+    """
+    from automorph_manifest import file_digest
+
+    record = {'rtol': rtol, 'atol': atol,
+              'graphs': [{'graph': os.path.basename(path), 'sha256': file_digest(path),
+                          'max_difference': worst, 'ok': close} for path, worst, close in results]}
+    with open(parity_path(folder, name), 'w', encoding='utf-8') as handle:
+        json.dump(record, handle, indent=2)
+
+
+def check_parity(folder: str, name: str, paths: Sequence[str]):
+    """
+    Checks that the graphs of an ensemble passed the parity check of the export, as they are now.
+
+    :param paths: the graphs, in member order
+    :raises FileNotFoundError: without record, e.g. for graphs exported with --no_check
+    :raises ValueError: when a graph failed the check, or is not the one that was checked
+    """
+    from automorph_manifest import file_digest
+
+    path = parity_path(folder, name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'no parity check of the {name} graphs in {folder}, export them with automorph_onnx.py')
+    with open(path, encoding='utf-8') as handle:
+        checked = {graph['graph']: graph for graph in json.load(handle)['graphs']}
+    for graph_file in paths:
+        graph = checked.get(os.path.basename(graph_file))
+        if graph is None or graph['sha256'] != file_digest(graph_file):
+            raise ValueError(f'{graph_file} was not checked against its torch model, export it again with automorph_onnx.py')
+        if not graph['ok']:
+            raise ValueError(f"{graph_file} differs from its torch model by up to {graph['max_difference']:.3g}")
+
+
+def load_ensemble(folder: str, name: str, num_threads: Optional[int] = None, checked: bool = True):
+    """
+    The exported members of an ensemble, in the container its stage expects.
+
+    :param folder: the folder of the graphs
+    :param name: one of automorph_pipeline.ENSEMBLE_STAGES
+    :param num_threads: optional number of threads of every operator
+    :param checked: only load graphs that passed the parity check of the export, see check_parity
+    :return: an OnnxEnsemble for the vessel Segmenters, the list of the members otherwise
+    """
+    paths = graph_paths(folder, name)
+    if checked:
+        check_parity(folder, name, paths)
+    models = [OnnxModel(path, num_threads) for path in paths]
+    return OnnxEnsemble(models) if name == 'vessel' else models
+
+
+def member_graphs(name: str, models, image) -> List[Tuple[object, tuple, List[str]]]:
+    """
+    The torch modules of an ensemble to export, with their inputs.
+
+    :param name: one of automorph_pipeline.ENSEMBLE_STAGES
+    :param models: the members, in the order the load_models function of its stage returns them
+    :param image: an input batch of the stage
+    :return: the module, its input tensors and their names, of every member in order
+    """
+    import torch
+
+    graphs = []
+    with torch.no_grad():
+        if name == 'artery_vein':
+            for net_G, net_G_A, net_G_V in zip(models[0::3], models[1::3], models[2::3]):
+                # the main generator takes the fused maps of the branches, as in test_net
+                _, fusion_A = net_G_A(image)
+                _, fusion_V = net_G_V(image)
+                graphs.append((net_G, (image, fusion_A, fusion_V), ['image', 'artery', 'vein']))
+                graphs.append((net_G_A, (image,), ['image']))
+                graphs.append((net_G_V, (image,), ['image']))
+        else:
+            for model in models:
+                if hasattr(model, 'set_swish'):
+                    # the memory efficient swish of EfficientNet is a custom autograd function ONNX cannot export
+                    model.set_swish(memory_efficient=False)
+                graphs.append((model, (image,), ['image']))
+    return graphs
+
+
+def export_graph(model, inputs: tuple, input_names: List[str], path: str):
+    """
+    Exports a module with a dynamic batch dimension.
+
+    :param model: the torch module, in eval mode
+    :param inputs: example input tensors
+    :param input_names: their names in the graph
+    :param path: the graph file
+    """
+    import torch
+
+    with torch.no_grad():
+        outputs = model(*inputs)
+    count = len(outputs) if isinstance(outputs, (tuple, list)) else 1
+    output_names = [f'output_{index}' for index in range(count)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(model, inputs, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes={name: {0: 'batch'} for name in input_names + output_names},
+                      opset_version=OPSET_VERSION, do_constant_folding=True)
+
+
+def parity(model, graph: OnnxModel, inputs: tuple, rtol: float, atol: float) -> Tuple[float, bool]:
+    """
+    Compares the outputs of a torch module and of its graph.
+
+    :return: the largest absolute difference over every output, and whether every output is within
+             atol + rtol * |torch output|
+    """
+    import torch
+
+    with torch.no_grad():
+        expected = model(*inputs)
+    actual = graph(*inputs)
+    if not isinstance(expected, (tuple, list)):
+        expected, actual = (expected,), (actual,)
+    worst, close = 0.0, len(expected) == len(actual)
+    for reference, output in zip(expected, actual):
+        reference = reference.detach().float().cpu()
+        difference = (output.cpu() - reference).abs()
+        worst = max(worst, float(difference.max()))
+        close = close and bool((difference <= atol + rtol * reference.abs()).all())
+    return worst, close
+
+
+def export_ensemble(name: str, models, image, folder: str, rtol: float = 1e-3, atol: float = 1e-4,
+                    check: bool = True) -> List[Tuple[str, float, bool]]:
+    """
+    Exports every member of an ensemble and checks its graph.
+
+    :param name: one of automorph_pipeline.ENSEMBLE_STAGES
+    :param models: the members, in the order the load_models function of its stage returns them, on the CPU
+    :param image: a (1, 3, H, W) input of the stage, the graphs are checked on it and its mirror image
+    :param folder: the folder of the graphs
+    :return: the graph, largest difference and parity of every member, nan and True without check
+    """
+    import torch
+
+    results = []
+    for index, (model, inputs, input_names) in enumerate(member_graphs(name, models, image)):
+        path = graph_path(folder, name, index)
+        export_graph(model, inputs, input_names, path)
+        if not check:
+            results.append((path, float('nan'), True))
+            continue
+        # twice the batch of the trace, so the dynamic batch dimension is checked too
+        batch = tuple(torch.cat([x, torch.flip(x, dims=[3])]) for x in inputs)
+        worst, close = parity(model, OnnxModel(path), batch, rtol, atol)
+        results.append((path, worst, close))
+    return results
+
+
+def get_args(argv=None):
+    from automorph_pipeline import ENSEMBLE_STAGES
+
+    parser = argparse.ArgumentParser(description='Export the AutoMorph model ensembles to ONNX and check them '
+                                                 'against the PyTorch models.')
+    parser.add_argument('--only', nargs='+', default=None, choices=list(ENSEMBLE_STAGES),
+                        help='Only export these ensembles.')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='Relative tolerance of the parity check.')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Absolute tolerance of the parity check.')
+    parser.add_argument('--no_check', action='store_true',
+                        help='Export without comparing with the PyTorch outputs, the backends then refuse the graphs.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = get_args(argv)
+    from automorph_pipeline import ENSEMBLE_STAGES, AutoMorphPipeline
+    from automorph_synthetic import ensemble_input
+
+    pipeline = AutoMorphPipeline()
+    failed = False
+    for name, stage in ENSEMBLE_STAGES.items():
+        if args.only and name not in args.only:
+            continue
+        models = pipeline.ensemble(name)
+        # the fused vessel ensemble is split back into its members
+        models = [model.to('cpu').eval() for model in (models.members() if hasattr(models, 'members') else models)]
+        folder = str(ROOT / stage / ONNX_FOLDER)
+        results = export_ensemble(name, models, ensemble_input(name, 'cpu'), folder, args.rtol, args.atol,
+                                  not args.no_check)
+        if args.no_check:
+            if os.path.exists(parity_path(folder, name)):
+                os.remove(parity_path(folder, name))
+        else:
+            write_parity(folder, name, results, args.rtol, args.atol)
+        for path, worst, close in results:
+            print(f"{os.path.relpath(path, ROOT):<60} max |difference| {worst:>10.3g}  {'ok' if close else 'FAILED'}")
+            failed = failed or not close
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Inference optimisation of the ensemble members, applied by the load_models function of every stage
+when it is asked to, with --optimize or --torchscript. By default the members only go to eval mode
+without gradients and give the outputs of the former code.
+
+The BatchNorm layers that directly follow a convolution, in an nn.Sequential or in the EfficientNet
+blocks, are folded into its weights and bias and replaced by nn.Identity, the Dropout layers are
+removed, the gradients are switched off and the members are converted to the channels-last layout,
+which the CPU and the CUDA convolution kernels run faster on. The BatchNorm of the W-Net ConvBlock
+comes after a ReLU and stays. The vessel Segmenters keep the NCHW layout, their stacked weights are
+evaluated with torch.func.vmap by automorph_ensemble.FusedEnsemble.
+
+With torchscript, every member of the other ensembles is also traced on a synthetic fundus and
+frozen. The frozen modules are saved under AUTOMORPH_CACHE, by default ~/.cache/automorph, keyed
+by the SHA-256 of the checkpoint, of the source of the architecture and by the torch version and
+device, so later runs load them instead of compiling again. A frozen module that does not give the
+outputs of the eager one at another batch size is not used.
+"""
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+from typing import List, Optional, Sequence
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from automorph_manifest import file_digest
+from automorph_synthetic import ensemble_input
+
+CACHE_FOLDER = os.path.expanduser(os.getenv('AUTOMORPH_CACHE', os.path.join('~', '.cache', 'automorph')))
+
+# convolutions followed by a BatchNorm outside of an nn.Sequential, (convolution, BatchNorm) attribute
+# names by class name, the forward of these classes calls the BatchNorm on the convolution output
+CONV_BN_ATTRIBUTES = {
+    'EfficientNet': (('_conv_stem', '_bn0'), ('_conv_head', '_bn1')),
+    'MBConvBlock': (('_expand_conv', '_bn0'), ('_depthwise_conv', '_bn1'), ('_project_conv', '_bn2')),
+}
+
+_DROPOUT = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+
+
+def _foldable(conv: nn.Module, norm: nn.Module) -> bool:
+    return (isinstance(conv, nn.Conv2d) and isinstance(norm, nn.BatchNorm2d) and norm.track_running_stats
+            and conv.out_channels == norm.num_features)
+
+
+def fold_batchnorm(model: nn.Module) -> int:
+    """
+    Folds the BatchNorm layers that directly follow a convolution into it, in place, the model must
+    be in eval mode.
+
+    :return: the number of BatchNorm layers folded
+    """
+    folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            layers = list(module)
+            for index in range(len(layers) - 1):
+                if _foldable(layers[index], layers[index + 1]):
+                    module[index] = fuse_conv_bn_eval(layers[index], layers[index + 1])
+                    module[index + 1] = nn.Identity()
+                    folded += 1
+        for conv_name, norm_name in CONV_BN_ATTRIBUTES.get(type(module).__name__, ()):
+            conv, norm = getattr(module, conv_name, None), getattr(module, norm_name, None)
+            if _foldable(conv, norm):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, norm))
+                setattr(module, norm_name, nn.Identity())
+                folded += 1
+    return folded
+
+
+def strip_dropout(model: nn.Module) -> int:
+    """
+    Replaces the Dropout layers, identities in eval mode, by nn.Identity, in place.
+
+    :return: the number of layers removed
+    """
+    stripped = 0
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, _DROPOUT):
+                setattr(module, name, nn.Identity())
+                stripped += 1
+    return stripped
+
+
+def optimize_model(model: nn.Module, channels_last: bool = True) -> nn.Module:
+    """
+    Prepares a member for inference, see the module docstring.
+
+    :param model: the member, with its checkpoint loaded
+    :param channels_last: convert the weights to the channels-last layout
+    :return: the same model, in eval mode
+    """
+    model.eval()
+    fold_batchnorm(model)
+    strip_dropout(model)
+    model.requires_grad_(False)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def _cache_key(model: nn.Module, checkpoint: str, inputs: tuple) -> str:
+    key = {'checkpoint': file_digest(checkpoint),
+           'source': file_digest(inspect.getfile(type(model))),
+           'optimize': file_digest(__file__),
+           'torch': torch.__version__,
+           'device': str(inputs[0].device),
+           'inputs': [list(x.shape[1:]) for x in inputs]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _same_outputs(expected, actual, rtol: float = 1e-3, atol: float = 1e-4) -> bool:
+    if not isinstance(expected, (tuple, list)):
+        expected, actual = (expected,), (actual,)
+    return len(expected) == len(actual) and all(
+        torch.allclose(reference.float(), output.float(), rtol=rtol, atol=atol)
+        for reference, output in zip(expected, actual))
+
+
+def freeze_model(model: nn.Module, inputs: tuple, checkpoint: Optional[str] = None) -> nn.Module:
+    """
+    Traces and freezes a member with TorchScript, or loads it from the cache.
+
+    :param model: the optimised member
+    :param inputs: example input tensors, with a batch of one image
+    :param checkpoint: the checkpoint the member was loaded from, the frozen module is only cached with one
+    :return: the frozen module, or the model itself when it cannot be frozen
+    """
+    path = None
+    if checkpoint is not None:
+        path = os.path.join(CACHE_FOLDER, _cache_key(model, checkpoint, inputs) + '.pt')
+        if os.path.exists(path):
+            return torch.jit.load(path, map_location=inputs[0].device)
+    try:
+        with torch.no_grad():
+            frozen = torch.jit.freeze(torch.jit.trace(model, inputs).eval())
+            # another batch size than the trace, the loops end with a smaller batch
+            batch = tuple(torch.cat([x, torch.flip(x, dims=[3])]) for x in inputs)
+            same = _same_outputs(model(*batch), frozen(*batch))
+    except Exception as error:
+        logging.warning(f'{type(model).__name__} cannot be frozen, it runs eagerly: {error}')
+        return model
+    if not same:
+        logging.warning(f'the frozen {type(model).__name__} differs from the eager one, it runs eagerly')
+        return model
+    if path is not None:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        torch.jit.save(frozen, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    return frozen
+
+
+def input_memory_format(models) -> torch.memory_format:
+    """
+    The layout the inference loops give the batches of an ensemble in, channels-last for the members
+    optimize_ensemble converted or froze, the default one otherwise.
+
+    :param models: the members, eager, frozen or ONNX Runtime graphs
+    """
+    for model in models:
+        if isinstance(model, torch.jit.ScriptModule):
+            return torch.channels_last
+        for parameter in model.parameters() if isinstance(model, nn.Module) else ():
+            if parameter.dim() == 4 and parameter.shape[1] > 1 and parameter.shape[2:] != (1, 1):
+                return torch.channels_last if parameter.is_contiguous(memory_format=torch.channels_last) \
+                    else torch.contiguous_format
+    return torch.contiguous_format
+
+
+def optimize_ensemble(name: str, models: Sequence[nn.Module], checkpoints: Optional[Sequence[str]] = None,
+                      torchscript: bool = False, optimize: bool = False) -> List[nn.Module]:
+    """
+    Optimises the members of an ensemble for inference, see the module docstring.
+
+    :param name: one of automorph_pipeline.ENSEMBLE_STAGES
+    :param models: the members with their checkpoints loaded, on their device, in the order the
+                   load_models function of the stage returns them
+    :param checkpoints: the checkpoint of every member, the key of the cache of the frozen modules
+    :param torchscript: also freeze the members, except the vessel Segmenters, implies optimize
+    :param optimize: fold the BatchNorm layers, strip the Dropout layers and convert the layout, otherwise
+                     the members are only put in eval mode without gradients
+    :return: the members, eager or frozen
+    """
+    if not optimize and not torchscript:
+        return [model.eval().requires_grad_(False) for model in models]
+    channels_last = name != 'vessel'
+    models = [optimize_model(model, channels_last) for model in models]
+    if not torchscript or name == 'vessel':
+        return models
+
+    from automorph_onnx import member_graphs
+
+    image = ensemble_input(name, next(models[0].parameters()).device).contiguous(memory_format=torch.channels_last)
+    checkpoints = checkpoints or [None] * len(models)
+    return [freeze_model(model, inputs, checkpoint)
+            for (model, inputs, _), checkpoint in zip(member_graphs(name, models, image), checkpoints)]
@@ -0,0 +1,680 @@
+"""Run the whole AutoMorph pipeline in one Python process, keeping the deep learning models warm.
+
+``run.sh`` used to start a fresh interpreter for every stage, so each of them imported torch again
+and loaded its checkpoints again. The driver imports every stage once, loads each ensemble the first
+time it is needed and reuses it for every later run of the same ``AutoMorphPipeline``. The stages
+themselves are the same scripts ``run.sh`` called, with the same arguments, so ``Results/`` holds
+the same files.
+
+With streaming on, the cropped images of M0 are handed to M1 and M2 in memory (see
+``automorph_images.ImageStore``) and the intermediate PNGs of M0/images, M1/Good_quality and
+M1/Bad_quality are only written when exporting intermediates is also on. The store holds every
+cropped image at full resolution and its resized copies, about 13 MB for a 2464x1640 photograph,
+so larger folders go through M0, M1 and M2 in chunks of a bounded number of images, run in a
+staging results folder and merged into the results folder, before M3 runs on all of them.
+
+Incremental runs keep a manifest of the input images in the results folder (see
+``automorph_manifest``). Only the images that are new, changed, or whose stage code, checkpoints or
+options changed are processed again, in a staging results folder seeded with their earlier
+upstream results, and their results are then merged into the results folder.
+
+A folder of images can be split into shards run independently, on as many nodes as there are
+shards (see ``automorph_shards``). Every shard writes to its own folder under Results/shards, and
+a final merge combines them into the results folder.
+
+With the onnx backend, the ensembles run with ONNX Runtime on the CPU, from the graphs
+``automorph_onnx.py`` exports into the stage folders, instead of PyTorch. Graphs the export did not
+find to give the outputs of the torch models are refused.
+
+With a trace folder, the wall time, CPU time and images per second of every stage and of their
+sub-steps are recorded there (see ``automorph_timing``), as timing.json and a Chrome trace.
+"""
+from __future__ import annotations
+
+import argparse
+import importlib
+import os
+import runpy
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+from automorph_images import ImageStore
+from automorph_manifest import (MANIFEST_NAME, STAGES, RunManifest, chain_key, first_stale_stage, image_stem,
+                                remove_results, source_fingerprint, transfer_results)
+from automorph_onnx import BACKENDS, ONNX_FOLDER, load_ensemble
+from automorph_shards import check_shard, merge_shards, prepare_shard
+import automorph_timing
+from automorph_timing import span
+
+# default batch sizes of the test_outside.sh files
+QUALITY_BATCH_SIZE = 64
+VESSEL_BATCH_SIZE = 8
+ARTERY_VEIN_BATCH_SIZE = 8
+DISC_CUP_BATCH_SIZE = 16
+DEFAULT_NUM_WORKERS = 8
+
+ZONE_SCRIPTS = (
+    'create_datasets_disc_centred_B.py',
+    'create_datasets_disc_centred_C.py',
+    'create_datasets_macular_centred_B.py',
+    'create_datasets_macular_centred_C.py',
+)
+WHOLE_PICTURE_SCRIPTS = (
+    'create_datasets_macular_centred.py',
+    'create_datasets_disc_centred.py',
+)
+
+# the stage folder of every model ensemble
+ENSEMBLE_STAGES = {
+    'quality': 'M1_Retinal_Image_quality_EyePACS',
+    'vessel': 'M2_Vessel_seg',
+    'artery_vein': 'M2_Artery_vein',
+    'disc_cup': 'M2_lwnet_disc_cup',
+}
+
+# code, checkpoints and configs each stage depends on, relative to the repository root
+STAGE_SOURCES = {
+    'M0': ('M0_Preprocess', 'automorph_images.py', 'automorph_metadata.py', 'automorph_paths.py'),
+    'M1': ('M1_Retinal_Image_quality_EyePACS', 'automorph_ensemble.py', 'automorph_images.py', 'automorph_onnx.py',
+           'automorph_optimize.py', 'automorph_synthetic.py'),
+    'M2': ('M2_Vessel_seg', 'M2_Artery_vein', 'M2_lwnet_disc_cup', 'automorph_ensemble.py', 'automorph_images.py',
+           'automorph_fractal.py', 'automorph_metadata.py', 'automorph_skeleton.py', 'automorph_workers.py',
+           'automorph_zones.py', 'automorph_onnx.py', 'automorph_optimize.py', 'automorph_synthetic.py'),
+    'M3': ('M3_feature_zone', 'M3_feature_whole_pic', 'automorph_skeleton.py', 'automorph_calibre.py',
+           'automorph_fractal.py', 'automorph_metadata.py', 'automorph_tortuosity.py', 'csv_merge.py',
+           'automorph_zones.py'),
+}
+STAGING_FOLDER = '.incremental'
+STREAMING_FOLDER = '.streaming'
+# the images streamed through M0, M1 and M2 at once, their store takes about 13 MB each
+STREAMING_CHUNK_SIZE = 100
+
+
+def _image_names(image_folder: str) -> List[str]:
+    # the input images of a folder, sorted
+    if not os.path.isdir(image_folder):
+        return []
+    return sorted(entry.name for entry in os.scandir(image_folder) if entry.is_file())
+
+
+class Stage(object):
+    """
+    A folder of AutoMorph scripts that expect to be run from inside it.
+
+    Several stages ship top-level modules with the same name (dataset, model, utils, retipy, ...),
+    so each stage keeps its own copies of them and only exposes them in sys.modules while it is
+    active. The working directory and sys.path are also switched, because checkpoints and configs
+    are opened with paths relative to the stage folder.
+
+    :param directory: the stage folder, relative to the repository root
+    """
+
+    def __init__(self, directory: str):
+        self.directory = ROOT / directory
+        self._local_names = {entry.stem if entry.suffix == '.py' else entry.name
+                             for entry in self.directory.iterdir()
+                             if entry.suffix == '.py' or (entry.is_dir() and not entry.name.startswith(('.', '_')))}
+        self._modules = {}
+
+    def _is_local(self, name: str) -> bool:
+        return name.split('.')[0] in self._local_names
+
+    @contextmanager
+    def active(self):
+        """Makes the stage folder the working directory and its modules the importable ones."""
+        previous_directory = os.getcwd()
+        previous_environment = dict(os.environ)
+        hidden = {name: sys.modules.pop(name) for name in list(sys.modules) if self._is_local(name)}
+        sys.modules.update(self._modules)
+        sys.path.insert(0, str(self.directory))
+        os.chdir(self.directory)
+        try:
+            yield self
+        finally:
+            os.chdir(previous_directory)
+            sys.path.remove(str(self.directory))
+            self._modules = {name: sys.modules.pop(name) for name in list(sys.modules) if self._is_local(name)}
+            sys.modules.update(hidden)
+            os.environ.clear()
+            os.environ.update(previous_environment)
+
+    def module(self, name: str):
+        """Imports a module of the stage, must be called while the stage is active."""
+        return importlib.import_module(name)
+
+    def run_script(self, script: str, argv: List[str]):
+        """Runs a stage script as __main__ with the given arguments, must be called while active."""
+        previous_argv = sys.argv
+        sys.argv = [script] + argv
+        try:
+            runpy.run_path(str(self.directory / script), run_name='__main__')
+        finally:
+            sys.argv = previous_argv
+
+
+class AutoMorphPipeline(object):
+    """
+    In-process AutoMorph pipeline.
+
+    The stage modules are imported and the model ensembles loaded on first use, then kept for the
+    lifetime of the object, so calling run() for every new batch of images only pays for the
+    inference itself.
+
+    :param batch_size: overrides the batch size of the deep learning stages
+    :param num_workers: overrides the DataLoader worker count of the deep learning stages
+    :param mask_max_size: optional largest side M0 locates the rim of the field of view at, see fundus_prep.get_mask
+    :param backend: 'torch', or 'onnx' to run the ensembles with ONNX Runtime from the graphs
+                    automorph_onnx.py exported in the stage folders
+    :param torchscript: with the torch backend, freeze the members of the quality, artery/vein and
+                        disc/cup ensembles with TorchScript, see automorph_optimize, implies optimize
+    :param optimize: with the torch backend, fold the BatchNorm layers of the members and convert them
+                     to channels-last, see automorph_optimize
+    :param postprocess_workers: overrides the number of processes post-processing the vessel and
+                                artery/vein maps, by default the cores the DataLoader workers leave
+    :param ensemble_chunk: overrides the number of vessel segmenters evaluated at once, one by default
+                           like the former loop, the activation memory grows with it
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, num_workers: Optional[int] = None,
+                 mask_max_size: Optional[int] = None, backend: str = 'torch', torchscript: bool = False,
+                 postprocess_workers: Optional[int] = None, ensemble_chunk: Optional[int] = None,
+                 optimize: bool = False):
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown backend {backend}, one of {BACKENDS}')
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.mask_max_size = mask_max_size
+        self.backend = backend
+        self.torchscript = torchscript
+        self.postprocess_workers = postprocess_workers
+        self.ensemble_chunk = ensemble_chunk
+        self.optimize = optimize
+        self._stages = {}  # type: Dict[str, Stage]
+        self._models = {}  # type: Dict[Tuple[str, str], object]
+
+    def _stage(self, directory: str) -> Stage:
+        if directory not in self._stages:
+            self._stages[directory] = Stage(directory)
+        return self._stages[directory]
+
+    def _batch_size(self, default: int) -> int:
+        if self.batch_size is not None:
+            return self.batch_size
+        return int(os.getenv('AUTOMORPH_BATCH_SIZE', default))
+
+    def _num_workers(self) -> int:
+        if self.num_workers is not None:
+            return self.num_workers
+        return int(os.getenv('AUTOMORPH_NUM_WORKERS', DEFAULT_NUM_WORKERS))
+
+    def _postprocess_argv(self) -> List[str]:
+        if self.postprocess_workers is None:
+            return []
+        return [f'--postprocess_workers={self.postprocess_workers}']
+
+    def _argv(self, name: str, image_folder: str, result_folder: str) -> List[str]:
+        # the arguments of the deep learning stages, as in their test_outside.sh files
+        if name == 'quality':
+            return ['--epochs=1', f'--batch-size={self._batch_size(QUALITY_BATCH_SIZE)}', '--task_name=Retinal_quality',
+                    '--model=efficientnet', '--round=0', '--train_on_dataset=EyePACS_quality',
+                    '--test_on_dataset=customised_data', f'--test_csv_dir={result_folder}/M0/images/', '--n_class=3',
+                    '--seed_num=42', f'--num_workers={self._num_workers()}',
+                    f'--image_folder={image_folder}', f'--result_folder={result_folder}']
+        if name == 'vessel':
+            return ['--epochs=1', f'--batchsize={self._batch_size(VESSEL_BATCH_SIZE)}', '--learning_rate=2e-4',
+                    '--validation_ratio=10.0', '--alpha=0.08', '--beta=1.1', '--gamma=0.5', '--dataset=ALL-SIX',
+                    '--dataset_test=ALL-SIX', '--uniform=True', '--jn=20210630_uniform_thres40_ALL-SIX',
+                    f'--num_workers={self._num_workers()}', '--save_model=best', '--train_test_mode=test',
+                    '--pre_threshold=40.0', '--seed_num=42', f'--out_test={result_folder}/M2/binary_vessel/',
+                    f'--image_folder={image_folder}', f'--result_folder={result_folder}'] + self._postprocess_argv() + (
+                    [] if self.ensemble_chunk is None else [f'--ensemble_chunk={self.ensemble_chunk}'])
+        if name == 'artery_vein':
+            return [f'--batch-size={self._batch_size(ARTERY_VEIN_BATCH_SIZE)}', '--dataset=ALL-AV',
+                    '--job_name=20210724_ALL-AV_randomseed', '--checkstart=1401', '--uniform=True',
+                    f'--num_workers={self._num_workers()}', f'--image_folder={image_folder}',
+                    f'--result_folder={result_folder}'] + self._postprocess_argv()
+        if name == 'disc_cup':
+            return ['--config_file', 'experiments/wnet_All_three_1024_disc_cup/30/config.cfg', '--im_size', '512',
+                    '--device', 'cuda:0', f'--batch_size={self._batch_size(DISC_CUP_BATCH_SIZE)}',
+                    f'--num_workers={self._num_workers()}', f'--image_folder={image_folder}', f'--result_folder={result_folder}']
+        raise ValueError(f'unknown ensemble {name}')
+
+    def _load_models(self, name: str, stage: Stage, argv: List[str]):
+        # loads an ensemble the first time it is needed, its stage must be active
+        if (name, self.backend) in self._models:
+            return self._models[name, self.backend]
+        if self.backend != 'torch':
+            models = load_ensemble(str(stage.directory / ONNX_FOLDER), name)
+        elif name == 'quality':
+            test_outside = stage.module('test_outside')
+            args = test_outside.get_args(argv)
+            models = test_outside.load_models(args, test_outside.select_device(args.local_rank), self.torchscript, self.optimize)
+        elif name == 'vessel':
+            test_outside = stage.module('test_outside_integrated')
+            args = test_outside.get_args(argv)
+            models = test_outside.load_models(args.dataset, args.jn, test_outside.select_device(), args.ensemble_chunk, self.optimize)
+        elif name == 'artery_vein':
+            test_outside = stage.module('test_outside')
+            args = test_outside.get_args(argv)
+            models = test_outside.load_models(args.jn, test_outside.select_device(), self.torchscript, self.optimize)
+        else:
+            generate_av_results = stage.module('generate_av_results')
+            args = generate_av_results.load_config(generate_av_results.parser.parse_args(argv))
+            models = generate_av_results.load_models(args.model_name, generate_av_results.select_device(), self.torchscript, self.optimize)
+        self._models[name, self.backend] = models
+        return models
+
+    def ensemble(self, name: str):
+        """
+        The models of an ensemble, loaded on first use and kept for the later runs.
+
+        :param name: one of ENSEMBLE_STAGES
+        :return: what the load_models function of the stage returns, the list of the models or the
+                 FusedEnsemble of the vessel segmenters, or their automorph_onnx stand-ins with the
+                 ONNX Runtime backends
+        """
+        with self._stage(ENSEMBLE_STAGES[name]).active() as stage:
+            return self._load_models(name, stage, self._argv(name, '.', '.'))
+
+    @staticmethod
+    def _clean_stage_paths(result_folder: str, *relative_paths: str):
+        for relative_path in relative_paths:
+            target = os.path.join(result_folder, relative_path)
+            if os.path.exists(target):
+                print(f'Cleaning {target}')
+                shutil.rmtree(target)
+
+    def preprocess(self, image_folder: str, result_folder: str, images: Optional[ImageStore] = None,
+                   export: bool = True):
+        """
+        M0, crops the fundus images and writes M0/crop_info.csv.
+
+        :param images: optional store that receives the cropped images
+        :param export: whether the cropped PNGs are written when images is given
+        """
+        argv = ['--image_folder', image_folder, '--result_folder', result_folder]
+        if self.mask_max_size is not None:
+            argv.append(f'--mask_max_size={self.mask_max_size}')
+        with self._stage('M0_Preprocess').active() as stage:
+            stage.module('EyeQ_process_main').main(argv, images=images, export=export)
+
+    def quality(self, image_folder: str, result_folder: str, images: Optional[ImageStore] = None,
+                export: bool = True) -> Optional[ImageStore]:
+        """
+        M1, grades the image quality with the EfficientNet ensemble.
+
+        :param images: optional store with the M0 images, read instead of M0/images
+        :param export: whether the images are copied to M1/Good_quality and M1/Bad_quality when images is given
+        :return: the store of the gradable images when images is given
+        """
+        argv = self._argv('quality', image_folder, result_folder)
+        with self._stage(ENSEMBLE_STAGES['quality']).active() as stage:
+            test_outside = stage.module('test_outside')
+            test_outside.main(argv, models=self._load_models('quality', stage, argv), images=images)
+            return stage.module('merge_quality_assessment').main(
+                ['--image_folder', image_folder, '--result_folder', result_folder], images=images, export=export)
+
+    def vessel_segmentation(self, image_folder: str, result_folder: str, images: Optional[ImageStore] = None):
+        """M2, binary vessel segmentation with the Segmenter ensemble, on M1/Good_quality or the given store."""
+        argv = self._argv('vessel', image_folder, result_folder)
+        with self._stage(ENSEMBLE_STAGES['vessel']).active() as stage:
+            test_outside = stage.module('test_outside_integrated')
+            test_outside.main(argv, models=self._load_models('vessel', stage, argv), images=images)
+
+    def artery_vein_segmentation(self, image_folder: str, result_folder: str, images: Optional[ImageStore] = None):
+        """M2, artery/vein segmentation with the generator ensemble, on M1/Good_quality or the given store."""
+        argv = self._argv('artery_vein', image_folder, result_folder)
+        with self._stage(ENSEMBLE_STAGES['artery_vein']).active() as stage:
+            test_outside = stage.module('test_outside')
+            test_outside.main(argv, models=self._load_models('artery_vein', stage, argv), images=images)
+
+    def disc_cup_segmentation(self, image_folder: str, result_folder: str, images: Optional[ImageStore] = None):
+        """
+        M2, optic disc/cup segmentation with the W-Net ensemble, and the zone skeletons of M3, on
+        M1/Good_quality or the given store.
+        """
+        argv = self._argv('disc_cup', image_folder, result_folder)
+        with self._stage(ENSEMBLE_STAGES['disc_cup']).active() as stage:
+            generate_av_results = stage.module('generate_av_results')
+            generate_av_results.main(argv, models=self._load_models('disc_cup', stage, argv), images=images)
+
+    def feature_measurement(self, image_folder: str, result_folder: str):
+        """M3, vessel features of every zone and of the whole picture, merged into the final csv."""
+        argv = ['--image_folder', image_folder, '--result_folder', result_folder]
+        with self._stage('M3_feature_zone/retipy').active() as stage:
+            for script in ZONE_SCRIPTS:
+                stage.run_script(script, argv)
+        with self._stage('M3_feature_whole_pic/retipy').active() as stage:
+            for script in WHOLE_PICTURE_SCRIPTS:
+                stage.run_script(script, argv)
+        importlib.import_module('csv_merge').main(argv)
+
+    def _fingerprints(self) -> Dict[str, str]:
+        config = {'M0': {'mask_max_size': self.mask_max_size,
+                         'pixel_resolution': os.getenv('AUTOMORPH_PIXEL_RESOLUTION')}}
+        # the graphs and the frozen models give the outputs of the models to the rounding, the defaults
+        # keep the earlier fingerprints
+        options = {}
+        if self.backend != 'torch':
+            options['backend'] = self.backend
+        if self.torchscript:
+            options['torchscript'] = True
+        if self.optimize:
+            options['optimize'] = True
+        if options:
+            config['M1'] = config['M2'] = options
+        if self.ensemble_chunk is not None:
+            # the moments of the chunks are merged with another rounding
+            config['M2'] = dict(options, ensemble_chunk=self.ensemble_chunk)
+        sources = {stage: [ROOT / source for source in stage_sources] for stage, stage_sources in STAGE_SOURCES.items()}
+        if self.backend != 'torch':
+            # the graphs are exported again without any change of the checkpoints
+            for name, directory in ENSEMBLE_STAGES.items():
+                sources['M1' if name == 'quality' else 'M2'].append(ROOT / directory / ONNX_FOLDER)
+        return {stage: source_fingerprint(stage_sources, config.get(stage)) for stage, stage_sources in sources.items()}
+
+    def _run_stages(self, image_folder: str, result_folder: str, stages: Tuple[str, ...], streaming: bool,
+                    export_intermediates: bool, streaming_chunk: Optional[int] = STREAMING_CHUNK_SIZE):
+        if streaming and 'M0' in stages and streaming_chunk and len(_image_names(image_folder)) > streaming_chunk:
+            self._run_streaming_chunks(image_folder, result_folder, stages, export_intermediates, streaming_chunk)
+            return
+        runpy.run_path(str(ROOT / 'automorph_data.py'))
+        os.makedirs(result_folder, exist_ok=True)
+        os.makedirs(image_folder, exist_ok=True)
+        os.environ['AUTOMORPH_RESOLUTION_FILE'] = importlib.import_module('generate_resolution').main(
+            ['--image_folder', image_folder, '--result_folder', result_folder])
+
+        images = ImageStore() if streaming and 'M0' in stages else None
+        good_images = None
+        # the throughput of every stage is given in input images per second
+        n_images = sum(1 for entry in os.scandir(image_folder) if entry.is_file())
+
+        if 'M0' in stages:
+            self._clean_stage_paths(result_folder, 'M0')
+            print('### Preprocess Start ###')
+            with span('M0', images=n_images):
+                self.preprocess(image_folder, result_folder, images=images, export=export_intermediates)
+        else:
+            print('### Skipping Preprocessing ###')
+
+        if 'M1' in stages:
+            self._clean_stage_paths(result_folder, 'M1')
+            print('### Image Quality Assessment ###')
+            with span('M1', images=n_images):
+                good_images = self.quality(image_folder, result_folder, images=images, export=export_intermediates)
+        else:
+            print('### Skipping Image Quality Assessment ###')
+
+        if 'M2' in stages:
+            self._clean_stage_paths(result_folder, 'M2')
+            print('### Segmentation Modules ###')
+            with span('M2.vessel', images=n_images):
+                self.vessel_segmentation(image_folder, result_folder, images=good_images)
+            with span('M2.artery_vein', images=n_images):
+                self.artery_vein_segmentation(image_folder, result_folder, images=good_images)
+            with span('M2.disc_cup', images=n_images):
+                self.disc_cup_segmentation(image_folder, result_folder, images=good_images)
+        else:
+            print('### Skipping Segmentation Modules ###')
+
+        if 'M3' in stages:
+            self._clean_stage_paths(result_folder, 'M3')
+            print('### Feature Measuring ###')
+            with span('M3', images=n_images):
+                self.feature_measurement(image_folder, result_folder)
+        else:
+            print('### Skipping Feature Measurement ###')
+
+    def _run_streaming_chunks(self, image_folder: str, result_folder: str, stages: Tuple[str, ...],
+                              export_intermediates: bool, streaming_chunk: int):
+        # the images of a chunk are only held in memory until its M2 is done
+        names = _image_names(image_folder)
+        streamed = tuple(stage for stage in stages if stage != 'M3')
+        os.makedirs(result_folder, exist_ok=True)
+        # the resolution of every image, the chunks only write the one of their own images
+        importlib.import_module('generate_resolution').main(['--image_folder', image_folder, '--result_folder', result_folder])
+        self._clean_stage_paths(result_folder, *streamed)
+
+        staging = Path(result_folder) / STREAMING_FOLDER
+        for start in range(0, len(names), streaming_chunk):
+            chunk = names[start:start + streaming_chunk]
+            shutil.rmtree(staging, ignore_errors=True)
+            staging_images = staging / 'images'
+            staging_results = staging / 'Results'
+            staging_images.mkdir(parents=True)
+            staging_results.mkdir()
+            for name in chunk:
+                os.symlink(os.path.join(image_folder, name), staging_images / name)
+
+            print(f'### Streaming images {start + 1} to {start + len(chunk)} of {len(names)} ###')
+            self._run_stages(str(staging_images), str(staging_results), streamed, True, export_intermediates, None)
+            for stage in streamed:
+                transfer_results(str(staging_results), result_folder, stage)
+        shutil.rmtree(staging, ignore_errors=True)
+
+        if 'M3' in stages:
+            self._run_stages(image_folder, result_folder, ('M3',), False, export_intermediates)
+
+    def _run_incremental(self, image_folder: str, result_folder: str, stages: Tuple[str, ...], streaming: bool,
+                         export_intermediates: bool, streaming_chunk: Optional[int] = STREAMING_CHUNK_SIZE):
+        manifest = RunManifest.load(result_folder)
+        scanned = manifest.scan(image_folder)
+        # the resolution of every image, the staging runs only write the one of their own images
+        importlib.import_module('generate_resolution').main(['--image_folder', image_folder, '--result_folder', result_folder])
+        fingerprints = self._fingerprints()
+
+        # the key of a stage result chains the input digest with the fingerprints of the stages
+        # up to it, the stages that are skipped keep the key of the result they already hold
+        keys = {}
+        groups = {}  # type: Dict[int, List[str]]
+        for name, record in scanned.items():
+            recorded = manifest.stage_keys(name)
+            key = record['digest']
+            keys[name] = {}
+            for stage in STAGES:
+                key = chain_key(key, fingerprints[stage]) if stage in stages or stage not in recorded else recorded[stage]
+                keys[name][stage] = key
+            start = first_stale_stage(keys[name], recorded, stages)
+            if start is not None:
+                groups.setdefault(start, []).append(name)
+        removed = sorted(set(manifest.images) - set(scanned))
+        stale = sum(len(names) for names in groups.values())
+        print(f'Incremental run: {stale} new or changed, {len(removed)} removed, {len(scanned) - stale} up to date')
+
+        if removed:
+            stems = {image_stem(name) for name in removed}
+            for stage in STAGES:
+                remove_results(result_folder, stage, stems)
+            for name in removed:
+                manifest.forget(name)
+            manifest.save()
+
+        if list(groups) == [0] and len(groups[0]) == len(scanned) and not manifest.images:
+            # nothing to keep, the results folder is simply filled as by a full run
+            self._run_stages(image_folder, result_folder, stages, streaming, export_intermediates, streaming_chunk)
+            for name in groups[0]:
+                manifest.record(name, scanned[name], {stage: keys[name][stage] for stage in stages})
+            manifest.save()
+            return
+
+        staging = Path(result_folder) / STAGING_FOLDER
+        for start, names in sorted(groups.items()):
+            run_stages = tuple(stage for stage in STAGES[start:] if stage in stages)
+            stems = {image_stem(name) for name in names}
+            shutil.rmtree(staging, ignore_errors=True)
+            staging_images = staging / 'images'
+            staging_results = staging / 'Results'
+            staging_images.mkdir(parents=True)
+            staging_results.mkdir()
+            for name in names:
+                os.symlink(os.path.join(image_folder, name), staging_images / name)
+            for stage in STAGES[:start]:
+                transfer_results(result_folder, str(staging_results), stage, stems, link=True)
+
+            print(f'### Incremental run of {len(names)} images from {STAGES[start]} ###')
+            self._run_stages(str(staging_images), str(staging_results), run_stages,
+                             streaming and 'M0' in run_stages, export_intermediates, streaming_chunk)
+
+            for stage in run_stages:
+                remove_results(result_folder, stage, stems)
+                transfer_results(str(staging_results), result_folder, stage)
+            for name in names:
+                manifest.record(name, scanned[name], {stage: keys[name][stage] for stage in run_stages})
+            manifest.save()
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def run(self, image_folder: str, result_folder: str, no_process: bool = False, no_quality: bool = False,
+            no_segmentation: bool = False, no_feature: bool = False, streaming: bool = False,
+            export_intermediates: bool = False, incremental: bool = False, shard_index: Optional[int] = None,
+            shard_count: Optional[int] = None, trace_dir: Optional[str] = None,
+            streaming_chunk: Optional[int] = STREAMING_CHUNK_SIZE):
+        """
+        Runs the pipeline on a folder of images, skipping the same stages as the run.sh flags.
+
+        :param image_folder: the folder containing the input images
+        :param result_folder: the folder where the stage outputs are written
+        :param streaming: hand the M0 images to M1 and M2 in memory. Only the stages that follow M0 in
+                          the same call can use them, the others read the PNGs as usual
+        :param streaming_chunk: with streaming, the largest number of images held in memory, larger
+                                folders go through M0, M1 and M2 in chunks of that many images. None
+                                holds them all
+        :param export_intermediates: with streaming, still write the PNGs of M0 and M1
+        :param incremental: only process the images whose results are missing or out of date and
+                            keep the others, instead of cleaning the stage folders
+        :param shard_index: with shard_count, only process the images of this shard, into
+                            result_folder/shards, see merge_shards()
+        :param shard_count: the number of shards the images are split into
+        :param trace_dir: optional folder where the timings of the stages and of their sub-steps are
+                          written, as timing.json and the Chrome trace trace.json
+        """
+        image_folder = str(Path(image_folder).expanduser().resolve())
+        result_folder = str(Path(result_folder).expanduser().resolve())
+        if (shard_index is None) != (shard_count is None):
+            raise ValueError('shard_index and shard_count go together')
+        if shard_count is not None:
+            check_shard(shard_index, shard_count)
+            image_folder, result_folder = prepare_shard(image_folder, result_folder, shard_index, shard_count)
+        print(f'Using image folder: {image_folder}')
+        print(f'Using result folder: {result_folder}')
+
+        skipped = {'M0': no_process, 'M1': no_quality, 'M2': no_segmentation, 'M3': no_feature}
+        stages = tuple(stage for stage in STAGES if not skipped[stage])
+        if trace_dir is not None:
+            trace_dir = str(Path(trace_dir).expanduser().resolve())
+            os.makedirs(trace_dir, exist_ok=True)
+            automorph_timing.reset(trace_dir)
+            # the stages and every process they start record their timings there
+            os.environ[automorph_timing.TRACE_DIR_ENV] = trace_dir
+        try:
+            if incremental:
+                os.makedirs(result_folder, exist_ok=True)
+                self._run_incremental(image_folder, result_folder, stages, streaming, export_intermediates,
+                                      streaming_chunk)
+            else:
+                self._run_stages(image_folder, result_folder, stages, streaming, export_intermediates, streaming_chunk)
+                # the stage folders were rebuilt without the manifest, the next incremental run starts over
+                manifest_path = Path(result_folder) / MANIFEST_NAME
+                if stages and manifest_path.exists():
+                    manifest_path.unlink()
+        finally:
+            if trace_dir is not None:
+                del os.environ[automorph_timing.TRACE_DIR_ENV]
+                automorph_timing.write_report(trace_dir)
+                print(f'Timings written to {trace_dir}')
+
+        print('### Done ###')
+
+    @staticmethod
+    def merge_shards(result_folder: str):
+        """Merges the results of every shard of a sharded run into the results folder."""
+        print('### Merging Shards ###')
+        merge_shards(str(Path(result_folder).expanduser().resolve()))
+
+
+def get_args(argv=None):
+    automorph_data = os.getenv('AUTOMORPH_DATA')
+    parser = argparse.ArgumentParser(
+        description='Run the AutoMorph pipeline in a single process.',
+        epilog='If paths are omitted, the script falls back to ./images and ./Results, or '
+               '${AUTOMORPH_DATA}/images and ${AUTOMORPH_DATA}/Results when the environment '
+               'variable AUTOMORPH_DATA is set.')
+    parser.add_argument('--image_folder', default=str(Path(automorph_data or '.') / 'images'),
+                        help='Absolute or relative path to the folder containing input images.')
+    parser.add_argument('--result_folder', default=str(Path(automorph_data or '.') / 'Results'),
+                        help='Absolute or relative path where pipeline outputs should be written.')
+    parser.add_argument('--batch_size', type=int, default=None, help='Override the batch size used by deep learning modules.')
+    parser.add_argument('--num_workers', type=int, default=None, help='Override the DataLoader worker count used by deep learning modules.')
+    parser.add_argument('--ensemble_chunk', type=int, default=None,
+                        help='Override the number of vessel segmenters evaluated at once, 1 by default, more '
+                             'are faster but take as many times the activation memory.')
+    parser.add_argument('--postprocess_workers', type=int, default=None,
+                        help='Override the number of processes post-processing the vessel and artery/vein maps, '
+                             'by default the cores the DataLoader workers leave.')
+    parser.add_argument('--mask_max_size', type=int, default=None,
+                        help='Locate the rim of the field of view of larger images on their mask subsampled to this size.')
+    parser.add_argument('--backend', default='torch', choices=BACKENDS,
+                        help='Run the model ensembles with PyTorch, or with ONNX Runtime on the graphs exported and checked by automorph_onnx.py.')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Fold the BatchNorm layers of the models and convert them to channels-last, see automorph_optimize.py.')
+    parser.add_argument('--torchscript', action='store_true',
+                        help='Freeze the models with TorchScript, cached on disk, see automorph_optimize.py.')
+    parser.add_argument('--no_process', action='store_true', help='Skip the preprocessing stage.')
+    parser.add_argument('--no_quality', action='store_true', help='Skip the image quality assessment stage.')
+    parser.add_argument('--no_segmentation', action='store_true', help='Skip the vessel/artery-vein/optic-disc segmentation stage.')
+    parser.add_argument('--no_feature', action='store_true', help='Skip feature extraction and CSV merging.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Hand the preprocessed images to the quality and segmentation stages in memory. Every '
+                             'image takes about 13 MB there, for a 2464x1640 photograph, see --streaming_chunk.')
+    parser.add_argument('--streaming_chunk', type=int, default=STREAMING_CHUNK_SIZE,
+                        help='With --streaming, the largest number of images held in memory, larger folders go '
+                             'through the preprocessing, quality and segmentation stages in chunks of that many '
+                             'images. 0 holds them all.')
+    parser.add_argument('--export_intermediates', action='store_true',
+                        help='With --streaming, still write the M0 and M1 images to the results folder.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process new or changed images and merge them with the earlier results.')
+    parser.add_argument('--shard_index', type=int, default=None,
+                        help='Only process the images of this shard, in [0, shard_count).')
+    parser.add_argument('--shard_count', type=int, default=None,
+                        help='Number of shards the images are split into, by a hash of their names.')
+    parser.add_argument('--merge_shards', action='store_true',
+                        help='Merge the results of every shard into the result folder, without running any stage.')
+    parser.add_argument('--trace_dir', default=None,
+                        help='Folder where the timings of every stage and sub-step are written, as JSON and a Chrome trace.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    # run.sh pinned the deep learning stages to the first GPU
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+    if args.batch_size is not None:
+        print(f'Using batch size override: {args.batch_size}')
+    if args.num_workers is not None:
+        print(f'Using dataloader workers override: {args.num_workers}')
+
+    print(time.ctime())
+    pipeline = AutoMorphPipeline(batch_size=args.batch_size, num_workers=args.num_workers,
+                                 mask_max_size=args.mask_max_size, backend=args.backend,
+                                 torchscript=args.torchscript, postprocess_workers=args.postprocess_workers,
+                                 ensemble_chunk=args.ensemble_chunk, optimize=args.optimize)
+    if args.merge_shards:
+        pipeline.merge_shards(args.result_folder)
+    else:
+        pipeline.run(args.image_folder, args.result_folder, no_process=args.no_process, no_quality=args.no_quality,
+                     no_segmentation=args.no_segmentation, no_feature=args.no_feature, streaming=args.streaming,
+                     export_intermediates=args.export_intermediates, incremental=args.incremental,
+                     shard_index=args.shard_index, shard_count=args.shard_count, trace_dir=args.trace_dir,
+                     streaming_chunk=args.streaming_chunk)
+    print(time.ctime())
+
+
+if __name__ == '__main__':
+    main()
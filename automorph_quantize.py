@@ -0,0 +1,336 @@
+"""Post-training static INT8 quantization of the segmentation ensembles, and the report of its accuracy.
+
+The float graphs automorph_onnx.py exported for the vessel Segmenters, the artery/vein generators and
+the disc/cup W-Nets are quantized with ONNX Runtime, weights per output channel and activations with
+the ranges they take on fundus photographs of M1/Good_quality, prepared as the dataset of each stage
+prepares them. The main artery/vein generators are calibrated on the fused maps their float branches
+give. The INT8 graphs go to <stage>/onnx_int8/ with the file names of the float ones.
+
+The images left out of the calibration are then segmented by the float and by the INT8 ensembles,
+and every mask the stage writes, vessels, arteries, veins, disc and cup, is compared with its Dice
+coefficient, which is the F1 score of the pixels. The drift of the M3 features is measured on two
+results folders of the same images. The pipeline does not run the INT8 graphs, they are only built
+and reported on until their agreement and drift are known to be acceptable.
+
+    python automorph_quantize.py --image_folder Results/M1/Good_quality --calibration 300 --report 100
+    python automorph_quantize.py --drift Results Results_int8
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+from automorph_manifest import stage_tables
+from automorph_onnx import ONNX_FOLDER, OnnxModel, graph_paths, load_ensemble
+from automorph_synthetic import ENSEMBLE_SIZES
+
+# the folder of the quantized graphs, in the stage folder of their ensemble, and the ensembles quantized
+INT8_FOLDER = 'onnx_int8'
+QUANTIZED_ENSEMBLES = ('vessel', 'artery_vein', 'disc_cup')
+CALIBRATION_METHODS = ('minmax', 'entropy', 'percentile')
+
+# the masks the stages write from the decoded mean map of their ensemble, and the classes in them
+MASKS = {
+    'vessel': (('Vessel', (1,)),),
+    'artery_vein': (('Artery', (1,)), ('Vein', (2,))),
+    'disc_cup': (('Disc', (1, 2)), ('Cup', (2,))),
+}
+
+# intermediate outputs the min/max calibration keeps before reducing them, bounds its memory
+_CALIBRATION_FLUSH = 16
+
+
+def fundus_dataset(name: str, image_folder: str):
+    """
+    The dataset the stage of an ensemble reads the gradable images with, for inference.
+
+    :param name: one of QUANTIZED_ENSEMBLES
+    :param image_folder: the folder of the images, e.g. Results/M1/Good_quality
+    :return: the dataset, its items hold the normalised image under 'image' and its name under 'name'
+    """
+    from automorph_pipeline import ENSEMBLE_STAGES, Stage
+
+    # the datasets glob the image names on the folder path
+    image_folder = os.path.join(image_folder, '')
+    size = (ENSEMBLE_SIZES[name], ENSEMBLE_SIZES[name])
+    with Stage(ENSEMBLE_STAGES[name]).active() as stage:
+        if name == 'vessel':
+            return stage.module('dataset').SEDataset_out(image_folder, None, None, size, 'ALL-SIX', 40.0,
+                                                         uniform='True', train_or=False)
+        if name == 'artery_vein':
+            return stage.module('scripts.dataset').LearningAVSegData_OOD(image_folder, None, None, size,
+                                                                         dataset_name='ALL-AV', train_or=False)
+        return stage.module('utils.get_loaders').TestDataset(image_folder, size)
+
+
+def split_images(count: int, calibration: int, report: int, seed: int = 0) -> Tuple[List[int], List[int]]:
+    """
+    Draws the images of the calibration and those of the report, without overlap.
+
+    :param count: the number of images
+    :return: the sorted indices of both
+    """
+    order = np.random.default_rng(seed).permutation(count)
+    return sorted(order[:calibration].tolist()), sorted(order[calibration:calibration + report].tolist())
+
+
+class CalibrationReader(object):
+    """
+    The calibration batches of one graph, in the CalibrationDataReader interface of ONNX Runtime.
+
+    :param feeds: the inputs of the graph for every calibration image, by input name
+    """
+
+    def __init__(self, feeds: Iterator[Dict[str, np.ndarray]]):
+        self._feeds = feeds
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self._feeds, None)
+
+
+def _images(dataset, indices: Sequence[int]) -> Iterator[np.ndarray]:
+    for index in indices:
+        yield dataset[index]['image'].numpy()[np.newaxis].astype(np.float32)
+
+
+def calibration_feeds(name: str, index: int, dataset, indices: Sequence[int],
+                      float_paths: Sequence[str]) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    The inputs of a member graph on the calibration images.
+
+    :param name: one of QUANTIZED_ENSEMBLES
+    :param index: the member, see automorph_onnx.member_graphs for the order of the artery/vein graphs
+    :param dataset: see fundus_dataset
+    :param indices: the calibration images of the dataset
+    :param float_paths: the float graphs of the ensemble, the main artery/vein generators take the
+                        fused maps of the float branches of their triplet
+    """
+    import torch
+
+    if name != 'artery_vein' or index % 3:
+        for image in _images(dataset, indices):
+            yield {'image': image}
+        return
+    branch_A, branch_V = OnnxModel(float_paths[index + 1]), OnnxModel(float_paths[index + 2])
+    for image in _images(dataset, indices):
+        x = torch.from_numpy(image)
+        yield {'image': image, 'artery': branch_A(x)[1].numpy(), 'vein': branch_V(x)[1].numpy()}
+
+
+def quantize_graph(float_path: str, int8_path: str, reader: CalibrationReader, method: str = 'minmax'):
+    """
+    Quantizes a graph to INT8 in the QDQ format, the weights per output channel.
+
+    :param float_path: the float graph
+    :param int8_path: the quantized graph
+    :param reader: the calibration inputs
+    :param method: one of CALIBRATION_METHODS, how the activation ranges are taken from the calibration
+    """
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    methods = {'minmax': CalibrationMethod.MinMax, 'entropy': CalibrationMethod.Entropy,
+               'percentile': CalibrationMethod.Percentile}
+    os.makedirs(os.path.dirname(int8_path), exist_ok=True)
+    folder = tempfile.mkdtemp(prefix='automorph_quantize_')
+    try:
+        # shape inference and graph optimisation first, so the quantizer sees the fused operators
+        prepared = os.path.join(folder, 'prepared.onnx')
+        quant_pre_process(float_path, prepared)
+        quantize_static(prepared, int8_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=methods[method],
+                        extra_options={'CalibMaxIntermediateOutputs': _CALIBRATION_FLUSH})
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def quantize_ensemble(name: str, stage_folder: str, dataset, indices: Sequence[int],
+                      method: str = 'minmax') -> List[str]:
+    """
+    Quantizes every member graph of an ensemble.
+
+    :param name: one of QUANTIZED_ENSEMBLES
+    :param stage_folder: the stage folder, with the float graphs in ONNX_FOLDER
+    :param dataset: see fundus_dataset
+    :param indices: the calibration images of the dataset
+    :return: the quantized graphs, in member order
+    """
+    float_paths = graph_paths(os.path.join(stage_folder, ONNX_FOLDER), name)
+    int8_paths = []
+    for index, float_path in enumerate(float_paths):
+        int8_path = os.path.join(stage_folder, INT8_FOLDER, os.path.basename(float_path))
+        quantize_graph(float_path, int8_path,
+                       CalibrationReader(calibration_feeds(name, index, dataset, indices, float_paths)), method)
+        int8_paths.append(int8_path)
+    return int8_paths
+
+
+def ensemble_prediction(name: str, models, x):
+    """
+    The mean activated output of an ensemble, as its stage averages it.
+
+    :param name: one of QUANTIZED_ENSEMBLES
+    :param models: what automorph_onnx.load_ensemble gives for it
+    :param x: a batch of the stage
+    """
+    import torch
+    import torch.nn.functional as F
+    from automorph_ensemble import RunningMoments
+
+    if name == 'vessel':
+        return models.mean_std(x, activation=torch.sigmoid)[0]
+    moments = RunningMoments()
+    if name == 'artery_vein':
+        for net_G, net_G_A, net_G_V in zip(models[0::3], models[1::3], models[2::3]):
+            _, fusion_A = net_G_A(x)
+            _, fusion_V = net_G_V(x)
+            moments.update(F.softmax(net_G(x, fusion_A, fusion_V)[0], dim=1))
+    else:
+        for model in models:
+            moments.update(F.softmax(model(x)[1], dim=1))
+    return moments.mean
+
+
+def decode(name: str, mean) -> np.ndarray:
+    """The class of every pixel, from the mean output, as the stage decodes it before writing its masks."""
+    if name == 'vessel':
+        return (mean[:, 0] >= 0.5).long().cpu().numpy()
+    return mean.argmax(dim=1).cpu().numpy()
+
+
+def dice(reference: np.ndarray, mask: np.ndarray) -> float:
+    """The Dice coefficient of two boolean masks, 1 when both are empty."""
+    total = int(reference.sum()) + int(mask.sum())
+    return 1.0 if total == 0 else 2.0 * int(np.logical_and(reference, mask).sum()) / total
+
+
+def agreement(name: str, float_models, int8_models, dataset, indices: Sequence[int]) -> pd.DataFrame:
+    """
+    Segments images with the float and with the INT8 graphs of an ensemble and compares the masks.
+
+    :param name: one of QUANTIZED_ENSEMBLES
+    :param dataset: see fundus_dataset
+    :param indices: the report images of the dataset
+    :return: one row per image, with the Dice coefficient of every mask of MASKS
+    """
+    import torch
+
+    rows = []
+    with torch.no_grad():
+        for index in indices:
+            item = dataset[index]
+            x = item['image'][np.newaxis].float()
+            reference = decode(name, ensemble_prediction(name, float_models, x))[0]
+            decoded = decode(name, ensemble_prediction(name, int8_models, x))[0]
+            row = {'Ensemble': name, 'Name': item['name']}
+            for mask, classes in MASKS[name]:
+                row[f'{mask}_dice'] = dice(np.isin(reference, classes), np.isin(decoded, classes))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def feature_drift(reference_folder: str, result_folder: str) -> pd.DataFrame:
+    """
+    Compares the M3 features of two results folders of the same images.
+
+    Images whose measurement failed, -1, in one folder only are counted apart and left out of the
+    differences.
+
+    :param reference_folder: the reference results, e.g. of the float models
+    :param result_folder: the results compared with them
+    :return: one row per table and feature, with the mean and largest absolute difference, the mean
+             difference relative to the reference value and the images that failed in one folder only
+    """
+    rows = []
+    for reference_path in stage_tables(reference_folder, 'M3'):
+        table = reference_path.relative_to(reference_folder)
+        path = Path(result_folder) / table
+        if not path.exists():
+            continue
+        reference = pd.read_csv(reference_path).astype({'Name': str}).set_index('Name')
+        result = pd.read_csv(path).astype({'Name': str}).set_index('Name')
+        names = reference.index.intersection(result.index)
+        for column in reference.columns.intersection(result.columns):
+            if not (pd.api.types.is_numeric_dtype(reference[column]) and pd.api.types.is_numeric_dtype(result[column])):
+                continue
+            before, after = reference.loc[names, column].to_numpy(float), result.loc[names, column].to_numpy(float)
+            failed = (before == -1) != (after == -1)
+            valid = ~failed & (before != -1) & np.isfinite(before) & np.isfinite(after)
+            difference = np.abs(after[valid] - before[valid])
+            relative = difference / np.maximum(np.abs(before[valid]), np.finfo(float).eps)
+            rows.append({'Table': str(table), 'Feature': column, 'Images': int(valid.sum()),
+                         'Mean_abs_difference': float(difference.mean()) if len(difference) else np.nan,
+                         'Max_abs_difference': float(difference.max()) if len(difference) else np.nan,
+                         'Mean_relative_difference': float(relative.mean()) if len(relative) else np.nan,
+                         'Failed_in_one': int(failed.sum())})
+    return pd.DataFrame(rows)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Quantize the AutoMorph segmentation ensembles to INT8 and report '
+                                                 'their agreement with the float graphs.')
+    parser.add_argument('--image_folder', default='Results/M1/Good_quality',
+                        help='The gradable images the calibration and the report draw from.')
+    parser.add_argument('--only', nargs='+', default=None, choices=QUANTIZED_ENSEMBLES,
+                        help='Only quantize these ensembles.')
+    parser.add_argument('--calibration', type=int, default=300, help='Number of calibration images.')
+    parser.add_argument('--report', type=int, default=100,
+                        help='Number of other images the INT8 masks are compared with the float ones on.')
+    parser.add_argument('--method', default='minmax', choices=CALIBRATION_METHODS,
+                        help='How the activation ranges are taken from the calibration.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the draw of the images.')
+    parser.add_argument('--output', default='automorph_quantization.csv',
+                        help='Write the per-image agreement, or the feature drift, to this CSV file.')
+    parser.add_argument('--drift', nargs=2, default=None, metavar=('FLOAT_RESULTS', 'INT8_RESULTS'),
+                        help='Only compare the M3 features of two results folders of the same images.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = get_args(argv)
+    if args.drift:
+        drift = feature_drift(*args.drift)
+        drift.to_csv(args.output, index=False, encoding='utf8')
+        print(drift.to_string(index=False))
+        return 0
+
+    from automorph_pipeline import ENSEMBLE_STAGES
+
+    image_folder = os.path.abspath(args.image_folder)
+    reports = []
+    for name in QUANTIZED_ENSEMBLES:
+        if args.only and name not in args.only:
+            continue
+        stage_folder = str(ROOT / ENSEMBLE_STAGES[name])
+        dataset = fundus_dataset(name, image_folder)
+        calibration, report = split_images(len(dataset), args.calibration, args.report, args.seed)
+        print(f'{name}: calibrating on {len(calibration)} images')
+        for path in quantize_ensemble(name, stage_folder, dataset, calibration, args.method):
+            print(f'    {os.path.relpath(path, ROOT)}')
+        if not report:
+            continue
+        table = agreement(name, load_ensemble(os.path.join(stage_folder, ONNX_FOLDER), name),
+                          load_ensemble(os.path.join(stage_folder, INT8_FOLDER), name, checked=False), dataset, report)
+        for mask, _ in MASKS[name]:
+            scores = table[f'{mask}_dice']
+            print(f'    {mask:<8} Dice over {len(scores)} images: mean {scores.mean():.4f}  min {scores.min():.4f}')
+        reports.append(table)
+    if reports:
+        pd.concat(reports, ignore_index=True).to_csv(args.output, index=False, encoding='utf8')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
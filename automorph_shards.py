@@ -0,0 +1,118 @@
+"""Deterministic split of an image folder across independent runs, and the merge of their results."""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import List, Tuple
+
+from automorph_manifest import STAGES, RunManifest, merge_results
+
+SHARDS_FOLDER = 'shards'
+_SHARD_PATTERN = re.compile(r'shard-(\d+)-of-(\d+)$')
+
+
+def shard_of(name: str, shard_count: int) -> int:
+    """
+    The shard an image belongs to, from a hash of its file name.
+
+    The partition only depends on the name and the number of shards, so every node computes the
+    same one without listing the folder in the same order or talking to the others.
+    """
+    digest = hashlib.sha256(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def shard_name(shard_index: int, shard_count: int) -> str:
+    return f'shard-{shard_index:04d}-of-{shard_count:04d}'
+
+
+def check_shard(shard_index: int, shard_count: int):
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f'invalid shard {shard_index} of {shard_count}, the index must be in [0, shard_count)')
+
+
+def prepare_shard(image_folder: str, result_folder: str, shard_index: int, shard_count: int) -> Tuple[str, str]:
+    """
+    Creates the image and results folders of a shard under result_folder/shards.
+
+    The image folder of the shard holds symbolic links to the images of the shard, and is brought
+    up to date with the input folder when the shard runs again. The two folders are siblings, as
+    the stages expect from images/ and Results/.
+
+    :return: the image folder and the results folder of the shard
+    """
+    check_shard(shard_index, shard_count)
+    shard_folder = Path(result_folder) / SHARDS_FOLDER / shard_name(shard_index, shard_count)
+    shard_images = shard_folder / 'images'
+    shard_results = shard_folder / 'Results'
+    shard_images.mkdir(parents=True, exist_ok=True)
+    shard_results.mkdir(exist_ok=True)
+
+    names = {entry.name for entry in os.scandir(image_folder)
+             if entry.is_file() and shard_of(entry.name, shard_count) == shard_index}
+    for entry in os.scandir(shard_images):
+        if entry.name not in names:
+            os.unlink(entry.path)
+    for name in sorted(names):
+        link = shard_images / name
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(image_folder, name), link)
+    print(f'Shard {shard_index} of {shard_count}: {len(names)} images')
+    return str(shard_images), str(shard_results)
+
+
+def shard_folders(result_folder: str) -> List[Path]:
+    """
+    The shard folders of a results folder, in shard order.
+
+    :raises ValueError: when the shards do not all come from the same split, or some are missing
+    """
+    root = Path(result_folder) / SHARDS_FOLDER
+    if not root.is_dir():
+        return []
+    shards = {}
+    for path in root.iterdir():
+        match = _SHARD_PATTERN.match(path.name)
+        if match and path.is_dir():
+            shards[(int(match.group(1)), int(match.group(2)))] = path
+    counts = {shard_count for _, shard_count in shards}
+    if len(counts) > 1:
+        raise ValueError(f'{root} holds shards of different splits: {sorted(counts)} shards')
+    if not shards:
+        return []
+    shard_count = counts.pop()
+    missing = [index for index in range(shard_count) if (index, shard_count) not in shards]
+    if missing:
+        raise ValueError(f'{root} is missing the shards {missing} of {shard_count}')
+    return [shards[(index, shard_count)] for index in range(shard_count)]
+
+
+def merge_shards(result_folder: str):
+    """
+    Merges the results of every shard into the results folder, then removes the shards.
+
+    The per-image files are moved, and the rows of the tables of every stage (M0/crop_info.csv,
+    M1/results_ensemble.csv, the Disc_cup_results.csv and feature tables of M3...) are combined
+    and sorted by image name, so the merged tables do not depend on the order the shards finished
+    in. The manifests of the shards are merged too, so the merged folder can be updated with an
+    incremental run.
+    """
+    folders = shard_folders(result_folder)
+    if not folders:
+        print(f'No shards to merge in {result_folder}')
+        return
+    shard_results = [str(folder / 'Results') for folder in folders]
+    for stage in STAGES:
+        merge_results(shard_results, result_folder, stage)
+
+    manifest = RunManifest.load(result_folder)
+    for folder in shard_results:
+        manifest.images.update(RunManifest.load(folder).images)
+    if manifest.images:
+        manifest.save()
+
+    shutil.rmtree(Path(result_folder) / SHARDS_FOLDER)
+    print(f'Merged {len(folders)} shards into {result_folder}')
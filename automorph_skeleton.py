@@ -0,0 +1,286 @@
+"""Vectorised helpers shared by the M2 and M3 stages for working on vessel skeletons."""
+from __future__ import annotations
+
+import os
+import tempfile
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from automorph_timing import span
+
+# 8-connected neighbourhood, the centre pixel is not counted
+NEIGHBOUR_KERNEL = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=np.uint8)
+
+# footprint of cv2.circle(radius=1, thickness=-1), which was used to erase junctions
+_ERASE_FOOTPRINT = ndimage.generate_binary_structure(2, 1)
+
+# skeletons written by the M2 modules, relative to the results folder
+SKELETON_PATHS = {
+    'binary': 'M2/binary_vessel/binary_skeleton',
+    'artery': 'M2/artery_vein/artery_binary_skeleton',
+    'vein': 'M2/artery_vein/vein_binary_skeleton',
+}
+
+
+def neighbour_count(skeleton: np.ndarray) -> np.ndarray:
+    """
+    Counts the active 8-neighbours of every pixel of the skeleton in a single convolution.
+
+    Out of range neighbours are clamped to the image border, as the former per-pixel scan did.
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :return: an uint8 array with the same shape as skeleton holding the neighbour count
+    """
+    active = (np.asarray(skeleton) > 0).astype(np.uint8)
+    return ndimage.correlate(active, NEIGHBOUR_KERNEL, mode='nearest')
+
+
+def junction_pixels(skeleton: np.ndarray, ignored_pixels: int = 1) -> np.ndarray:
+    """
+    Detects the skeleton pixels with more than two active neighbours (bifurcations and crossings).
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :param ignored_pixels: how many pixels will be ignored from borders
+    :return: a boolean array with the junction pixels set
+    """
+    skeleton = np.asarray(skeleton)
+    junctions = (skeleton > 0) & (neighbour_count(skeleton) > 2)
+    if ignored_pixels > 0:
+        junctions[:ignored_pixels, :] = False
+        junctions[-ignored_pixels:, :] = False
+        junctions[:, :ignored_pixels] = False
+        junctions[:, -ignored_pixels:] = False
+    return junctions
+
+
+def junction_mask(skeleton: np.ndarray, ignored_pixels: int = 1) -> np.ndarray:
+    """
+    Builds the mask that removes every junction and its 4-connected neighbourhood from the skeleton,
+    so the remaining pixels split into separate vessel segments.
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :param ignored_pixels: how many pixels will be ignored from borders
+    :return: a float array of ones with zeros on the erased pixels
+    """
+    erased = ndimage.binary_dilation(junction_pixels(skeleton, ignored_pixels), structure=_ERASE_FOOTPRINT)
+    mask = np.ones(np.shape(skeleton))
+    mask[erased] = 0
+    return mask
+
+
+def remove_junctions(skeleton: np.ndarray, ignored_pixels: int = 1) -> np.ndarray:
+    """
+    Removes the intersections of the skeleton in case the whole vessel is too long.
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :param ignored_pixels: how many pixels will be ignored from borders
+    :return: the skeleton multiplied by its junction mask
+    """
+    return skeleton * junction_mask(skeleton, ignored_pixels)
+
+
+def trace_segments(skeleton: np.ndarray, ignored_pixels: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits a skeleton into its 8-connected segments, in the same order and with the same pixel
+    order as retipy's detect_vessel_border: segments start at the first pixel in raster order that
+    is not within ignored_pixels of the border, and their pixels are visited breadth first.
+
+    A pixel is added to a segment when it is first reached, so a breadth first search lists the
+    pixels in the order it queues them: the preallocated int32 frontier is the output itself, and
+    a bitmap with a blank border lets every neighbour be a fixed offset of the flat pixel index.
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :param ignored_pixels: how many pixels will be ignored from borders when looking for a start
+    :return: a tuple with the (N, 2) int32 array of the pixel coordinates of all segments, one
+             after the other, and the (S + 1,) int64 array with the offset of each segment in it
+    """
+    active = np.asarray(skeleton) > 0
+    height, width = active.shape
+    stride = width + 2
+    padded = np.zeros((height + 2, stride), dtype=np.uint8)
+    padded[1:-1, 1:-1] = active
+    pending = bytearray(padded.tobytes())
+    # same neighbour order as retipy, the clamped duplicates it visited at the border did not change it
+    steps = (-stride - 1, -stride, -stride + 1, -1, 1, stride - 1, stride, stride + 1)
+
+    interior = active[ignored_pixels:height - ignored_pixels, ignored_pixels:width - ignored_pixels]
+    starts = ((np.argwhere(interior) + ignored_pixels + 1) @ np.array([stride, 1])).tolist()
+
+    frontier = array('i', bytes(np.dtype(np.intc).itemsize * int(np.count_nonzero(active))))
+    tail = 0
+    offsets = [0]
+    for start in starts:
+        if not pending[start]:
+            continue
+        pending[start] = 0
+        head = tail
+        frontier[tail] = start
+        tail += 1
+        while head < tail:
+            pixel = frontier[head]
+            head += 1
+            for step in steps:
+                neighbour = pixel + step
+                if pending[neighbour]:
+                    pending[neighbour] = 0
+                    frontier[tail] = neighbour
+                    tail += 1
+        offsets.append(tail)
+
+    rows, columns = np.divmod(np.frombuffer(frontier, dtype=np.intc)[:tail], stride)
+    coords = np.empty((tail, 2), dtype=np.int32)
+    coords[:, 0] = rows - 1
+    coords[:, 1] = columns - 1
+    return coords, np.array(offsets, dtype=np.int64)
+
+
+def endpoint_pixels(skeleton: np.ndarray) -> np.ndarray:
+    """
+    Detects the skeleton pixels with exactly one active neighbour.
+
+    :param skeleton: a 2D array, any value above zero is considered part of the skeleton
+    :return: a boolean array with the end pixels set
+    """
+    skeleton = np.asarray(skeleton)
+    return (skeleton > 0) & (neighbour_count(skeleton) == 1)
+
+
+class SkeletonGraph(object):
+    """
+    Vessel segments, junctions and end points of the binary, artery and vein skeletons of an image.
+
+    The segments are the ones traced by detect_vessel_border once the junctions are removed, so the
+    feature scripts can filter them instead of tracing every skeleton again.
+
+    :param shape: the shape of the skeletons the graph was built from
+    :param layers: a dictionary with, for every kind of skeleton, the arrays 'coords', 'offsets',
+                   'junctions' and 'endpoints'
+    """
+    KINDS = ('binary', 'artery', 'vein')
+    _FIELDS = ('coords', 'offsets', 'junctions', 'endpoints')
+
+    def __init__(self, shape: Tuple[int, int], layers: Dict[str, Dict[str, np.ndarray]]):
+        self.shape = tuple(int(v) for v in shape)
+        self._layers = layers
+
+    @classmethod
+    def build(cls, skeletons: Dict[str, np.ndarray], ignored_pixels: int = 1) -> 'SkeletonGraph':
+        """
+        Builds the graph of the given skeletons.
+
+        :param skeletons: a dictionary from the kind of skeleton to its image
+        :param ignored_pixels: how many pixels will be ignored from borders
+        """
+        layers = {}
+        shape = None
+        for kind, skeleton in skeletons.items():
+            shape = np.shape(skeleton)
+            segmented = remove_junctions(skeleton, ignored_pixels)
+            coords, offsets = trace_segments(segmented, ignored_pixels)
+            layers[kind] = {
+                'coords': coords,
+                'offsets': offsets,
+                'junctions': np.argwhere(junction_pixels(skeleton, ignored_pixels)).astype(np.int32),
+                'endpoints': np.argwhere(endpoint_pixels(segmented)).astype(np.int32),
+            }
+        return cls(shape, layers)
+
+    def save(self, file_path: str):
+        """Stores the graph in a compressed npz file, written atomically."""
+        arrays = {'shape': np.array(self.shape, dtype=np.int32)}
+        for kind, layer in self._layers.items():
+            for field in self._FIELDS:
+                arrays['{}_{}'.format(kind, field)] = layer[field]
+        directory, name = os.path.split(file_path)
+        os.makedirs(directory or '.', exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory or '.', prefix=name, suffix='.tmp', delete=False) as handle:
+            np.savez_compressed(handle, **arrays)
+        os.replace(handle.name, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> 'SkeletonGraph':
+        """Loads a graph stored with save()."""
+        with np.load(file_path) as data:
+            layers = {}
+            for key in data.files:
+                if key == 'shape':
+                    continue
+                kind, field = key.rsplit('_', 1)
+                layers.setdefault(kind, {})[field] = data[key]
+            return cls(tuple(data['shape']), layers)
+
+    def junctions(self, kind: str) -> np.ndarray:
+        """(J, 2) coordinates of the junctions removed from the skeleton."""
+        return self._layers[kind]['junctions']
+
+    def endpoints(self, kind: str) -> np.ndarray:
+        """(E, 2) coordinates of the segment end points."""
+        return self._layers[kind]['endpoints']
+
+    def segments(self, kind: str) -> List[np.ndarray]:
+        """List with the (N, 2) pixel coordinates of every segment, in tracing order."""
+        layer = self._layers[kind]
+        return np.split(layer['coords'], layer['offsets'][1:-1]) if len(layer['offsets']) > 1 else []
+
+    def vessels(self, kind: str, within: Optional[np.ndarray] = None, ignored_pixels: int = 1) -> list:
+        """
+        Returns the vessels with the same content and order as detect_vessel_border.
+
+        :param kind: the kind of skeleton, one of KINDS
+        :param within: optional boolean image, only the segment pixels set in it are kept. Segments
+                       cut by it are traced again, the others are reused as they are
+        :param ignored_pixels: how many pixels will be ignored from borders
+        :return: a list of [x, y] int32 arrays with the points of each vessel
+        """
+        segments = self.segments(kind)
+        if within is not None:
+            kept = []
+            cut = np.zeros(self.shape, dtype=bool)
+            for segment in segments:
+                inside = within[segment[:, 0], segment[:, 1]]
+                if inside.all():
+                    kept.append(segment)
+                elif inside.any():
+                    cut[segment[inside, 0], segment[inside, 1]] = True
+            if cut.any():
+                coords, offsets = trace_segments(cut, ignored_pixels)
+                kept.extend(np.split(coords, offsets[1:-1]))
+            segments = sorted(kept, key=lambda segment: (segment[0, 0], segment[0, 1]))
+        return [[segment[:, 0], segment[:, 1]] for segment in segments]
+
+
+def skeleton_graph(result_folder: str, name: str, size: Tuple[int, int] = (912, 912)) -> SkeletonGraph:
+    """
+    Returns the skeleton graph of an image, building it from the M2 skeletons on first use.
+
+    The graph is cached in <result_folder>/M3/skeleton_graph/<name>.npz so every feature script of
+    the run shares it, and built again when one of the skeletons is newer than the cached graph.
+
+    :param result_folder: the AutoMorph results folder
+    :param name: the image file name, e.g. 1.png
+    :param size: the size the skeletons are resized to, as retipy does when opening them
+    """
+    graph_path = os.path.join(result_folder, 'M3', 'skeleton_graph', os.path.splitext(name)[0] + '.npz')
+    skeleton_paths = {kind: os.path.join(result_folder, relative_path, name)
+                      for kind, relative_path in SKELETON_PATHS.items()}
+    if os.path.exists(graph_path):
+        graph_time = os.path.getmtime(graph_path)
+        if all(not os.path.exists(path) or os.path.getmtime(path) <= graph_time for path in skeleton_paths.values()):
+            return SkeletonGraph.load(graph_path)
+
+    skeletons = {}
+    for kind, skeleton_path in skeleton_paths.items():
+        skeleton = cv2.imread(skeleton_path, cv2.IMREAD_GRAYSCALE)
+        if skeleton is None:
+            raise FileNotFoundError(skeleton_path)
+        if skeleton.shape != size:
+            skeleton = cv2.resize(skeleton, dsize=size, interpolation=cv2.INTER_CUBIC)
+        skeletons[kind] = skeleton
+    with span('M3.vessel_tracing', images=1, image=name):
+        graph = SkeletonGraph.build(skeletons)
+    graph.save(graph_path)
+    return graph
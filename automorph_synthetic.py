@@ -0,0 +1,95 @@
+"""Synthetic fundus photographs drawn from a fixed seed, and the inputs the model ensembles are traced,
+exported, frozen and benchmarked on.
+
+Only numpy and OpenCV are needed to draw them, torch is imported by ensemble_input alone.
+"""
+from __future__ import annotations
+
+import math
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+
+SEED = 2023
+
+# the input size of every ensemble, as their datasets resize the images
+ENSEMBLE_SIZES = {'quality': 512, 'vessel': 912, 'artery_vein': 720, 'disc_cup': 512}
+
+
+def _tree(rng: np.random.Generator, canvas: np.ndarray, start: Tuple[float, float], angle: float, width: float,
+          length: float, depth: int, step: float):
+    # a vessel and its branches as random walks with slowly turning directions
+    stack = [(start, angle, width, length, depth)]
+    while stack:
+        (x, y), angle, width, length, depth = stack.pop()
+        points = [(x, y)]
+        for _ in range(max(2, int(length / step))):
+            angle += rng.normal(0.0, 0.08)
+            x, y = x + step * math.cos(angle), y + step * math.sin(angle)
+            points.append((x, y))
+            if depth > 0 and rng.random() < 0.04:
+                side = 1 if rng.random() < 0.5 else -1
+                stack.append(((x, y), angle + side * rng.uniform(0.4, 0.9), width * 0.7, length * 0.55, depth - 1))
+        cv2.polylines(canvas, [np.round(np.array(points)).astype(np.int32)], False, 255,
+                      thickness=max(1, int(round(width))), lineType=cv2.LINE_8)
+
+
+def synthetic_fundus(width: int, height: int, seed: int = SEED) -> Dict[str, np.ndarray]:
+    """
+    Draws a fundus photograph with its vessel, optic disc and cup maps.
+
+    The field of view is a disc with a darker rim, the optic disc sits on one side of the centre
+    and the arteries and veins leave it in arcades that branch as they go. The same arguments
+    always give the same pixels.
+
+    :param width: the width of the photograph
+    :param height: the height of the photograph
+    :param seed: the seed of the random walks and of the noise
+    :return: 'image', the BGR uint8 photograph, and the boolean 'artery', 'vein', 'vessel', 'disc'
+             and 'cup' maps, all at the same size
+    """
+    rng = np.random.default_rng(seed)
+    radius = 0.47 * min(width, height)
+    cx, cy = width / 2.0, height / 2.0
+    scale = radius / 428.0
+    yy, xx = np.mgrid[0:height, 0:width]
+    distance = np.hypot(xx - cx, yy - cy) / radius
+    fov = distance <= 1.0
+
+    disc_x, disc_y = cx + 0.38 * radius * (1 if seed % 2 else -1), cy - 0.05 * radius
+    disc_radius = 0.1 * radius
+    disc = np.hypot(xx - disc_x, yy - disc_y) <= disc_radius
+    cup = np.hypot(xx - disc_x, yy - disc_y) <= 0.5 * disc_radius
+
+    artery = np.zeros((height, width), np.uint8)
+    vein = np.zeros((height, width), np.uint8)
+    towards_centre = math.pi if disc_x > cx else 0.0
+    for canvas, offset, thickness in ((artery, 0.75, 7.0), (vein, 0.95, 9.0), (artery, -0.75, 7.0), (vein, -0.95, 9.0)):
+        angle = towards_centre + offset * (1 if towards_centre == 0.0 else -1)
+        _tree(rng, canvas, (disc_x, disc_y), angle, thickness * scale, 1.6 * radius, 3, 4.0 * scale)
+    for canvas, offset in ((artery, 0.4), (vein, -0.4)):
+        _tree(rng, canvas, (disc_x, disc_y), math.pi - towards_centre + offset, 4.0 * scale, 0.7 * radius, 2, 4.0 * scale)
+    artery = (artery > 0) & fov & ~disc
+    vein = (vein > 0) & fov & ~disc & ~artery
+
+    shade = np.clip(1.0 - 0.35 * distance ** 2, 0.0, 1.0)[..., np.newaxis]
+    image = np.array([40.0, 95.0, 190.0]) * shade + rng.normal(0.0, 3.0, (height, width, 3))
+    image[artery] = np.array([35.0, 45.0, 150.0]) + rng.normal(0.0, 3.0, (int(artery.sum()), 3))
+    image[vein] = np.array([30.0, 35.0, 115.0]) + rng.normal(0.0, 3.0, (int(vein.sum()), 3))
+    image[disc] = np.array([120.0, 200.0, 240.0])
+    image[cup] = np.array([170.0, 230.0, 250.0])
+    image[~fov] = rng.integers(0, 4, (int((~fov).sum()), 1))
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return {'image': image, 'artery': artery, 'vein': vein, 'vessel': artery | vein, 'disc': disc & fov, 'cup': cup & fov}
+
+
+def ensemble_input(name: str, device):
+    """A synthetic fundus normalised as the dataset of an ensemble gives it, as a (1, 3, H, W) batch."""
+    import torch
+
+    size = ENSEMBLE_SIZES[name]
+    image = synthetic_fundus(size, size)['image'][..., ::-1].astype(np.float32)
+    inside = image[image > 0]
+    image = (image - inside.mean()) / inside.std()
+    return torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))[np.newaxis].to(device)
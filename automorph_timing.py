@@ -0,0 +1,162 @@
+"""Wall time, CPU time and throughput of the stages and of their sub-steps, as JSON and Chrome traces.
+
+Recording is off unless the AUTOMORPH_TRACE_DIR environment variable names a folder, then every
+process of the run, the M0 pool and the DataLoader workers included, appends its events to its own
+events-<pid>.jsonl file there. write_report() combines them into trace.json, which chrome://tracing
+and Perfetto open, and timing.json, the totals of every step with its images per second.
+
+Step names are dotted, the first part is the stage (M0.decode, M2.vessel.forward...). A step timed
+on a CUDA device should be given the device, so the asynchronous kernels are waited for before the
+clock stops.
+"""
+from __future__ import annotations
+
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+TRACE_DIR_ENV = 'AUTOMORPH_TRACE_DIR'
+
+_lock = threading.Lock()
+_files = {}  # type: Dict[int, object]
+
+
+def trace_dir() -> Optional[str]:
+    """The folder the events are written to, None when recording is off."""
+    return os.environ.get(TRACE_DIR_ENV) or None
+
+
+def enabled() -> bool:
+    return trace_dir() is not None
+
+
+def _synchronize(device):
+    if device is not None and str(getattr(device, 'type', device)).startswith('cuda'):
+        import torch
+        torch.cuda.synchronize(device)
+
+
+def _emit(name: str, start_ns: int, wall: float, cpu: float, images: Optional[int], args: dict):
+    folder = trace_dir()
+    if folder is None:
+        return
+    pid = os.getpid()
+    event = {'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'ts': start_ns / 1000.0, 'dur': wall * 1e6,
+             'pid': pid, 'tid': threading.get_ident(), 'args': dict(args, cpu_ms=cpu * 1000.0)}
+    if images is not None:
+        event['args']['images'] = images
+    line = json.dumps(event) + '\n'
+    with _lock:
+        # the file of a forked process is not the one of its parent
+        handle = _files.get(pid)
+        if handle is None:
+            os.makedirs(folder, exist_ok=True)
+            handle = _files[pid] = open(os.path.join(folder, f'events-{pid}.jsonl'), 'a', buffering=1, encoding='utf-8')
+        handle.write(line)
+
+
+@contextmanager
+def span(name: str, images: Optional[int] = None, device=None, **args) -> Iterator[None]:
+    """
+    Times the block it wraps.
+
+    :param name: the step, prefixed with its stage
+    :param images: the number of images the block processes, for the throughput
+    :param device: the torch device the block runs on, CUDA ones are synchronized before stopping
+    :param args: more details kept with the event, e.g. the image name
+    """
+    if not enabled():
+        yield
+        return
+    _synchronize(device)
+    start_ns = time.time_ns()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        _synchronize(device)
+        _emit(name, start_ns, time.perf_counter() - wall, time.process_time() - cpu, images, args)
+
+
+class Stopwatch(object):
+    """
+    Time of a step that runs many times inside a loop, recorded as a single event.
+
+    Use it as a context manager around every run of the step, then call record() once, so the
+    inner loops of M3 do not write an event per vessel.
+
+    :param device: the torch device the step runs on, see span()
+    """
+
+    def __init__(self, device=None):
+        self.device = device
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self._start_ns = None  # type: Optional[int]
+        self._started = None
+
+    def __enter__(self):
+        if enabled():
+            _synchronize(self.device)
+            if self._start_ns is None:
+                self._start_ns = time.time_ns()
+            self._started = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._started is not None:
+            _synchronize(self.device)
+            wall, cpu = self._started
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+            self.calls += 1
+            self._started = None
+        return False
+
+    def record(self, name: str, images: Optional[int] = None, **args):
+        """Writes the accumulated time as one event starting at the first run, then starts over."""
+        if self._start_ns is not None:
+            _emit(name, self._start_ns, self.wall, self.cpu, images, dict(args, calls=self.calls))
+        self.wall, self.cpu, self.calls, self._start_ns = 0.0, 0.0, 0, None
+
+
+def reset(folder: str):
+    """Removes the events of an earlier run from a trace folder."""
+    for path in glob.glob(os.path.join(folder, 'events-*.jsonl')):
+        os.remove(path)
+
+
+def write_report(folder: str) -> dict:
+    """
+    Combines the events of every process of a trace folder into trace.json and timing.json.
+
+    :return: the summary written to timing.json, for every step its number of events, wall and CPU
+             seconds, images, images per second and milliseconds per image
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(folder, 'events-*.jsonl'))):
+        with open(path, encoding='utf-8') as handle:
+            events.extend(json.loads(line) for line in handle if line.strip())
+    events.sort(key=lambda event: event['ts'])
+    with open(os.path.join(folder, 'trace.json'), 'w', encoding='utf-8') as handle:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, handle)
+
+    steps = {}  # type: Dict[str, dict]
+    for event in events:
+        step = steps.setdefault(event['name'], {'events': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'images': 0})
+        step['events'] += 1
+        step['wall_s'] += event['dur'] / 1e6
+        step['cpu_s'] += event['args'].get('cpu_ms', 0.0) / 1000.0
+        step['images'] += event['args'].get('images', 0)
+    for step in steps.values():
+        step['images_per_s'] = step['images'] / step['wall_s'] if step['images'] and step['wall_s'] else None
+        step['ms_per_image'] = 1000.0 * step['wall_s'] / step['images'] if step['images'] else None
+    summary = {'steps': dict(sorted(steps.items())), 'processes': len({event['pid'] for event in events})}
+    with open(os.path.join(folder, 'timing.json'), 'w', encoding='utf-8') as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
@@ -0,0 +1,204 @@
+"""Tortuosity measures of every vessel of an image at once, on the flattened pixels of the vessels.
+
+The vessels are given the way automorph_skeleton.trace_segments returns them: the (N, 2) coordinates
+of the pixels of every vessel one after the other, and the (S + 1,) offsets of the vessels in them.
+Every measure returns one value per vessel, the same as the retipy function of the same name
+called on the x (row) and y (column) points of the vessel, to the rounding of the sums.
+
+The per-vessel sums are accumulated with np.bincount, which adds the values in order like the
+Python loops of retipy, so most measures come out identical.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+def pack_vessels(vessels: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flattens vessels as returned by detect_vessel_border.
+
+    :param vessels: the [x, y] points of every vessel
+    :return: the (N, 2) int32 coordinates of the vessel pixels and the (S + 1,) int64 offsets
+    """
+    offsets = np.zeros(len(vessels) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(vessel[0]) for vessel in vessels])
+    coords = np.empty((offsets[-1], 2), dtype=np.int32)
+    for vessel, begin, end in zip(vessels, offsets[:-1], offsets[1:]):
+        coords[begin:end, 0] = vessel[0]
+        coords[begin:end, 1] = vessel[1]
+    return coords, offsets
+
+
+def _segment_ids(offsets: np.ndarray) -> np.ndarray:
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _power(values: np.ndarray, exponent: float) -> np.ndarray:
+    # Python's ** of every distinct value: neither np.sqrt nor np.power round like the C pow retipy
+    # goes through, and the squared distances and derivatives of pixels only take a few values
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([value ** exponent for value in distinct.tolist()], dtype=np.float64)[inverse].reshape(np.shape(values))
+
+
+def _distance(x: np.ndarray, y: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    return _power((x[second] - x[first]) ** 2 + (y[second] - y[first]) ** 2, 0.5)
+
+
+class VesselBatch(object):
+    """
+    The vessels of an image and the intermediate arrays their measures share.
+
+    :param coords: the (N, 2) coordinates of the vessel pixels, every vessel is at least 2 pixels long
+    :param offsets: the (S + 1,) offsets of the vessels in coords
+    """
+
+    def __init__(self, coords: np.ndarray, offsets: np.ndarray):
+        self.x = np.asarray(coords[:, 0], dtype=np.int64)
+        self.y = np.asarray(coords[:, 1], dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.count = len(self.offsets) - 1
+        self.lengths = np.diff(self.offsets)
+        self.segments = _segment_ids(self.offsets)
+        # steps from a pixel to the next one of the same vessel
+        self._within = self.segments[1:] == self.segments[:-1]
+        self._steps = _distance(self.x, self.y, np.arange(len(self.x) - 1), np.arange(1, len(self.x)))
+        self._inflections = None
+
+    def _sum(self, segments: np.ndarray, values: np.ndarray, count: int = None) -> np.ndarray:
+        return np.bincount(segments, weights=values, minlength=self.count if count is None else count)
+
+    def curve_length(self) -> np.ndarray:
+        """Length of every vessel, from pixel to pixel, as retipy's _curve_length."""
+        return self._sum(self.segments[:-1][self._within], self._steps[self._within])
+
+    def chord_length(self) -> np.ndarray:
+        """Distance between the first and the last pixel of every vessel, as _chord_length."""
+        return _distance(self.x, self.y, self.offsets[:-1], self.offsets[1:] - 1)
+
+    def distance_measure(self) -> np.ndarray:
+        """Arc-chord ratio of every vessel, as distance_measure_tortuosity."""
+        return self.curve_length() / self.chord_length()
+
+    def inflection_points(self) -> np.ndarray:
+        """
+        Indexes in coords of the inflection points, as _detect_inflection_points: the pixels where
+        the sign of the change of y differs before and after them.
+        """
+        if self._inflections is None:
+            signs = np.sign(np.diff(self.y))
+            change = (signs[1:] != signs[:-1]) & self._within[1:] & self._within[:-1]
+            self._inflections = np.flatnonzero(change) + 1
+        return self._inflections
+
+    def inflection_count(self) -> np.ndarray:
+        """Number of inflection points of every vessel."""
+        return np.bincount(self.segments[self.inflection_points()], minlength=self.count)
+
+    def distance_inflection_count(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Arc-chord ratio times the inflection count plus 1, and the count, as distance_inflection_count_tortuosity."""
+        count = self.inflection_count()
+        return self.distance_measure() * (count + 1), count
+
+    def squared_curvature(self) -> np.ndarray:
+        """
+        Squared curvature tortuosity of every vessel, as squared_curvature_tortuosity: the trapezoid
+        integral of the curvature at the inner pixels, from centred derivatives.
+        """
+        inner = np.flatnonzero(self._within[1:] & self._within[:-1]) + 1
+        x_1 = (self.x[inner + 1] - self.x[inner - 1]) / 2
+        x_2 = (self.x[inner + 1] - 2 * self.x[inner] + self.x[inner - 1]) / 4
+        y_1 = (self.y[inner + 1] - self.y[inner - 1]) / 2
+        y_2 = (self.y[inner + 1] - 2 * self.y[inner] + self.y[inner - 1]) / 4
+        curvature = (x_1 * y_2 - x_2 * y_1) / _power(_power(y_1, 2) + _power(x_1, 2), 1.5)
+        segments = self.segments[inner]
+        pairs = segments[1:] == segments[:-1]
+        trapezoids = (curvature[1:] + curvature[:-1])[pairs] / 2.0
+        return np.abs(self._sum(segments[:-1][pairs], trapezoids))
+
+    def tortuosity_density(self) -> np.ndarray:
+        """
+        Tortuosity density of every vessel, as tortuosity_density: the vessel is cut at its
+        inflection points, the part after the last one is left out as retipy does.
+        """
+        ends = self.inflection_points()
+        count = self.inflection_count()
+        segments = self.segments[ends]
+        starts = np.empty_like(ends)
+        if len(ends):
+            starts[0] = self.offsets[segments[0]]
+            follows = segments[1:] == segments[:-1]
+            starts[1:] = np.where(follows, ends[:-1], self.offsets[segments[1:]])
+
+        # the part of every step, its two pixels lie in the same part
+        part = np.searchsorted(ends, np.arange(len(self.x)), side='right')
+        inside = np.zeros(len(self.x), dtype=bool)
+        valid = part < len(ends)
+        inside[valid] = np.arange(len(self.x))[valid] >= starts[part[valid]]
+        steps = inside[:-1] & inside[1:] & (part[:-1] == part[1:])
+        part_length = self._sum(part[:-1][steps], self._steps[steps], len(ends))
+
+        chord = _distance(self.x, self.y, starts, ends - 1)
+        ratio = np.zeros(len(ends))
+        np.divide(part_length, chord, out=ratio, where=chord != 0)
+        ratio[chord != 0] -= 1
+        sum_parts = self._sum(segments, ratio)
+
+        density = np.zeros(self.count)
+        bent = count > 0
+        density[bent] = (count[bent] - 1) / count[bent] + (1 / self.curve_length()[bent]) * sum_parts[bent]
+        return density
+
+    def _regression(self, x: np.ndarray, y: np.ndarray, sampling_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        # determination coefficient of every vessel, and whether retipy divided by zero for it
+        first, last = self.offsets[:-1], self.offsets[1:] - 1
+        run = x[last] - x[first]
+        flat = run == 0
+        slope = np.zeros(self.count)
+        slope[~flat] = (y[last] - y[first])[~flat] / run[~flat]
+        intercept = y[first] - slope * x[first]
+
+        # pixels 1, 1 + step... before the last one of every vessel
+        step = np.maximum(np.rint(self.lengths / sampling_size).astype(np.int64), 1)
+        samples = np.maximum(-(-(self.lengths - 2) // step), 0)
+        segments = np.repeat(np.arange(self.count), samples)
+        rank = np.arange(len(segments)) - np.repeat(np.cumsum(samples) - samples, samples)
+        pixels = self.offsets[segments] + 1 + rank * step[segments]
+
+        average = np.zeros(self.count)
+        sampled = samples > 0
+        average[sampled] = self._sum(segments, y[pixels])[sampled] / samples[sampled]
+        top = self._sum(segments, np.square(x[pixels] * slope[segments] + intercept[segments] - average[segments]))
+        bottom = self._sum(segments, np.square(y[pixels] - average[segments]))
+        zero = flat | (bottom == 0) | ~sampled
+        r_2 = np.zeros(self.count)
+        r_2[~zero] = top[~zero] / bottom[~zero]
+        return r_2, zero
+
+    def linear_regression(self, sampling_size: int = 6) -> np.ndarray:
+        """
+        Determination coefficient of the line between the ends of every vessel, as
+        linear_regression_tortuosity. Vessels of less than 4 pixels, for which retipy raises, get nan.
+        """
+        r_2, zero = self._regression(self.x, self.y, sampling_size)
+        if zero.any():
+            # retipy swaps x and y, with the default sampling size, then gives up with 1
+            inverted, inverted_zero = self._regression(self.y, self.x, 6)
+            r_2[zero] = np.where(inverted_zero, 1, inverted)[zero]
+        r_2[np.isnan(r_2)] = 0
+        r_2[self.lengths < 4] = np.nan
+        return r_2
+
+    def measures(self, sampling_size: int = 6) -> Dict[str, List[float]]:
+        """Every measure evaluate_window uses, as lists with one value per vessel."""
+        distance_inflection, inflections = self.distance_inflection_count()
+        return {
+            'linear_regression': self.linear_regression(sampling_size).tolist(),
+            'distance_measure': self.distance_measure().tolist(),
+            'curve_length': self.curve_length().tolist(),
+            'distance_inflection_count': distance_inflection.tolist(),
+            'inflection_count': inflections.tolist(),
+            'squared_curvature': self.squared_curvature().tolist(),
+            'tortuosity_density': self.tortuosity_density().tolist(),
+        }
@@ -0,0 +1,64 @@
+"""Pool of processes that runs the per-image post-processing of a stage while its inference goes on."""
+from __future__ import annotations
+
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+
+class TaskPool(object):
+    """
+    Runs tasks in a pool of processes in the background, e.g. the post-processing of the maps of a
+    batch while the next batches are inferred, and gives their results back in submission order.
+
+    With a single worker the tasks run in this process as soon as they are submitted. Only a
+    bounded number of tasks wait in the pool, submit() blocks on the oldest one beyond that, so
+    the maps of a large dataset are never all held in memory at once.
+
+    :param num_workers: the number of processes, by default the cores the reserved ones leave, 1 runs
+                        in this process
+    :param initializer: optional function every process runs first
+    :param max_pending: the number of tasks that may wait in the pool, 4 per process by default
+    :param reserved: the cores left to the other processes of the stage, e.g. its DataLoader workers,
+                     when the number of processes is not given
+    """
+
+    def __init__(self, num_workers: Optional[int] = None, initializer: Optional[Callable] = None,
+                 max_pending: Optional[int] = None, reserved: int = 0):
+        self.num_workers = num_workers or max(1, (os.cpu_count() or 1) - reserved)
+        self.max_pending = max_pending or 4 * self.num_workers
+        self._executor = None
+        if self.num_workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.num_workers, initializer=initializer)
+        self._results = []  # type: List[object]
+        self._first_pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(cancel=exc_type is not None)
+        return False
+
+    def submit(self, function: Callable, *args):
+        """Runs function(*args), the function must be defined at the top level of a module."""
+        if self._executor is None:
+            self._results.append(function(*args))
+            return
+        while len(self._results) - self._first_pending >= self.max_pending:
+            self._results[self._first_pending] = self._results[self._first_pending].result()
+            self._first_pending += 1
+        self._results.append(self._executor.submit(function, *args))
+
+    def results(self) -> list:
+        """Waits for every task submitted so far and returns their results, the error of a failed task is raised here."""
+        results = [result.result() if isinstance(result, Future) else result for result in self._results]
+        self._results = []
+        self._first_pending = 0
+        return results
+
+    def close(self, cancel: bool = False):
+        """Stops the processes, after the tasks left are done unless cancel."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=cancel)
+            self._executor = None
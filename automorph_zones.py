@@ -0,0 +1,104 @@
+"""Zones B and C around the optic disc, applied to the vessel maps from the disc centre and radius M2 records."""
+from __future__ import annotations
+
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from automorph_metadata import ZONE_INFO_PATH, zone_info
+from automorph_skeleton import remove_junctions
+
+CENTRED = ('Disc_centred', 'Macular_centred')
+
+# inner and outer radius of every zone, in disc radii
+ZONES = {
+    'B': (2, 3),
+    'C': (2, 5),
+}
+
+# skeleton and vessel map of every kind of vessel, relative to the results folder
+MAP_PATHS = {
+    'binary': ('M2/binary_vessel/binary_skeleton', 'M2/binary_vessel/binary_process'),
+    'artery': ('M2/artery_vein/artery_binary_skeleton', 'M2/artery_vein/artery_binary_process'),
+    'vein': ('M2/artery_vein/vein_binary_skeleton', 'M2/artery_vein/vein_binary_process'),
+}
+
+# radius of the images whose disc was not found, they have no zones
+NO_DISC = -1
+
+
+def zone_mask(shape: Tuple[int, int], centre: Tuple[int, int], radius: int, zone: str) -> np.ndarray:
+    """
+    The pixels of a zone, drawn with cv2.circle as the masks the maps used to be multiplied with.
+
+    :param shape: the shape of the maps
+    :param centre: the (x, y) centre of the disc
+    :param radius: the radius of the disc
+    :param zone: 'B' or 'C'
+    :return: a boolean image
+    """
+    inner, outer = ZONES[zone]
+    mask = np.zeros(shape, dtype=np.uint8)
+    cv2.circle(mask, (int(centre[0]), int(centre[1])), radius=outer*int(radius), color=1, thickness=-1)
+    cv2.circle(mask, (int(centre[0]), int(centre[1])), radius=inner*int(radius), color=0, thickness=-1)
+    return mask.view(bool)
+
+
+def write_zone_info(result_folder: str, rows: Sequence[Tuple[str, str, int, int, int]]):
+    """
+    Writes the centring and the disc of every image, see zone_info.
+
+    :param rows: the name, centring (one of CENTRED), x and y of the disc centre and disc radius,
+                 NO_DISC for the images whose disc was not found
+    """
+    path = os.path.join(result_folder, ZONE_INFO_PATH)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(list(rows), columns=['Name', 'Centred', 'Centre_w', 'Centre_h', 'Radius']).to_csv(
+        path, index=False, encoding='utf8')
+
+
+def centred_images(result_folder: str, centred: str, zoned: bool = False) -> List[str]:
+    """
+    The sorted names of the images of a centring.
+
+    :param centred: one of CENTRED
+    :param zoned: only the images whose disc was found, the ones with zones
+    """
+    table = zone_info(result_folder)
+    names = table.columns['Name'].astype(str)
+    keep = table.columns['Centred'] == centred
+    if zoned:
+        keep &= table.columns['Radius'] != NO_DISC
+    return sorted(names[keep])
+
+
+def zone_maps(result_folder: str, name: str, kind: str, zone: str,
+              size: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The skeleton, without its junctions, and the vessel map of an image, zeroed outside of a zone.
+
+    :param result_folder: the AutoMorph results folder
+    :param name: the image file name, e.g. 1.png
+    :param kind: one of the MAP_PATHS
+    :param zone: 'B' or 'C'
+    :param size: optional side the maps are then resized to, with cubic interpolation as retipy
+                 resizes the maps it opens
+    :return: the uint8 skeleton and vessel map
+    """
+    table = zone_info(result_folder)
+    skeleton_path, vessel_path = (os.path.join(result_folder, path, name) for path in MAP_PATHS[kind])
+    skeleton = cv2.imread(skeleton_path, cv2.IMREAD_GRAYSCALE)
+    vessel = cv2.imread(vessel_path, cv2.IMREAD_GRAYSCALE)
+    if skeleton is None or vessel is None:
+        raise FileNotFoundError(skeleton_path if skeleton is None else vessel_path)
+
+    mask = zone_mask(vessel.shape, (table.get(name, 'Centre_w'), table.get(name, 'Centre_h')),
+                     table.get(name, 'Radius'), zone)
+    skeleton = remove_junctions(skeleton, 1)
+    maps = np.where(mask, skeleton, 0).astype(np.uint8), np.where(mask, vessel, 0).astype(np.uint8)
+    if size is None or vessel.shape == (size, size):
+        return maps
+    return tuple(cv2.resize(image, dsize=(size, size), interpolation=cv2.INTER_CUBIC) for image in maps)
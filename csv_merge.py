@@ -11,7 +11,7 @@ from automorph_paths import prepare_automorph_data
 DEFAULT_AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA','.')
 
 
-def main():
+def main(argv=None):
     parser = ArgumentParser(description='Merge AutoMorph CSV outputs')
     parser.add_argument(
         '--image_folder',
@@ -23,7 +23,7 @@ def main():
         default=str(Path(DEFAULT_AUTOMORPH_DATA) / 'Results'),
         help='Path to the AutoMorph results folder'
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     automorph_base, _ = prepare_automorph_data(args.image_folder, args.result_folder)
 
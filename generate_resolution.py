@@ -11,13 +11,13 @@ def build_dataframe(image_folder: Path, pixel_resolution: float) -> pd.DataFrame
     return pd.DataFrame({'fundus': images, 'res': [pixel_resolution] * len(images)})
 
 
-def main() -> str:
+def main(argv=None) -> str:
     parser = argparse.ArgumentParser(description='Generate resolution_information.csv for AutoMorph runs.')
     parser.add_argument('--image_folder', required=True, help='Folder containing input images.')
     parser.add_argument('--result_folder', help='Folder where pipeline results are stored.')
     parser.add_argument('--output', help='Explicit path where resolution_information.csv should be written.')
     parser.add_argument('--pixel_resolution', type=float, default=None, help='Pixel resolution value to use for all images.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     image_path = Path(args.image_folder).expanduser().resolve()
     if not image_path.exists():